@@ -1,37 +1,11 @@
 # main.py
 import sys
 import os
+import time
 from dotenv import load_dotenv
 import streamlit as st
-import tempfile
-import gc
-import psutil
 from streamlit_mic_recorder import mic_recorder
 
-# --- Memory Management Setup ---
-@st.cache_resource(max_entries=1)
-def load_emotion_models():
-    """Load all emotion detection models with memory limits"""
-    # Your models will be loaded here with caching
-    return True
-
-# Emergency memory management
-if 'memory_cleanup_counter' not in st.session_state:
-    st.session_state.memory_cleanup_counter = 0
-
-st.session_state.memory_cleanup_counter += 1
-
-# Force cleanup every 3 interactions
-if st.session_state.memory_cleanup_counter % 3 == 0:
-    gc.collect()
-    st.cache_data.clear()
-
-# Memory cleanup function
-def cleanup_memory():
-    """Force garbage collection to free memory"""
-    gc.collect()
-    st.cache_data.clear()
-
 # --- UI Configuration & Custom CSS ---
 st.set_page_config(
     page_title="VibeTune 🎵",
@@ -44,11 +18,30 @@ load_dotenv()
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 # Import your improved modules
-from modules.face_emotion import detect_emotion_from_face
-from modules.text_emotion import get_bert_emotion
-from modules.voice_record import record_audio
-from modules.voice_emotion import detect_emotion_from_voice
-from modules.recommendation import get_tracks_for_emotion
+# These imports are cheap: models register a loader and are only built on first use
+# (or by the opt-in background warm-up at the end of this script), see modules/model_registry.py
+from modules import metrics, model_registry, result_cache
+
+_import_started = time.perf_counter()
+from modules.face_emotion import detect_emotion_from_face, detect_emotions_in_group
+model_registry.record_import("face_emotion", time.perf_counter() - _import_started)
+
+_import_started = time.perf_counter()
+from modules.text_emotion import get_text_emotion
+model_registry.record_import("text_emotion", time.perf_counter() - _import_started)
+
+_import_started = time.perf_counter()
+from modules.voice_emotion import EMOTION_LABELS as VOICE_EMOTION_LABELS, detect_emotion_from_voice, detect_emotion_timeline
+model_registry.record_import("voice_emotion", time.perf_counter() - _import_started)
+
+_import_started = time.perf_counter()
+from modules.recommendation import get_spotify, get_tracks_for_emotion
+model_registry.record_import("recommendation", time.perf_counter() - _import_started)
+
+from modules import fusion
+
+# Prometheus metrics on http://127.0.0.1:$METRICS_PORT/metrics (started once per process)
+metrics.start_http_server()
 
 # Custom CSS for a more polished look
 st.markdown("""
@@ -65,25 +58,22 @@ with st.sidebar:
     st.markdown("Detect your emotion and get personalized music recommendations from Spotify.")
     st.markdown("---")
     
-    # Memory management controls
-    if st.button("🧹 Clear Memory", help="Free up memory to prevent resource limits"):
-        cleanup_memory()
-        st.success("Memory cleared!")
-        st.rerun()
+    # Model memory: what is resident right now, bounded by MODEL_MEMORY_BUDGET_MB
+    memory = model_registry.memory_stats()
+    st.caption(f"Memory Usage: {memory['rss_mb']:.1f} MB")
+    budget = f" / {memory['budget_mb']:.0f} MB budget" if memory['budget_mb'] else ""
+    st.caption(f"Models resident: {', '.join(memory['resident']) or 'none'} ({memory['resident_mb']:.0f} MB{budget})")
+    if memory['evictions']:
+        st.caption("Evictions: " + ", ".join(f"{name} ×{count}" for name, count in memory['evictions'].items()))
     
-    # Show current memory status
-    try:
-        process = psutil.Process(os.getpid())
-        memory_mb = process.memory_info().rss / 1024 / 1024
-        st.caption(f"Memory Usage: {memory_mb:.1f} MB")
-        if memory_mb > 2000:  # Warning if approaching 2GB limit
-            st.warning("⚠️ High memory usage detected")
-    except:
-        pass
+    if st.button("🧹 Unload Models", help="Free model memory; models reload on next use"):
+        model_registry.evict_all()
+        st.success("Models unloaded!")
+        st.rerun()
     
     # Test Spotify connection
     if st.button("🔗 Test Spotify Connection"):
-        from modules.recommendation import sp
+        sp = get_spotify()
         if sp:
             try:
                 result = sp.search(q="test", limit=1)
@@ -93,6 +83,30 @@ with st.sidebar:
         else:
             st.error("❌ Spotify not connected")
     
+    # Cold-start costs: module imports and per-model load times
+    with st.expander("⏱️ Startup timings"):
+        timings = model_registry.timings()
+        for name, seconds in timings["import_s"].items():
+            st.caption(f"import {name}: {seconds:.2f}s")
+        for name in model_registry.registered():
+            if name in timings["load_s"]:
+                st.caption(f"{name} model: loaded in {timings['load_s'][name]:.1f}s")
+            else:
+                st.caption(f"{name} model: not loaded yet")
+    
+    # Where the time of the most recent analyses went (see modules/metrics.py)
+    with st.expander("📈 Latency breakdown"):
+        traces = metrics.recent_traces()[:3]
+        if not traces:
+            st.caption("No requests yet.")
+        for request in traces:
+            st.caption(f"**{request['name']}**: {request['total'] * 1000:.0f} ms")
+            for name, seconds in request["spans"]:
+                st.caption(f"· {name}: {seconds * 1000:.1f} ms")
+        # Repeat analyses of the same input are answered from the result cache (modules/result_cache.py)
+        for name, cache in result_cache.stats().items():
+            st.caption(f"{name} cache: {cache['hit_ratio']:.0%} hits ({cache['size']} results)")
+    
     st.markdown("---")
     st.markdown("Built by [Reeth Jain](https://github.com/reethj-07) 👨💻")
     st.markdown("🔗 [GitHub Repo](https://github.com/reethj-07/emotion-music-recommender)")
@@ -132,21 +146,28 @@ with tab1:
         if image_file:
             st.image(image_file, caption="Your Image", width=250)
             
+            all_faces = st.checkbox("Analyze every face (group photo)", key="face_all")
+            
             if st.button("Analyze Face", key="face_analyze"):
-                with st.spinner("Analyzing..."):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                        tmp.write(image_file.getvalue())
-                        emotion = detect_emotion_from_face(tmp.name)
-                        
-                        if emotion and emotion not in ["No face detected", "Uncertain", "Error"]:
-                            st.success(f"Emotion Detected: **{emotion}**")
-                            st.session_state.detected_emotions["Face"] = emotion
+                with st.spinner("Analyzing..."), metrics.trace("face"):
+                    # The upload is decoded in memory, no temporary file needed
+                    if all_faces:
+                        group = detect_emotions_in_group(image_file.getvalue())
+                        if isinstance(group, str):
+                            emotion = group
                         else:
-                            st.warning(emotion)
+                            emotion = group["group_emotion"]
+                            for i, face in enumerate(group["faces"], start=1):
+                                st.caption(f"Face {i}: {face['emotion']}")
+                    else:
+                        emotion = detect_emotion_from_face(image_file.getvalue())
                     
-                    # Clean up temporary file and memory
-                    os.unlink(tmp.name)
-                    gc.collect()
+                    if emotion and emotion not in ["No face detected", "Uncertain", "Error", "Error loading image"]:
+                        emotion = fusion.to_unified(emotion)
+                        st.success(f"Emotion Detected: **{emotion}**")
+                        st.session_state.detected_emotions["Face"] = emotion
+                    else:
+                        st.warning(emotion)
 
 with tab2:
     st.subheader("Analyze Emotion From Your Words")
@@ -155,17 +176,14 @@ with tab2:
     
     if st.button("Analyze Text", key="text_button"):
         if user_input.strip():
-            with st.spinner("Analyzing..."):
-                emotion = get_bert_emotion(user_input)
+            with st.spinner("Analyzing..."), metrics.trace("text"):
+                emotion = get_text_emotion(user_input)
                 
                 if emotion and emotion not in ["Uncertain", "Error"]:
                     st.success(f"Emotion Detected: **{emotion}**")
                     st.session_state.detected_emotions["Text"] = emotion
                 else:
                     st.warning(emotion)
-                
-                # Clean up memory after text processing
-                gc.collect()
         else:
             st.warning("Please enter some text.")
 
@@ -196,28 +214,57 @@ with tab3:
             audio_file_to_process = audio['bytes']
     
     if audio_file_to_process:
+        show_timeline = st.checkbox("Show emotion timeline (long recordings)", key="voice_timeline")
+        
         if st.button("Analyze Voice", key="voice_analyze"):
-            with st.spinner("Analyzing..."):
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                    if isinstance(audio_file_to_process, str):  # Path from recording
-                        with open(audio_file_to_process, 'rb') as f: 
-                            tmp.write(f.read())
-                    elif hasattr(audio_file_to_process, 'getvalue'):  # Uploaded file object
-                        tmp.write(audio_file_to_process.getvalue())
-                    else:  # Raw bytes from mic_recorder
-                        tmp.write(audio_file_to_process)
-                    
-                    emotion = detect_emotion_from_voice(tmp.name)
-                    
-                    if emotion and "Error" not in emotion and "failed" not in emotion and "silent" not in emotion:
-                        st.success(f"Emotion Detected: **{emotion}**")
-                        st.session_state.detected_emotions["Voice"] = emotion
+            with st.spinner("Analyzing..."), metrics.trace("voice"):
+                # Paths, uploaded file objects and raw mic_recorder bytes are all accepted; the timeline decodes block by block
+                if show_timeline:
+                    result = detect_emotion_timeline(audio_file_to_process)
+                    if isinstance(result, str):
+                        emotion = result
                     else:
-                        st.warning(emotion)
+                        emotion = result["emotion"]
+                        for segment in result["timeline"]:
+                            st.caption(f"{segment['start']:.1f}s – {segment['end']:.1f}s: {segment['emotion']}")
+                else:
+                    emotion = detect_emotion_from_voice(audio_file_to_process)
                 
-                # Clean up temporary file and memory
-                os.unlink(tmp.name)
-                gc.collect()
+                # Anything but a real label ("Uncertain", "Voice model not loaded.", errors) is only a warning
+                if emotion in VOICE_EMOTION_LABELS:
+                    st.success(f"Emotion Detected: **{emotion}**")
+                    st.session_state.detected_emotions["Voice"] = emotion
+                else:
+                    st.warning(emotion)
+
+# --- Combined Analysis ---
+# Every input given in the tabs above is analyzed at the same time and the probabilities are fused
+fusion_inputs = {
+    "face": image_file.getvalue() if image_file else None,
+    "text": user_input if user_input.strip() else None,
+    "voice": audio_file_to_process,
+}
+if any(source is not None for source in fusion_inputs.values()):
+    st.markdown("---")
+    st.subheader("🔀 Combined Analysis")
+    provided = [name for name, source in fusion_inputs.items() if source is not None]
+    st.caption(f"Inputs: {', '.join(provided)}")
+    
+    if st.button("Analyze All Inputs Together", key="fusion_analyze"):
+        with st.spinner("Analyzing..."), metrics.trace("combined"):
+            result = fusion.analyze(**fusion_inputs)
+        
+        for name, modality in result["modalities"].items():
+            if modality["confidence"] is None:
+                st.caption(f"{name.title()}: {modality['emotion']}")
+            else:
+                st.caption(f"{name.title()}: {modality['emotion']} ({modality['confidence']:.0%}, {modality['latency_s']:.1f}s)")
+        
+        if result["confidence"] is not None and result["emotion"] != "Uncertain":
+            st.success(f"Combined Emotion: **{result['emotion']}** ({result['confidence']:.0%})")
+            st.session_state.detected_emotions["Combined"] = result["emotion"]
+        else:
+            st.warning(result["emotion"])
 
 # --- Music Recommendations ---
 st.markdown("---")
@@ -232,7 +279,7 @@ else:
     selected_emotion = emotion_options[selected_option]
     
     if st.button(f"Get Songs for '{selected_emotion}'", key="get_songs"):
-        with st.spinner(f"Finding songs on Spotify for a '{selected_emotion}' vibe..."):
+        with st.spinner(f"Finding songs on Spotify for a '{selected_emotion}' vibe..."), metrics.trace("recommendation"):
             tracks = get_tracks_for_emotion(selected_emotion)
             
             if not tracks:
@@ -257,6 +304,9 @@ else:
                             st.audio(track['preview_url'], format="audio/mp3")
                     
                     st.divider()
-            
-            # Clean up memory after song recommendations
-            gc.collect()
+
+# With MODEL_WARM_UP set, preload those models in a background thread once the page has
+# rendered, so the first analysis doesn't pay for them (runs once per process)
+warm_up_names = model_registry.configured_warm_up()
+if warm_up_names:
+    model_registry.warm_up(warm_up_names)
@@ -0,0 +1,123 @@
+# app/service.py
+# Headless HTTP inference service. Wraps the same module functions as the Streamlit app, but
+# requests from different clients share forward passes through a micro-batcher per model.
+#
+#   python -m app.service --port 8000 --workers 2
+#
+#   curl -F file=@face.jpg localhost:8000/face
+#   curl -H 'Content-Type: application/json' -d '{"text": "What a day!"}' localhost:8000/text
+#   curl -F file=@clip.wav localhost:8000/voice
+#   curl 'localhost:8000/recommend?emotion=Happy&limit=10'
+import argparse
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+load_dotenv()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from modules import metrics, model_registry, result_cache
+from modules.batching import MicroBatcher
+from modules.face_emotion import detect_emotions_from_faces
+from modules.recommendation import get_tracks_for_emotion
+from modules.text_emotion import TEXT_CASCADE_ENABLED, get_bert_emotion_probabilities, get_cascade_emotions, label_from_scores
+from modules.voice_emotion import detect_emotions_from_voices
+
+SERVICE_MAX_BATCH = int(os.getenv("SERVICE_MAX_BATCH", "16"))
+SERVICE_MAX_WAIT_MS = float(os.getenv("SERVICE_MAX_WAIT_MS", "5"))
+
+def _score_texts(texts):
+    if TEXT_CASCADE_ENABLED:
+        return [{"emotion": label, "probabilities": None} for label in get_cascade_emotions(texts)]
+    # Same calibrated labeling as the app, so a below-threshold top class comes back "Uncertain"
+    results = [{"emotion": label_from_scores(scores), "probabilities": scores}
+               for scores in get_bert_emotion_probabilities(texts)]
+    metrics.inc("uncertain_total", sum(r["emotion"] == "Uncertain" for r in results), modality="text")
+    return results
+
+# One thread per model, so a face batch and a text batch can run at the same time
+_model_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="inference")
+batchers = {
+    # The micro-batch is already at most SERVICE_MAX_BATCH images; score exactly those, so a lone
+    # request on an idle service costs a one-image forward pass
+    "face": MicroBatcher(lambda images: detect_emotions_from_faces(images, batch_size=max(1, len(images))),
+                         SERVICE_MAX_BATCH, SERVICE_MAX_WAIT_MS, _model_pool, "face"),
+    "text": MicroBatcher(_score_texts, SERVICE_MAX_BATCH, SERVICE_MAX_WAIT_MS, _model_pool, "text"),
+    "voice": MicroBatcher(detect_emotions_from_voices, SERVICE_MAX_BATCH, SERVICE_MAX_WAIT_MS, _model_pool, "voice"),
+}
+
+@asynccontextmanager
+async def lifespan(app):
+    # Opt-in background warm-up (MODEL_WARM_UP, see modules/model_registry.py)
+    names = model_registry.configured_warm_up()
+    if names:
+        model_registry.warm_up(names)
+    yield
+
+app = FastAPI(title="VibeTune inference service", lifespan=lifespan)
+
+class TextRequest(BaseModel):
+    text: str
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/stats")
+async def stats():
+    return {
+        "batchers": {name: batcher.stats for name, batcher in batchers.items()},
+        "models": model_registry.memory_stats(),
+        "result_caches": result_cache.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return metrics.render()
+
+@app.get("/profile", response_class=PlainTextResponse)
+async def profile():
+    """Folded stacks from the sampling profiler (PROFILE_SAMPLING=1), for flamegraph tools."""
+    if metrics.profiler() is None:
+        raise HTTPException(status_code=404, detail="Sampling profiler is off; set PROFILE_SAMPLING=1.")
+    return metrics.profiler().folded()
+
+@app.post("/face")
+async def face(file: UploadFile = File(...)):
+    return await batchers["face"].submit(await file.read())
+
+@app.post("/text")
+async def text(request: TextRequest):
+    if not request.text.strip():
+        raise HTTPException(status_code=422, detail="Text is empty.")
+    return await batchers["text"].submit(request.text)
+
+@app.post("/voice")
+async def voice(file: UploadFile = File(...)):
+    return await batchers["voice"].submit(await file.read())
+
+@app.get("/recommend")
+async def recommend(emotion: str, limit: int = 10):
+    tracks = await asyncio.get_running_loop().run_in_executor(None, get_tracks_for_emotion, emotion, limit)
+    return {"emotion": emotion, "tracks": tracks}
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the VibeTune inference service.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVICE_WORKERS", "1")),
+                        help="Worker processes; each one loads its own copy of the models")
+    args = parser.parse_args()
+    uvicorn.run("app.service:app", host=args.host, port=args.port, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# modules/batching.py
+# Dynamic micro-batching for asyncio servers: concurrent requests for the same model are
+# collected for up to `max_wait_ms` (or until `max_batch_size` items) and run as one batch.
+import asyncio
+import time
+
+class MicroBatcher:
+    """
+    Wraps a synchronous `batch_fn(items) -> results` (same length, same order).
+    `await batcher.submit(item)` returns that item's result. The batch function runs in
+    `executor` so the event loop keeps accepting requests while a batch is on the model.
+    """
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=5.0, executor=None, name="batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.name = name
+        self.stats = {"requests": 0, "batches": 0, "max_batch": 0, "busy_s": 0.0}
+        self._queue = None
+        self._worker = None
+
+    async def submit(self, item):
+        if self._worker is None:
+            # Created lazily so the queue belongs to the running event loop
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run(), name=f"{self.name}-worker")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            started = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats["busy_s"] += time.perf_counter() - started
+
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,462 @@
+# modules/benchmark.py
+# Performance benchmarks for every pipeline stage and end to end.
+#
+# Each case runs for every batch size and thread count (threads = concurrent callers). The report
+# includes p50/p95/p99 latency per call, throughput in items/s and peak RSS. Fixtures are RAF-DB
+# test images plus synthetic text and audio; Spotify is replaced by the local stub
+# (modules/spotify_stub.py), so no credentials or network are needed. Cases whose dependencies
+# or models are unavailable are reported as skipped.
+#
+#   python -m modules.benchmark                                   # everything, saved to benchmarks/latest.json
+#   python -m modules.benchmark --groups face --batch-sizes 1,8,32 --threads 1,4
+#   python -m modules.benchmark --groups detect --threads 1        # detection latency vs. photo size
+#   python -m modules.benchmark --baseline benchmarks/baseline.json --threshold 0.15
+#   python -m modules.benchmark --compare benchmarks/latest.json --baseline benchmarks/baseline.json
+#
+# With --baseline the exit status is 1 when any case's p95 latency rose, or its throughput fell,
+# by more than the threshold.
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RAFDB_TEST_DIR = os.path.join(REPO_ROOT, "data", "RAF-DB", "test")
+DEFAULT_OUTPUT = os.path.join(REPO_ROOT, "benchmarks", "latest.json")
+GROUPS = ["face", "detect", "text", "voice", "cache", "spotify", "import", "end_to_end"]
+# Photo widths for the detection-latency-vs-image-size cases (4032 px = a 12 MP phone photo)
+DETECT_SIZES = [640, 1280, 2016, 4032]
+IMPORT_MODULES = ["modules.face_emotion", "modules.text_emotion", "modules.voice_emotion", "modules.recommendation"]
+EMOTIONS = ["Happy", "Sad", "Angry", "Calm", "Neutral", "Surprised", "Fearful", "Disgust"]
+
+TEXT_TEMPLATES = [
+    "I just got the news and I {} can't believe how {} this day turned out.",
+    "Honestly the {} meeting was {} and I want to go home.",
+    "We finally {} the project and everyone felt {} about it!",
+    "Why does everything {} go wrong when I'm already {}?",
+    "It was a {} afternoon, nothing {} happened at all.",
+]
+TEXT_WORDS = ["really", "amazing", "terrible", "quiet", "finished", "always", "so", "scary", "calm", "great", "awful", "ordinary"]
+
+# --- Fixtures ---
+class Fixtures:
+    """Benchmark inputs, built on first use. Everything is held in memory so disk I/O isn't measured."""
+    def __init__(self, image_count=256, audio_count=32, audio_seconds=3.0, seed=0):
+        self.image_count = image_count
+        self.audio_count, self.audio_seconds = audio_count, audio_seconds
+        self.rng = np.random.default_rng(seed)
+        self._text_counter = itertools.count()
+        self._text_lock = threading.Lock()
+        self._cache = {}
+
+    def _cached(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def image_bytes(self):
+        def build():
+            from modules.rafdb import list_images
+            items = list_images(RAFDB_TEST_DIR)
+            if not items:
+                raise FileNotFoundError(f"No images under {RAFDB_TEST_DIR}")
+            # Evenly spaced, so every class is represented
+            step = max(1, len(items) // self.image_count)
+            paths = [path for path, _ in items[::step][:self.image_count]]
+            data = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    data.append(f.read())
+            return data
+        return self._cached("image_bytes", build)
+
+    def images(self):
+        from modules.face_emotion import load_image
+        return self._cached("images", lambda: [load_image(data) for data in self.image_bytes()])
+
+    def face_crops(self):
+        """Model-ready float32 crops (RAF-DB test images are already aligned faces)."""
+        import cv2
+        from modules.face_emotion import IMG_SIZE
+
+        def build():
+            crops = [cv2.cvtColor(cv2.resize(image, (IMG_SIZE, IMG_SIZE)), cv2.COLOR_BGR2RGB) for image in self.images()]
+            return np.stack(crops).astype(np.float32) / 255.0
+        return self._cached("face_crops", build)
+
+    def scenes(self, width, count=4):
+        """Photo-sized 4:3 frames with one RAF-DB face (a quarter of the width) on a textured background."""
+        import cv2
+
+        def build():
+            height = width * 3 // 4
+            face_size = width // 4
+            frames = []
+            for image in self.images()[:count]:
+                noise = self.rng.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+                frame = cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR)
+                y = int(self.rng.integers(0, height - face_size))
+                x = int(self.rng.integers(0, width - face_size))
+                frame[y:y + face_size, x:x + face_size] = cv2.resize(image, (face_size, face_size))
+                frames.append(frame)
+            return frames
+        return self._cached(f"scenes_{width}", build)
+
+    def texts(self, count):
+        """Unique sentences every call, so the text emotion cache never answers for the model."""
+        texts = []
+        with self._text_lock:  # numpy Generators aren't thread-safe
+            for _ in range(count):
+                template = TEXT_TEMPLATES[self.rng.integers(len(TEXT_TEMPLATES))]
+                words = self.rng.choice(TEXT_WORDS, size=2)
+                texts.append(template.format(*words) + f" ({next(self._text_counter)})")
+        return texts
+
+    def waveforms(self):
+        """Speech-like synthetic clips at 16 kHz: a gliding harmonic tone with syllable-rate envelope and noise."""
+        from modules.voice_emotion import SAMPLE_RATE
+
+        def build():
+            t = np.arange(int(self.audio_seconds * SAMPLE_RATE)) / SAMPLE_RATE
+            clips = []
+            for _ in range(self.audio_count):
+                pitch = self.rng.uniform(90, 250) * (1 + 0.1 * np.sin(2 * np.pi * self.rng.uniform(0.5, 2) * t))
+                phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+                voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+                envelope = 0.5 * (1 + np.sin(2 * np.pi * self.rng.uniform(3, 6) * t))
+                clip = 0.3 * voice * envelope + 0.01 * self.rng.standard_normal(len(t))
+                clips.append(clip.astype(np.float32))
+            return clips
+        return self._cached("waveforms", build)
+
+    def audio_bytes(self):
+        import soundfile as sf
+        from modules.voice_emotion import SAMPLE_RATE
+
+        def build():
+            encoded = []
+            for clip in self.waveforms():
+                buffer = io.BytesIO()
+                sf.write(buffer, clip, SAMPLE_RATE, format="WAV", subtype="PCM_16")
+                encoded.append(buffer.getvalue())
+            return encoded
+        return self._cached("audio_bytes", build)
+
+def _cycle(items, batch_size):
+    """Returns a thread-safe function that hands out the next `batch_size` items, wrapping around."""
+    counter = itertools.count()
+
+    def next_batch():
+        start = next(counter) * batch_size
+        return [items[(start + i) % len(items)] for i in range(batch_size)]
+    return next_batch
+
+# --- Cases: factory(fixtures, batch_size) -> zero-argument callable that processes batch_size items ---
+def _face_decode(fixtures, batch_size):
+    from modules.face_emotion import load_image
+    next_batch = _cycle(fixtures.image_bytes(), batch_size)
+    return lambda: [load_image(data) for data in next_batch()]
+
+def _face_detect(fixtures, batch_size):
+    from modules.face_emotion import detect_faces
+    next_batch = _cycle(fixtures.images(), batch_size)
+    return lambda: [detect_faces(image) for image in next_batch()]
+
+def _face_preprocess(fixtures, batch_size):
+    from modules.face_emotion import preprocess_face
+    next_batch = _cycle(fixtures.image_bytes(), batch_size)
+    return lambda: [preprocess_face(data) for data in next_batch()]
+
+def _detect(detector, width, max_side=None):
+    """Detection latency on a photo of the given width; max_side=0 disables the downscale step."""
+    def factory(fixtures, batch_size):
+        from modules.face_detectors import load_face_detector
+        options = {} if max_side is None else {"max_side": max_side}
+        face_detector = load_face_detector(detector, **options)
+        next_batch = _cycle(fixtures.scenes(width), 1)
+        return lambda: face_detector.detect(next_batch()[0])
+    return factory
+
+def _face_forward(fixtures, batch_size):
+    from modules.face_emotion import get_face_model
+    crops = fixtures.face_crops()
+    next_batch = _cycle(list(range(len(crops))), batch_size)
+    return lambda: get_face_model().predict(crops[next_batch()])
+
+def _face_end_to_end(fixtures, batch_size):
+    from modules.face_emotion import detect_emotions_from_faces
+    next_batch = _cycle(fixtures.image_bytes(), batch_size)
+    return lambda: detect_emotions_from_faces(next_batch(), batch_size=batch_size)
+
+def _text_forward(fixtures, batch_size):
+    from modules.text_emotion import get_bert_emotion_probabilities
+    return lambda: get_bert_emotion_probabilities(fixtures.texts(batch_size), batch_size)
+
+def _text_end_to_end(fixtures, batch_size):
+    from modules.text_emotion import get_text_emotion
+    return lambda: get_text_emotion(fixtures.texts(1)[0])
+
+def _voice_decode(fixtures, batch_size):
+    from modules.voice_emotion import load_audio
+    next_batch = _cycle(fixtures.audio_bytes(), batch_size)
+    return lambda: [load_audio(data) for data in next_batch()]
+
+def _voice_forward(fixtures, batch_size):
+    from modules.voice_emotion import classify_voice_clips, get_voice_model
+    if get_voice_model()[1] is None:
+        raise RuntimeError("Voice model not loaded")
+    next_batch = _cycle(fixtures.waveforms(), batch_size)
+    return lambda: classify_voice_clips(next_batch())
+
+def _voice_end_to_end(fixtures, batch_size):
+    from modules.voice_emotion import detect_emotion_from_voice
+    next_batch = _cycle(fixtures.audio_bytes(), 1)
+    return lambda: detect_emotion_from_voice(next_batch()[0])
+
+def _spotify_fetch(fixtures, batch_size):
+    from modules.recommendation import get_tracks_for_emotion
+    next_emotion = _cycle(EMOTIONS, 1)
+    return lambda: get_tracks_for_emotion(next_emotion()[0])
+
+def _face_to_tracks(fixtures, batch_size):
+    """What the app does for an uploaded photo: emotion of the largest face, then a playlist for it."""
+    from modules.face_emotion import detect_emotion_from_face
+    from modules.recommendation import get_tracks_for_emotion
+    next_batch = _cycle(fixtures.image_bytes(), 1)
+
+    def run():
+        emotion = detect_emotion_from_face(next_batch()[0])
+        return get_tracks_for_emotion(emotion if emotion in EMOTIONS else "Neutral")
+    return run
+
+def _result_cache_hit(fixtures, batch_size):
+    """A repeated analysis: hash the upload's bytes and look the stored result up."""
+    from modules.result_cache import ResultCache, content_key
+    cache = ResultCache("benchmark", disk_dir="")
+    images = fixtures.image_bytes()
+    for data in images:
+        cache.put(content_key(data, "benchmark"), {"emotion": "Happy"})
+    next_batch = _cycle(images, batch_size)
+    return lambda: [cache.get(content_key(data, "benchmark")) for data in next_batch()]
+
+def _cold_import(module):
+    def factory(fixtures, batch_size):
+        command = [sys.executable, "-c", f"import {module}"]
+
+        def run():
+            completed = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+        return run
+    return factory
+
+# (name, group, batched, factory); unbatched cases only run with batch size 1
+CASES = [
+    ("face.decode", "face", True, _face_decode),
+    ("face.detect", "face", True, _face_detect),
+    ("face.preprocess", "face", True, _face_preprocess),
+    ("face.forward", "face", True, _face_forward),
+    *[(f"detect.{detector}.{width}px{suffix}", "detect", False, _detect(detector, width, max_side))
+      for detector in ("haar", "dnn") for width in DETECT_SIZES
+      for suffix, max_side in (("", None), (".full_res", 0))],
+    ("face.end_to_end", "face", True, _face_end_to_end),
+    ("text.forward", "text", True, _text_forward),
+    ("text.end_to_end", "text", False, _text_end_to_end),
+    ("voice.decode", "voice", True, _voice_decode),
+    ("voice.forward", "voice", True, _voice_forward),
+    ("voice.end_to_end", "voice", False, _voice_end_to_end),
+    ("cache.result_hit", "cache", True, _result_cache_hit),
+    ("spotify.fetch", "spotify", False, _spotify_fetch),
+    ("end_to_end.face_to_tracks", "end_to_end", False, _face_to_tracks),
+] + [(f"import.{module.split('.')[-1]}", "import", False, _cold_import(module)) for module in IMPORT_MODULES]
+
+# --- Measurement ---
+class PeakRss:
+    """Samples this process's RSS in a background thread while the block runs."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_mb = None
+
+    def _current_mb(self):
+        try:
+            import psutil
+            return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+        except ImportError:
+            import resource
+            # ru_maxrss is the lifetime peak (KiB on Linux); the best available without psutil
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, self._current_mb())
+
+    def __enter__(self):
+        self.peak_mb = self._current_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, self._current_mb())
+
+def measure(fn, items_per_call, iterations, threads=1, warmup=2):
+    """Runs fn `iterations` times across `threads` callers and summarizes latency, throughput and RSS."""
+    # Warm-up calls absorb model loading and first-call allocation
+    for _ in range(warmup):
+        fn()
+
+    def timed(_):
+        started = time.perf_counter()
+        fn()
+        return time.perf_counter() - started
+
+    with PeakRss() as rss:
+        started = time.perf_counter()
+        if threads == 1:
+            latencies = [timed(i) for i in range(iterations)]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                latencies = list(pool.map(timed, range(iterations)))
+        wall = time.perf_counter() - started
+
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        "iterations": iterations,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(latencies_ms.mean()), 3),
+        "throughput": round(iterations * items_per_call / wall, 3),
+        "peak_rss_mb": round(rss.peak_mb, 1),
+    }
+
+def run(groups, batch_sizes, thread_counts, iterations, fixtures):
+    results = []
+    for name, group, batched, factory in CASES:
+        if group not in groups:
+            continue
+        for batch_size in (batch_sizes if batched else [1]):
+            for threads in thread_counts:
+                key = {"name": name, "batch_size": batch_size, "threads": threads}
+                # Subprocess imports are slow and don't benefit from more samples
+                case_iterations = min(iterations, 5) if group == "import" else iterations
+                try:
+                    fn = factory(fixtures, batch_size)
+                    result = {**key, **measure(fn, batch_size, case_iterations, threads)}
+                except Exception as e:
+                    result = {**key, "skipped": f"{type(e).__name__}: {e}"}
+                    print(f"{name:<28} b={batch_size:<3} t={threads:<2} skipped ({result['skipped']})")
+                    results.append(result)
+                    break  # The same failure would repeat for every thread count
+                print(f"{name:<28} b={batch_size:<3} t={threads:<2} p50 {result['p50_ms']:>9.2f} ms  "
+                      f"p95 {result['p95_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+                      f"{result['throughput']:>9.1f} items/s  peak {result['peak_rss_mb']:.0f} MB")
+                results.append(result)
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    settings = ["FACE_MODEL_BACKEND", "TEXT_MODEL_BACKEND", "VOICE_MODEL_BACKEND", "TEXT_CASCADE",
+                "ONNX_INTRA_OP_THREADS", "FACE_MODEL_THREADS", "MODEL_MEMORY_BUDGET_MB"]
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {name: os.getenv(name) for name in settings if os.getenv(name)},
+    }
+
+# --- Baseline comparison ---
+def compare(current, baseline, threshold):
+    """Returns a list of regression messages: p95 latency up, or throughput down, by more than threshold."""
+    def index(report):
+        return {(r["name"], r["batch_size"], r["threads"]): r for r in report["results"] if "skipped" not in r}
+
+    before, after = index(baseline), index(current)
+    regressions = []
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        label = f"{key[0]} b={key[1]} t={key[2]}"
+        if new["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            regressions.append(f"{label}: p95 {old['p95_ms']:.2f} -> {new['p95_ms']:.2f} ms "
+                               f"(+{new['p95_ms'] / old['p95_ms'] - 1:.0%})")
+        if new["throughput"] < old["throughput"] * (1 - threshold):
+            regressions.append(f"{label}: throughput {old['throughput']:.1f} -> {new['throughput']:.1f} items/s "
+                               f"({new['throughput'] / old['throughput'] - 1:.0%})")
+    missing = sorted(before.keys() - after.keys())
+    for key in missing:
+        print(f"Not measured in this run: {key[0]} b={key[1]} t={key[2]}")
+    return regressions
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the emotion pipelines and recommendations.")
+    parser.add_argument("--groups", default=",".join(GROUPS), help=f"Comma-separated subset of {','.join(GROUPS)}")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--threads", type=_int_list, default=[1, 4])
+    parser.add_argument("--iterations", type=int, default=30, help="Timed calls per case")
+    parser.add_argument("--stub-latency-ms", type=float, default=20, help="Simulated Spotify API latency")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", help="Earlier result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed relative regression (0.10 = 10%%)")
+    parser.add_argument("--compare", metavar="RESULT", help="Only compare this result JSON with --baseline, don't run")
+    args = parser.parse_args()
+
+    if args.compare:
+        if not args.baseline:
+            parser.error("--compare needs --baseline")
+        with open(args.compare) as f:
+            report = json.load(f)
+    else:
+        groups = set(args.groups.split(","))
+        # Repeated fixtures would otherwise be answered by the result cache instead of the pipeline
+        os.environ["RESULT_CACHE"] = "0"
+        if groups & {"spotify", "end_to_end"}:
+            # Must be set before modules.recommendation is imported; the cache would hide the fetch cost
+            from modules.spotify_stub import start_stub_server
+            _, base_url = start_stub_server(latency_ms=args.stub_latency_ms)
+            os.environ["SPOTIFY_API_URL"] = base_url
+            os.environ["TRACK_CACHE_ENABLED"] = "0"
+            os.environ["RECOMMENDATION_SOURCE"] = "spotify"
+
+        report = {"environment": environment(),
+                  "config": {"batch_sizes": args.batch_sizes, "threads": args.threads,
+                             "iterations": args.iterations, "stub_latency_ms": args.stub_latency_ms},
+                  "results": run(groups, args.batch_sizes, args.threads, args.iterations, Fixtures())}
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {len(report['results'])} results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+# modules/bulk_score.py
+# Offline batch scoring for whole datasets (nightly re-scoring, model regression checks).
+#
+# Files are decoded on a thread pool that runs at most `--queue-size` items ahead of the model,
+# and the decoded items are classified in batches through the face/text/voice modules. Results
+# are appended to the output after every batch, so an interrupted run continues where it stopped
+# with --resume (items already in the output are skipped). When inputs carry labels a confusion
+# matrix is printed and, with --report, saved as JSON together with the throughput.
+#
+#   python -m modules.bulk_score face data/RAF-DB/test --aligned -o scores/face.csv
+#   python -m modules.bulk_score text reviews.csv -o scores/text.parquet --resume
+#   python -m modules.bulk_score voice recordings/ -o scores/voice.csv --report scores/voice.json
+#
+# Inputs:
+#   face   a directory tree of images; the parent folder is the label (RAF-DB digits 1-7 or emotion names)
+#   text   a CSV or JSONL manifest with a "text" column and optional "id" and "label" columns
+#   voice  a directory tree of audio files (parent folder = label), or a CSV manifest with "path" and optional "label"
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a", ".webm")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+OUTPUT_COLUMNS = ["id", "label", "emotion", "confidence", "probabilities"]
+
+# --- Inputs: every item is {"id", "label", "source"} ---
+def _iter_tree(root, extensions, label_names=None):
+    """Walks root in sorted order; the label is the parent folder name (None for files directly in root)."""
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        folder = os.path.relpath(directory, root)
+        label = None if folder == "." else os.path.basename(directory)
+        if label is not None and label_names and label.isdigit() and 1 <= int(label) <= len(label_names):
+            label = label_names[int(label) - 1]
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                path = os.path.join(directory, name)
+                yield {"id": os.path.relpath(path, root), "label": label, "source": path}
+
+def _iter_manifest(path, source_column):
+    """Reads a CSV or JSONL manifest; rows without an id are numbered by position."""
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = (json.loads(line) for line in f if line.strip()) if path.endswith(".jsonl") else csv.DictReader(f)
+        for position, row in enumerate(rows):
+            source = row.get(source_column)
+            if source is None:
+                continue
+            if source_column == "path" and not os.path.isabs(source):
+                source = os.path.join(os.path.dirname(path), source)
+            yield {"id": str(row.get("id") or row.get("path") or position), "label": row.get("label") or None, "source": source}
+
+def iter_items(modality, input_path):
+    if modality == "face":
+        from modules.face_emotion import emotion_labels
+        return _iter_tree(input_path, IMAGE_EXTENSIONS, emotion_labels)
+    if modality == "text":
+        return _iter_manifest(input_path, "text")
+    if os.path.isdir(input_path):
+        return _iter_tree(input_path, AUDIO_EXTENSIONS)
+    return _iter_manifest(input_path, "path")
+
+# --- Scorers: decode() runs on the thread pool, classify() on the main thread ---
+class FaceScorer:
+    def __init__(self, aligned=False):
+        # Dataset images such as RAF-DB "aligned" are already face crops; skip detection for them
+        from modules import face_emotion, rafdb
+        self.face_emotion = face_emotion
+        self.decode_crop = (lambda path: (rafdb.load_aligned_image(path), None)) if aligned else face_emotion.load_face_crop
+
+    def decode(self, source):
+        try:
+            return self.decode_crop(source)
+        except ValueError as e:
+            return None, str(e)
+
+    def classify(self, decoded, batch_size):
+        return self.face_emotion.classify_face_crops(decoded, batch_size)
+
+class TextScorer:
+    def __init__(self):
+        from modules import text_emotion
+        self.text_emotion = text_emotion
+
+    def decode(self, text):
+        return (text, None) if text.strip() else (None, "Empty text")
+
+    def classify(self, decoded, batch_size):
+        results = []
+        for scores in self.text_emotion.get_bert_emotion_probabilities(decoded, batch_size):
+            results.append({"emotion": max(scores, key=scores.get), "probabilities": scores})
+        return results
+
+class VoiceScorer:
+    def __init__(self):
+        from modules import voice_emotion
+        if voice_emotion.get_voice_model()[1] is None:
+            sys.exit("Voice model could not be loaded.")
+        self.voice_emotion = voice_emotion
+
+    def decode(self, source):
+        return self.voice_emotion.prepare_voice_clip(source)
+
+    def classify(self, decoded, batch_size):
+        return self.voice_emotion.classify_voice_clips(decoded)
+
+SCORERS = {"face": FaceScorer, "text": TextScorer, "voice": VoiceScorer}
+
+# --- Outputs: appended after every batch, and read back to resume and for the report ---
+class CsvOutput:
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, newline="", encoding="utf-8") as f:
+            # A row cut off by a crash is missing trailing columns; it is simply scored again
+            return [row for row in csv.DictReader(f) if row.get("probabilities") is not None]
+
+    def append(self, rows):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+class ParquetOutput:
+    """A directory of part files, one per flushed batch (Parquet files can't be appended to)."""
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow (pip install pyarrow); use a .csv output instead.")
+        self.pa, self.pq, self.path = pa, pq, path
+        os.makedirs(path, exist_ok=True)
+        self.parts = len([name for name in os.listdir(path) if name.endswith(".parquet")])
+
+    def read(self):
+        if not self.parts:
+            return []
+        return self.pq.read_table(self.path).to_pylist()
+
+    def append(self, rows):
+        table = self.pa.Table.from_pylist(rows, schema=self.pa.schema([
+            ("id", self.pa.string()), ("label", self.pa.string()), ("emotion", self.pa.string()),
+            ("confidence", self.pa.float64()), ("probabilities", self.pa.string()),
+        ]))
+        temporary = os.path.join(self.path, f".part-{self.parts:06d}.tmp")
+        self.pq.write_table(table, temporary)
+        # Rename is atomic, so a crash never leaves a half-written part behind
+        os.replace(temporary, os.path.join(self.path, f"part-{self.parts:06d}.parquet"))
+        self.parts += 1
+
+def open_output(path):
+    return ParquetOutput(path) if path.endswith(".parquet") else CsvOutput(path)
+
+# --- Pipeline ---
+def decode_ahead(items, decode, workers, queue_size):
+    """Yields (item, (decoded, error)) in input order, with at most queue_size decodes in flight."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for item in items:
+            in_flight.append((item, pool.submit(decode, item["source"])))
+            if len(in_flight) >= queue_size:
+                done, future = in_flight.popleft()
+                yield done, future.result()
+        while in_flight:
+            done, future = in_flight.popleft()
+            yield done, future.result()
+
+def _output_row(item, result):
+    probabilities = result["probabilities"]
+    return {
+        "id": item["id"],
+        "label": item["label"],
+        "emotion": result["emotion"],
+        "confidence": max(probabilities.values()) if probabilities else None,
+        "probabilities": json.dumps(probabilities) if probabilities else "",
+    }
+
+def score(modality, items, output, batch_size=32, workers=None, queue_size=256, aligned=False, progress_every=10):
+    """Scores items into output and returns throughput stats for this run."""
+    scorer = FaceScorer(aligned) if modality == "face" else SCORERS[modality]()
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    stats = {"scored": 0, "failed": 0, "batches": 0, "elapsed_s": 0.0, "items_per_s": 0.0}
+    started = time.perf_counter()
+    batch, rows = [], []
+
+    def flush():
+        if batch:
+            results = scorer.classify([decoded for _, decoded in batch], batch_size)
+            rows.extend(_output_row(item, result) for (item, _), result in zip(batch, results))
+            stats["batches"] += 1
+        if rows:
+            output.append(rows)
+        stats["scored"] += len(rows)
+        stats["elapsed_s"] = time.perf_counter() - started
+        stats["items_per_s"] = stats["scored"] / stats["elapsed_s"] if stats["elapsed_s"] else 0.0
+        if progress_every and stats["batches"] % progress_every == 0:
+            print(f"{stats['scored']} scored ({stats['failed']} failed), {stats['items_per_s']:.1f} items/s", file=sys.stderr)
+        batch.clear()
+        rows.clear()
+
+    for item, (decoded, error) in decode_ahead(items, scorer.decode, workers, queue_size):
+        if error:
+            # Failures are recorded too, so a resumed run doesn't retry them forever
+            stats["failed"] += 1
+            rows.append(_output_row(item, {"emotion": error, "probabilities": None}))
+        else:
+            batch.append((item, decoded))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return stats
+
+def confusion_matrix(rows):
+    """Returns (labels, predictions, matrix, accuracy) over the rows that carry a ground-truth label."""
+    labelled = [(row["label"], row["emotion"]) for row in rows if row.get("label")]
+    if not labelled:
+        return None
+    labels = sorted({label for label, _ in labelled})
+    predictions = labels + sorted({emotion for _, emotion in labelled} - set(labels))
+    counts = Counter(labelled)
+    matrix = [[counts[(label, emotion)] for emotion in predictions] for label in labels]
+    accuracy = sum(counts[(label, label)] for label in labels) / len(labelled)
+    return labels, predictions, matrix, accuracy
+
+def print_confusion_matrix(labels, predictions, matrix, accuracy):
+    width = max(len(name) for name in labels + predictions) + 2
+    print("\nrows = label, columns = prediction")
+    print("".ljust(width) + "".join(name[:width - 1].rjust(width) for name in predictions))
+    for label, counts in zip(labels, matrix):
+        print(label.ljust(width) + "".join(str(count).rjust(width) for count in counts))
+    print(f"\nAccuracy: {accuracy:.2%} over {sum(map(sum, matrix))} labelled items")
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a dataset of images, texts or audio clips in bulk.")
+    parser.add_argument("modality", choices=sorted(SCORERS))
+    parser.add_argument("input", help="Directory tree or manifest (see module header)")
+    parser.add_argument("-o", "--output", required=True, help="Output .csv file or .parquet directory")
+    parser.add_argument("--resume", action="store_true", help="Skip items already present in the output")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None, help="Decode threads (default: CPU count + 4)")
+    parser.add_argument("--queue-size", type=int, default=256, help="Maximum items decoded ahead of the model")
+    parser.add_argument("--aligned", action="store_true", help="Face images are already cropped faces (e.g. RAF-DB aligned)")
+    parser.add_argument("--report", help="Write throughput and confusion matrix as JSON to this path")
+    args = parser.parse_args()
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+    output = open_output(args.output)
+    existing = output.read()
+    if existing and not args.resume:
+        sys.exit(f"{args.output} already has {len(existing)} rows; pass --resume to continue or remove it.")
+
+    done = {row["id"] for row in existing}
+    items = (item for item in iter_items(args.modality, args.input) if item["id"] not in done)
+    if done:
+        print(f"Resuming: {len(done)} items already scored", file=sys.stderr)
+
+    stats = score(args.modality, items, output, batch_size=args.batch_size, workers=args.workers,
+                  queue_size=args.queue_size, aligned=args.aligned)
+    print(f"Scored {stats['scored']} items ({stats['failed']} failed to decode) in "
+          f"{stats['elapsed_s']:.1f}s: {stats['items_per_s']:.1f} items/s")
+
+    report = {"modality": args.modality, "input": args.input, "run": stats}
+    matrix = confusion_matrix(output.read())
+    if matrix:
+        labels, predictions, counts, accuracy = matrix
+        print_confusion_matrix(labels, predictions, counts, accuracy)
+        report.update({"labels": labels, "predictions": predictions, "confusion_matrix": counts, "accuracy": accuracy})
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
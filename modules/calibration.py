@@ -0,0 +1,177 @@
+# modules/calibration.py
+# Confidence calibration for the emotion models: a fitted temperature per modality and a
+# per-class "Uncertain" threshold, both produced by `python -m modules.evaluate ... --save`
+# and stored in models/calibration.json (CALIBRATION_PATH).
+#
+#   {"face": {"temperature": 1.42, "thresholds": {"Happy": 0.38, "Fear": 0.61, ...}, ...}, "text": {...}}
+#
+# The face, text and voice modules pass their probabilities through calibrate() and compare the
+# top probability with threshold(); without a saved calibration both are no-ops (temperature 1,
+# each module's previous default threshold).
+import json
+import logging
+import os
+import threading
+import numpy as np
+
+CALIBRATION_PATH = os.getenv("CALIBRATION_PATH", os.path.join(os.path.dirname(__file__), '..', 'models', 'calibration.json'))
+
+_calibration = None
+_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+def load_calibration(path=None):
+    """The saved calibration, read once per process; {} when none has been saved."""
+    global _calibration
+    with _lock:
+        if _calibration is None or path is not None:
+            path = path or CALIBRATION_PATH
+            try:
+                with open(path) as f:
+                    _calibration = json.load(f)
+            except FileNotFoundError:
+                _calibration = {}
+            except ValueError as e:
+                logger.warning("Ignoring unreadable calibration file %s: %s", path, e)
+                _calibration = {}
+    return _calibration
+
+def save_calibration(modality, entry, path=None):
+    """Replaces one modality's entry in the calibration file, keeping the others."""
+    global _calibration
+    path = path or CALIBRATION_PATH
+    try:
+        with open(path) as f:
+            calibration = json.load(f)
+    except (FileNotFoundError, ValueError):
+        calibration = {}
+    calibration[modality] = entry
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(temporary, path)
+    with _lock:
+        _calibration = calibration
+
+def apply_temperature(probabilities, temperature):
+    """softmax(log(p) / T) over the last axis; identical to dividing the logits by T."""
+    probabilities = np.asarray(probabilities)
+    scaled = np.log(np.clip(probabilities, 1e-12, 1.0)) / temperature
+    scaled = np.exp(scaled - scaled.max(axis=-1, keepdims=True))
+    return (scaled / scaled.sum(axis=-1, keepdims=True)).astype(probabilities.dtype, copy=False)
+
+def calibrate(modality, probabilities):
+    """Temperature-scales a modality's probability rows; returns them unchanged when uncalibrated."""
+    temperature = load_calibration().get(modality, {}).get("temperature", 1.0)
+    if temperature == 1.0:
+        return probabilities
+    return apply_temperature(probabilities, temperature)
+
+def version(modality):
+    """A string that changes whenever the modality's saved calibration does (for result cache keys)."""
+    return json.dumps(load_calibration().get(modality), sort_keys=True)
+
+def threshold(modality, label, default=0.0):
+    """Minimum calibrated top probability for `label` to be reported instead of "Uncertain"."""
+    return load_calibration().get(modality, {}).get("thresholds", {}).get(label, default)
+
+# --- Fitting and reporting, used by modules/evaluate.py ---
+def negative_log_likelihood(probabilities, labels):
+    return float(-np.log(np.clip(probabilities[np.arange(len(labels)), labels], 1e-12, 1.0)).mean())
+
+def fit_temperature(probabilities, labels, low=0.05, high=20.0, iterations=60):
+    """The temperature minimizing the negative log-likelihood (golden-section search over log T)."""
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = np.log(low), np.log(high)
+
+    def loss(log_t):
+        return negative_log_likelihood(apply_temperature(probabilities, np.exp(log_t)), labels)
+
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    loss_c, loss_d = loss(c), loss(d)
+    for _ in range(iterations):
+        if loss_c < loss_d:
+            b, d, loss_d = d, c, loss_c
+            c = b - ratio * (b - a)
+            loss_c = loss(c)
+        else:
+            a, c, loss_c = c, d, loss_d
+            d = a + ratio * (b - a)
+            loss_d = loss(d)
+    return float(np.exp((a + b) / 2))
+
+def reliability_curve(probabilities, labels, bins=10):
+    """Top-1 confidence vs accuracy in equal-width bins, and the expected calibration error."""
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == labels
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    curve, ece = [], 0.0
+    for lower, upper in zip(edges[:-1], edges[1:]):
+        in_bin = (confidence > lower) & (confidence <= upper)
+        count = int(in_bin.sum())
+        if not count:
+            continue
+        bin_confidence, bin_accuracy = float(confidence[in_bin].mean()), float(correct[in_bin].mean())
+        curve.append({"lower": float(lower), "upper": float(upper), "count": count,
+                      "confidence": bin_confidence, "accuracy": bin_accuracy})
+        ece += count / len(labels) * abs(bin_accuracy - bin_confidence)
+    return {"bins": curve, "ece": ece}
+
+def per_class_metrics(probabilities, labels, names):
+    """Precision, recall, F1 and support of the top-1 prediction for every class."""
+    predictions = probabilities.argmax(axis=1)
+    report = {}
+    for index, name in enumerate(names):
+        predicted, actual = predictions == index, labels == index
+        hits = int((predicted & actual).sum())
+        precision = hits / predicted.sum() if predicted.any() else 0.0
+        recall = hits / actual.sum() if actual.any() else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        report[name] = {"precision": float(precision), "recall": float(recall), "f1": float(f1), "support": int(actual.sum())}
+    return report
+
+def selective_accuracy(probabilities, labels, thresholds):
+    """(coverage, accuracy of the covered items) when the top class c is kept only if p >= thresholds[c]."""
+    predictions = probabilities.argmax(axis=1)
+    kept = probabilities.max(axis=1) >= np.asarray(thresholds)[predictions]
+    accuracy = float((predictions[kept] == labels[kept]).mean()) if kept.any() else 0.0
+    return float(kept.mean()), accuracy
+
+def coverage_curve(probabilities, labels, steps=20):
+    """Coverage and accuracy for one global threshold swept over [0, 1)."""
+    curve = []
+    for value in np.linspace(0.0, 1.0, steps, endpoint=False):
+        coverage, accuracy = selective_accuracy(probabilities, labels, np.full(probabilities.shape[1], value))
+        curve.append({"threshold": float(value), "coverage": coverage, "accuracy": accuracy})
+    return curve
+
+def recommend_thresholds(probabilities, labels, names, target_precision=0.8, min_support=10):
+    """
+    Per class, the lowest threshold at which predictions of that class are right at least
+    target_precision of the time. Classes that never get there use the threshold with the best
+    precision that still keeps min_support predictions; classes predicted fewer than min_support
+    times get no threshold (the module default applies).
+    """
+    predictions = probabilities.argmax(axis=1)
+    confidence = probabilities.max(axis=1)
+    grid = np.round(np.arange(0.0, 0.96, 0.01), 2)
+    thresholds = {}
+    for index, name in enumerate(names):
+        mask = predictions == index
+        if mask.sum() < min_support:
+            continue
+        class_confidence, class_correct = confidence[mask], labels[mask] == index
+        best = None
+        for value in grid:
+            kept = class_confidence >= value
+            if kept.sum() < min_support:
+                break
+            precision = class_correct[kept].mean()
+            if precision >= target_precision:
+                best = (precision, value)
+                break
+            if best is None or precision > best[0]:
+                best = (precision, value)
+        thresholds[name] = float(best[1])
+    return thresholds
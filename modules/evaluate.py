@@ -0,0 +1,287 @@
+# modules/evaluate.py
+# Measures how accurate and how well calibrated each emotion model is on a labelled set, fits a
+# temperature, and recommends per-class "Uncertain" thresholds (see modules/calibration.py).
+#
+#   python -m modules.evaluate face data/RAF-DB/test --workers 4
+#   python -m modules.evaluate text labelled_texts.csv --save
+#   python -m modules.evaluate voice recordings/ --report evaluation/voice.json --save
+#
+# Inputs are read like modules/bulk_score.py (face: RAF-DB-style folder tree of aligned faces;
+# text: CSV/JSONL with "text" and "label"; voice: folder tree or CSV with "path" and "label").
+# Labels may use the model's own names or the playlist names (e.g. "Fear" or "Fearful", "joy").
+#
+# The raw model probabilities are computed by --workers processes, each running batched
+# inference on its own shard with its share of the CPU threads. Face images come from the
+# preprocessed store when one is built (python -m modules.rafdb_store build ...), which the
+# workers share through the page cache. Temperature and thresholds are fitted on one part of
+# the data and the calibrated metrics are reported on the held-out rest (--holdout).
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+from modules import bulk_score, calibration
+
+DEFAULT_THRESHOLDS = {"face": 0.4, "text": 0.0, "voice": 0.0}  # the modules' thresholds without calibration
+
+# --- Raw model probabilities (no calibration applied), computed in worker processes ---
+def _init_worker(threads):
+    # Set before the model libraries are imported in this process, so they size their pools from it
+    for name in ("OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "FACE_MODEL_THREADS", "ONNX_INTRA_OP_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+def model_labels(modality):
+    """The model's class names, in the order of its probability columns."""
+    if modality == "face":
+        from modules.face_emotion import emotion_labels
+        return list(emotion_labels)
+    if modality == "voice":
+        from modules.voice_emotion import EMOTION_LABELS
+        return list(EMOTION_LABELS)
+    # Only the config is needed for the label order; the workers load the model itself
+    from transformers import AutoConfig
+    from modules.text_emotion import EMOTION_MAP, TEXT_MODEL_NAME
+    id2label = AutoConfig.from_pretrained(TEXT_MODEL_NAME).id2label
+    return [EMOTION_MAP.get(id2label[i], id2label[i]) for i in range(len(id2label))]
+
+def _load_aligned(path):
+    """(aligned RGB crop, None), or (None, error) for an unreadable file, like load_face_crop."""
+    from modules import rafdb
+    try:
+        return rafdb.load_aligned_image(path), None
+    except ValueError as e:
+        return None, str(e)
+
+def _face_probabilities(sources, rows, batch_size, aligned, store_dir):
+    from modules import face_emotion
+    from modules.rafdb_store import RafdbStore
+    model = face_emotion.get_face_model()
+    store = RafdbStore(store_dir) if store_dir else None
+    # An unreadable file leaves its row NaN, so it is counted and left out instead of ending the run
+    load = _load_aligned if aligned else face_emotion.load_face_crop
+    probabilities = np.full((len(sources), len(face_emotion.emotion_labels)), np.nan, dtype=np.float32)
+
+    with ThreadPoolExecutor() as pool:
+        for start in range(0, len(sources), batch_size):
+            if store is not None:
+                probabilities[start:start + batch_size] = model.predict(store.batch(rows[start:start + batch_size]))
+                continue
+            crops = list(pool.map(load, sources[start:start + batch_size]))
+            ok = [offset for offset, (crop, error) in enumerate(crops) if error is None]
+            if ok:
+                batch = np.stack([crops[offset][0] for offset in ok]).astype(np.float32) / 255.0
+                probabilities[[start + offset for offset in ok]] = model.predict(batch)
+    return probabilities
+
+def _text_probabilities(sources, batch_size):
+    from modules import text_emotion
+    return text_emotion._bert_probabilities(list(sources), batch_size)
+
+def _voice_probabilities(sources, batch_size):
+    from modules import voice_emotion
+    probabilities = np.full((len(sources), len(voice_emotion.EMOTION_LABELS)), np.nan, dtype=np.float32)
+    for start in range(0, len(sources), batch_size):
+        clips = [voice_emotion.prepare_voice_clip(source) for source in sources[start:start + batch_size]]
+        ok = [offset for offset, (wave, error) in enumerate(clips) if error is None]
+        if ok:
+            logits = voice_emotion._classify_waveforms([clips[offset][0] for offset in ok])
+            probabilities[[start + offset for offset in ok]] = voice_emotion._softmax(logits)
+    return probabilities
+
+def _score_shard(modality, sources, rows, batch_size, aligned, store_dir):
+    """Raw probabilities for one shard; rows that failed to decode are NaN."""
+    if modality == "face":
+        return _face_probabilities(sources, rows, batch_size, aligned, store_dir)
+    if modality == "text":
+        return _text_probabilities(sources, batch_size)
+    return _voice_probabilities(sources, batch_size)
+
+def raw_probabilities(modality, items, workers=1, batch_size=32, aligned=False, store_dir=None):
+    """(N, C) raw probabilities for the items, scored by `workers` processes in contiguous shards."""
+    sources = [item["source"] for item in items]
+    rows = [item.get("row") for item in items]
+    if workers <= 1:
+        return _score_shard(modality, sources, rows, batch_size, aligned, store_dir)
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    bounds = np.linspace(0, len(items), workers + 1).astype(int)
+    # spawn: every worker starts clean instead of inheriting a forked TensorFlow/PyTorch runtime
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(threads,)) as pool:
+        futures = [pool.submit(_score_shard, modality, sources[lo:hi], rows[lo:hi], batch_size, aligned, store_dir)
+                   for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        return np.concatenate([future.result() for future in futures])
+
+# --- Inputs ---
+def _label_index(modality, names):
+    """Accepts the model's label names, their playlist spellings and, for text, the model's raw labels."""
+    from modules.fusion import to_unified
+    index = {}
+    for position, name in enumerate(names):
+        index[name.lower()] = index[to_unified(name).lower()] = position
+    if modality == "text":
+        from modules.text_emotion import EMOTION_MAP
+        for raw, name in EMOTION_MAP.items():
+            if name.lower() in index:
+                index.setdefault(raw, index[name.lower()])
+    return index
+
+def load_items(modality, input_path, names, limit=None, seed=0):
+    """Labelled items with "target" (column index); unlabelled or unknown labels are counted and skipped."""
+    index = _label_index(modality, names)
+    items, skipped = [], 0
+    for item in bulk_score.iter_items(modality, input_path):
+        target = index.get((item["label"] or "").lower())
+        if target is None:
+            skipped += 1
+            continue
+        item["target"] = target
+        items.append(item)
+    if limit and limit < len(items):
+        # Sample, then restore file order so store reads stay sequential
+        items = sorted(random.Random(seed).sample(items, limit), key=lambda item: item["source"])
+    return items, skipped
+
+def attach_store_rows(items, input_path):
+    """Adds each image's row in the preprocessed store; returns the store dir, or None if any is missing."""
+    from modules.rafdb_store import open_store
+    store = open_store(input_path)
+    if store is None:
+        return None
+    row_of = {os.path.abspath(path): row for row, path in enumerate(store.paths)}
+    rows = [row_of.get(os.path.abspath(item["source"])) for item in items]
+    if any(row is None for row in rows):
+        return None
+    for item, row in zip(items, rows):
+        item["row"] = row
+    return store.store_dir
+
+# --- Report ---
+def evaluate(probabilities, targets, names, modality, holdout=0.3, target_precision=0.8, min_support=10, seed=0):
+    """Fits temperature and thresholds on part of the data and reports raw and calibrated metrics."""
+    order = np.random.default_rng(seed).permutation(len(targets))
+    cut = int(len(order) * (1 - holdout)) if 0 < holdout < 1 else len(order)
+    fit, test = order[:cut], (order[cut:] if cut < len(order) else order)
+
+    temperature = calibration.fit_temperature(probabilities[fit], targets[fit])
+    calibrated = calibration.apply_temperature(probabilities, temperature)
+    thresholds = calibration.recommend_thresholds(calibrated[fit], targets[fit], names, target_precision, min_support)
+    default = DEFAULT_THRESHOLDS[modality]
+    per_class = [thresholds.get(name, default) for name in names]
+
+    raw_test, calibrated_test, targets_test = probabilities[test], calibrated[test], targets[test]
+    coverage, accuracy = calibration.selective_accuracy(calibrated_test, targets_test, per_class)
+    current_coverage, current_accuracy = calibration.selective_accuracy(raw_test, targets_test, [default] * len(names))
+    return {
+        "items": int(len(targets)),
+        "fit_items": int(len(fit)),
+        "test_items": int(len(test)),
+        "accuracy": float((probabilities.argmax(axis=1) == targets).mean()),
+        "per_class": calibration.per_class_metrics(probabilities, targets, names),
+        "temperature": temperature,
+        "nll": {"raw": calibration.negative_log_likelihood(raw_test, targets_test),
+                "calibrated": calibration.negative_log_likelihood(calibrated_test, targets_test)},
+        "reliability": {"raw": calibration.reliability_curve(raw_test, targets_test),
+                        "calibrated": calibration.reliability_curve(calibrated_test, targets_test)},
+        "coverage_curve": calibration.coverage_curve(calibrated_test, targets_test),
+        "thresholds": thresholds,
+        "target_precision": target_precision,
+        "selective": {"current": {"threshold": default, "coverage": current_coverage, "accuracy": current_accuracy},
+                      "recommended": {"coverage": coverage, "accuracy": accuracy}},
+    }
+
+def print_report(report, names):
+    print(f"\n{'class':>10} {'precision':>10} {'recall':>8} {'f1':>6} {'support':>8} {'threshold':>10}")
+    for name in names:
+        row = report["per_class"][name]
+        threshold = report["thresholds"].get(name)
+        print(f"{name:>10} {row['precision']:>10.3f} {row['recall']:>8.3f} {row['f1']:>6.3f} {row['support']:>8} "
+              f"{'-' if threshold is None else f'{threshold:.2f}':>10}")
+    print(f"\nAccuracy: {report['accuracy']:.2%} over {report['items']} items")
+    print(f"Temperature: {report['temperature']:.3f} (fitted on {report['fit_items']}, reported on {report['test_items']})")
+    raw, calibrated = report["reliability"]["raw"], report["reliability"]["calibrated"]
+    print(f"ECE: {raw['ece']:.4f} raw -> {calibrated['ece']:.4f} calibrated; "
+          f"NLL: {report['nll']['raw']:.4f} -> {report['nll']['calibrated']:.4f}")
+
+    print(f"\n{'confidence':>12} {'count':>6} {'raw acc':>8} {'cal count':>10} {'cal acc':>8}")
+    calibrated_bins = {b["lower"]: b for b in calibrated["bins"]}
+    raw_bins = {b["lower"]: b for b in raw["bins"]}
+    for lower in sorted(set(raw_bins) | set(calibrated_bins)):
+        r, c = raw_bins.get(lower), calibrated_bins.get(lower)
+        print(f"{lower:>5.1f}-{lower + 0.1:<5.1f} {r['count'] if r else 0:>7} {r['accuracy'] if r else 0:>8.3f} "
+              f"{c['count'] if c else 0:>10} {c['accuracy'] if c else 0:>8.3f}")
+
+    current, recommended = report["selective"]["current"], report["selective"]["recommended"]
+    print(f"\nCurrent threshold {current['threshold']:.2f}: coverage {current['coverage']:.1%}, accuracy {current['accuracy']:.1%}")
+    print(f"Recommended thresholds: coverage {recommended['coverage']:.1%}, accuracy {recommended['accuracy']:.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate an emotion model and calibrate its confidence thresholds.")
+    parser.add_argument("modality", choices=["face", "text", "voice"])
+    parser.add_argument("input", help="Labelled directory tree or manifest (see module header)")
+    parser.add_argument("--workers", type=int, default=1, help="Inference processes, each loading its own model copy")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--detect", action="store_true", help="Face: detect and crop faces instead of using aligned images")
+    parser.add_argument("--limit", type=int, help="Evaluate a random sample of this many items")
+    parser.add_argument("--holdout", type=float, default=0.3, help="Fraction held out from fitting for the calibrated metrics")
+    parser.add_argument("--target-precision", type=float, default=0.8,
+                        help="Precision each class's threshold should reach on the fitting part")
+    parser.add_argument("--min-support", type=int, default=10)
+    parser.add_argument("--report", help="Write the full report (per-class metrics, reliability curves) as JSON here")
+    parser.add_argument("--save", action="store_true", help=f"Store temperature and thresholds in {calibration.CALIBRATION_PATH}")
+    args = parser.parse_args()
+
+    names = model_labels(args.modality)
+    items, skipped = load_items(args.modality, args.input, names, args.limit)
+    if not items:
+        sys.exit(f"No labelled items found in {args.input} ({skipped} without a usable label).")
+    if skipped:
+        print(f"Skipping {skipped} items without a usable label", file=sys.stderr)
+
+    store_dir = attach_store_rows(items, args.input) if args.modality == "face" and not args.detect else None
+    started = time.perf_counter()
+    probabilities = raw_probabilities(args.modality, items, args.workers, args.batch_size,
+                                      aligned=not args.detect, store_dir=store_dir)
+    elapsed = time.perf_counter() - started
+    print(f"Scored {len(items)} items in {elapsed:.1f}s ({len(items) / elapsed:.1f} items/s, "
+          f"{args.workers} worker(s){', from the preprocessed store' if store_dir else ''})")
+
+    targets = np.array([item["target"] for item in items])
+    scored = ~np.isnan(probabilities).any(axis=1)
+    if not scored.all():
+        print(f"{int((~scored).sum())} items could not be decoded (unreadable, no face, silent audio) and are left out", file=sys.stderr)
+    report = evaluate(probabilities[scored], targets[scored], names, args.modality, args.holdout,
+                      args.target_precision, args.min_support)
+    report.update({"modality": args.modality, "input": args.input, "failed": int((~scored).sum()), "elapsed_s": elapsed})
+    print_report(report, names)
+
+    if args.report:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save:
+        calibration.save_calibration(args.modality, {
+            "temperature": report["temperature"],
+            "thresholds": report["thresholds"],
+            "target_precision": args.target_precision,
+            "evaluated_on": args.input,
+            "items": report["items"],
+            "accuracy": report["accuracy"],
+        })
+        print(f"\nSaved {args.modality} calibration to {calibration.CALIBRATION_PATH}")
+    else:
+        print("\nRun again with --save to use these thresholds in the app.")
+
+if __name__ == "__main__":
+    main()
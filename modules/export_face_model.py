@@ -0,0 +1,171 @@
+# modules/export_face_model.py
+# Converts the Keras face model to a quantized TFLite or ONNX file and checks it against the original.
+#
+#   python -m modules.export_face_model --format tflite --quantize int8
+#   python -m modules.export_face_model --format onnx --quantize int8 --check
+#
+# Then run the app with FACE_MODEL_BACKEND=tflite (or onnx) to serve the exported file.
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+from modules import rafdb, rafdb_store
+from modules.face_backends import DEFAULT_MODEL_FILES, MODELS_DIR, KerasFaceModel, load_face_model
+
+def load_calibration_set(calibration_dir, num_samples, seed=0):
+    """
+    Draws a class-stratified random sample of training images for post-training quantization,
+    read from the preprocessed store when one is built for calibration_dir.
+    """
+    items = rafdb.list_images(calibration_dir)
+    by_label = {}
+    for row, (_, label) in enumerate(items):
+        by_label.setdefault(label, []).append(row)
+
+    rng = random.Random(seed)
+    per_class = max(1, num_samples // max(1, len(by_label)))
+    rows = []
+    for label_rows in by_label.values():
+        rows.extend(rng.sample(label_rows, min(per_class, len(label_rows))))
+
+    store = rafdb_store.open_store(calibration_dir)
+    if store is not None:
+        return store.batch(rows)
+    return rafdb.load_batch([items[row][0] for row in rows])
+
+def export_tflite(keras_model, output_path, quantize, calibration):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantize == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([sample[None]] for sample in calibration)
+        # Integer kernels everywhere, but keep float input/output so callers don't change
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+
+def export_onnx(keras_model, output_path, quantize, calibration):
+    import tensorflow as tf
+    try:
+        import tf2onnx
+    except ImportError:
+        raise SystemExit("ONNX export needs tf2onnx: pip install tf2onnx")
+
+    spec = [tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input")]
+    float_path = output_path if quantize == "none" else output_path + ".fp32.onnx"
+    tf2onnx.convert.from_keras(keras_model, input_signature=spec, opset=17, output_path=float_path)
+
+    if quantize == "int8":
+        from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+        class _CalibrationReader(CalibrationDataReader):
+            def __init__(self):
+                self._samples = iter(calibration)
+
+            def get_next(self):
+                sample = next(self._samples, None)
+                return None if sample is None else {"input": sample[None]}
+
+        quantize_static(float_path, output_path, _CalibrationReader(), quant_format=QuantFormat.QDQ,
+                        per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    elif quantize == "float16":
+        import onnx
+        try:
+            from onnxconverter_common import float16
+        except ImportError:
+            raise SystemExit("float16 ONNX export needs onnxconverter-common: pip install onnxconverter-common")
+        fp16_model = float16.convert_float_to_float16(onnx.load(float_path), keep_io_types=True)
+        onnx.save(fp16_model, output_path)
+
+    if float_path != output_path:
+        os.remove(float_path)
+
+def check_parity(reference, candidate, test_dir, batch_size=32):
+    """Scores the test split with both models and prints accuracy, top-1 agreement and latency."""
+    items = rafdb.list_images(test_dir)
+    labels = np.array([label for _, label in items])
+    store = rafdb_store.open_store(test_dir)
+    ref_preds, cand_preds = [], []
+    ref_time = cand_time = 0.0
+
+    for start in range(0, len(items), batch_size):
+        if store is not None:
+            batch = store.batch(slice(start, start + batch_size))
+        else:
+            batch = rafdb.load_batch([path for path, _ in items[start:start + batch_size]])
+
+        t0 = time.perf_counter()
+        ref_preds.append(reference.predict(batch))
+        t1 = time.perf_counter()
+        cand_preds.append(candidate.predict(batch))
+        t2 = time.perf_counter()
+        ref_time += t1 - t0
+        cand_time += t2 - t1
+
+    ref_probs = np.concatenate(ref_preds)
+    cand_probs = np.concatenate(cand_preds)
+    ref_top, cand_top = ref_probs.argmax(axis=1), cand_probs.argmax(axis=1)
+
+    report = {
+        "images": len(items),
+        "keras_accuracy": float((ref_top == labels).mean()),
+        "exported_accuracy": float((cand_top == labels).mean()),
+        "top1_agreement": float((ref_top == cand_top).mean()),
+        "max_abs_prob_diff": float(np.abs(ref_probs - cand_probs).max()),
+        "keras_ms_per_image": 1000 * ref_time / len(items),
+        "exported_ms_per_image": 1000 * cand_time / len(items),
+    }
+    for key, value in report.items():
+        print(f"{key:>22}: {value:.4f}" if isinstance(value, float) else f"{key:>22}: {value}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the face emotion model to a quantized TFLite/ONNX file.")
+    parser.add_argument("--format", choices=["tflite", "onnx"], default="tflite")
+    parser.add_argument("--quantize", choices=["int8", "float16", "none"], default="int8")
+    parser.add_argument("--keras-model", default=os.path.join(MODELS_DIR, DEFAULT_MODEL_FILES["keras"]))
+    parser.add_argument("--output", help="Defaults to the path the runtime backend loads from models/")
+    parser.add_argument("--calibration-dir", default="data/RAF-DB/train")
+    parser.add_argument("--calibration-samples", type=int, default=300)
+    parser.add_argument("--check", action="store_true", help="Compare against the Keras model on the test split")
+    parser.add_argument("--min-agreement", type=float, default=0.95,
+                        help="With --check, exit with an error if top-1 agreement falls below this")
+    parser.add_argument("--test-dir", default="data/RAF-DB/test")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(MODELS_DIR, DEFAULT_MODEL_FILES[args.format])
+    if args.quantize != "int8" and not args.output:
+        # Non-default variants are served by pointing FACE_MODEL_PATH at them
+        output_path = output_path.replace("_int8", "_float16" if args.quantize == "float16" else "_fp32")
+
+    reference = KerasFaceModel(args.keras_model)
+    calibration = None
+    if args.quantize == "int8":
+        print(f"Loading {args.calibration_samples} calibration images from {args.calibration_dir}...")
+        calibration = load_calibration_set(args.calibration_dir, args.calibration_samples)
+
+    print(f"Exporting {args.format} ({args.quantize}) to {output_path}...")
+    if args.format == "tflite":
+        export_tflite(reference.model, output_path, args.quantize, calibration)
+    else:
+        export_onnx(reference.model, output_path, args.quantize, calibration)
+
+    source_mb = os.path.getsize(args.keras_model) / 1024 / 1024
+    output_mb = os.path.getsize(output_path) / 1024 / 1024
+    print(f"Model size: {source_mb:.1f} MB -> {output_mb:.1f} MB")
+
+    if args.check:
+        report = check_parity(reference, load_face_model(args.format, output_path), args.test_dir)
+        if report["top1_agreement"] < args.min_agreement:
+            sys.exit(f"Parity check failed: top-1 agreement {report['top1_agreement']:.3f} < {args.min_agreement}")
+
+if __name__ == "__main__":
+    main()
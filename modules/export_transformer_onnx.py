@@ -0,0 +1,147 @@
+# modules/export_transformer_onnx.py
+# Exports the text (DistilRoBERTa) and voice (wav2vec2) emotion models to ONNX with dynamic
+# int8 quantization, and checks the result against the PyTorch model on a fixed sample set.
+# The parity check runs after every export and fails it (exit status 1) when top-1 agreement
+# drops below --min-agreement, so a broken export can't be shipped silently.
+#
+#   python -m modules.export_transformer_onnx text
+#   python -m modules.export_transformer_onnx voice
+#
+# Then run the app with TEXT_MODEL_BACKEND=onnx / VOICE_MODEL_BACKEND=onnx.
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+
+from modules.onnx_runtime import ONNX_MODEL_FILES, MODELS_DIR, OnnxModelForClassification
+
+# Same checkpoints as modules/text_emotion.py and modules/voice_emotion.py
+MODEL_NAMES = {
+    "text": "j-hartmann/emotion-english-distilroberta-base",
+    "voice": "ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition",
+}
+
+PARITY_TEXTS = [
+    "I had a wonderful day and I'm feeling on top of the world!",
+    "Nothing went right today and I just want to be alone.",
+    "How dare they cancel the meeting again without telling anyone.",
+    "I keep hearing noises downstairs and I can't sleep.",
+    "Wait, they actually gave me the job?",
+    "The leftovers in the fridge smelled absolutely revolting.",
+    "I went to the store and bought some bread.",
+    "ok",
+]
+
+def parity_audio(sample_rate=16000, seed=0):
+    """Deterministic synthetic clips of different lengths: voiced-like tones mixed with noise."""
+    rng = np.random.default_rng(seed)
+    clips = []
+    for seconds, pitch in [(1.0, 120), (2.5, 220), (4.0, 180), (6.0, 300)]:
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        tone = 0.3 * np.sin(2 * np.pi * pitch * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t))
+        clips.append((tone + 0.02 * rng.standard_normal(t.size)).astype(np.float32))
+    return clips
+
+def load_reference(kind):
+    from transformers import (AutoFeatureExtractor, AutoModelForAudioClassification,
+                              AutoModelForSequenceClassification, AutoTokenizer)
+    name = MODEL_NAMES[kind]
+    if kind == "text":
+        return AutoTokenizer.from_pretrained(name), AutoModelForSequenceClassification.from_pretrained(name).eval()
+    return (AutoFeatureExtractor.from_pretrained(name, trust_remote_code=True),
+            AutoModelForAudioClassification.from_pretrained(name, trust_remote_code=True).eval())
+
+def sample_inputs(kind, preprocessor, index=None):
+    """Preprocessed parity inputs (all of them as one padded batch, or just sample `index`)."""
+    if kind == "text":
+        texts = PARITY_TEXTS if index is None else [PARITY_TEXTS[index]]
+        return preprocessor(texts, padding=True, truncation=True, return_tensors="pt")
+    clips = parity_audio() if index is None else [parity_audio()[index]]
+    return preprocessor(clips, sampling_rate=16000, padding=True, return_tensors="pt")
+
+class _LogitsOnly(torch.nn.Module):
+    """Positional-argument wrapper so torch.onnx.export sees a plain tensor-in, logits-out graph."""
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *args):
+        return self.model(**dict(zip(self.input_names, args))).logits
+
+def export(kind, preprocessor, model, output_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    sample = sample_inputs(kind, preprocessor)
+    input_names = list(sample.keys())
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    float_path = output_path + ".fp32.onnx"
+    with torch.no_grad():
+        torch.onnx.export(_LogitsOnly(model, input_names), tuple(sample[name] for name in input_names), float_path,
+                          input_names=input_names, output_names=["logits"], dynamic_axes=dynamic_axes,
+                          opset_version=17, do_constant_folding=True)
+
+    # Only the matmul-heavy transformer layers are quantized; int8 convolutions are slower than fp32 on most CPUs
+    quantize_dynamic(float_path, output_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+    os.remove(float_path)
+
+def check_parity(kind, preprocessor, reference, candidate):
+    """Compares softmax outputs sample by sample and prints agreement, max difference and latency."""
+    num_samples = len(PARITY_TEXTS) if kind == "text" else len(parity_audio())
+    ref_probs, cand_probs = [], []
+    ref_time = cand_time = 0.0
+
+    for index in range(num_samples):
+        inputs = sample_inputs(kind, preprocessor, index)
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            ref_probs.append(torch.softmax(reference(**inputs).logits, dim=-1).numpy()[0])
+        t1 = time.perf_counter()
+        # The ONNX wrapper returns numpy logits
+        cand_logits = candidate(**inputs).logits[0]
+        cand_exp = np.exp(cand_logits - cand_logits.max())
+        cand_probs.append(cand_exp / cand_exp.sum())
+        t2 = time.perf_counter()
+        ref_time += t1 - t0
+        cand_time += t2 - t1
+
+    ref_probs, cand_probs = np.array(ref_probs), np.array(cand_probs)
+    report = {
+        "samples": num_samples,
+        "top1_agreement": float((ref_probs.argmax(axis=1) == cand_probs.argmax(axis=1)).mean()),
+        "max_abs_prob_diff": float(np.abs(ref_probs - cand_probs).max()),
+        "torch_ms_per_sample": 1000 * ref_time / num_samples,
+        "onnx_ms_per_sample": 1000 * cand_time / num_samples,
+    }
+    for key, value in report.items():
+        print(f"{key:>20}: {value:.4f}" if isinstance(value, float) else f"{key:>20}: {value}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the text or voice emotion model to int8 ONNX.")
+    parser.add_argument("kind", choices=list(MODEL_NAMES))
+    parser.add_argument("--output", help="Defaults to the path the ONNX backend loads from models/")
+    parser.add_argument("--no-check", action="store_true", help="Skip the parity check against PyTorch")
+    parser.add_argument("--min-agreement", type=float, default=0.875,
+                        help="Exit with an error if top-1 agreement falls below this")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(MODELS_DIR, ONNX_MODEL_FILES[args.kind])
+    preprocessor, reference = load_reference(args.kind)
+
+    print(f"Exporting {MODEL_NAMES[args.kind]} to {output_path}...")
+    export(args.kind, preprocessor, reference, output_path)
+    print(f"ONNX int8 size: {os.path.getsize(output_path) / 1024 / 1024:.1f} MB")
+
+    if not args.no_check:
+        candidate = OnnxModelForClassification(output_path, reference.config)
+        report = check_parity(args.kind, preprocessor, reference, candidate)
+        if report["top1_agreement"] < args.min_agreement:
+            sys.exit(f"Parity check failed: top-1 agreement {report['top1_agreement']:.3f} < {args.min_agreement}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# modules/face_backends.py
+# Interchangeable runtimes for the face emotion model. The quantized files are
+# produced by `python -m modules.export_face_model`.
+import os
+import threading
+import numpy as np
+from modules import metrics
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), '..', 'models')
+DEFAULT_MODEL_FILES = {
+    "keras": "face_emotion_resnet50.h5",
+    "tflite": "face_emotion_resnet50_int8.tflite",
+    "onnx": "face_emotion_resnet50_int8.onnx",
+}
+FACE_MODEL_THREADS = int(os.getenv("FACE_MODEL_THREADS", "0")) or None
+
+class KerasFaceModel:
+    """Full-precision Keras model. Imports TensorFlow only when this backend is used."""
+    def __init__(self, path):
+        from tensorflow.keras.models import load_model
+        self.model = load_model(path)
+
+    @metrics.timed("face_model_predict", backend="keras")
+    def predict(self, batch):
+        # predict_on_batch skips the per-call dataset/callback setup that model.predict does
+        return np.asarray(self.model.predict_on_batch(batch))
+
+class TFLiteFaceModel:
+    """TFLite interpreter; uses tflite_runtime when installed so TensorFlow is never imported."""
+    def __init__(self, path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # A single interpreter owns its tensors, so calls have to be serialized
+        self._lock = threading.Lock()
+
+    @metrics.timed("face_model_predict", backend="tflite")
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        count = len(batch)
+        with self._lock:
+            if self._batch_size is None or count > self._batch_size:
+                self.interpreter.resize_tensor_input(self.input_details["index"], batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = count
+            elif count < self._batch_size:
+                # Reallocating the interpreter costs more than a few padded rows, so smaller batches reuse it
+                padded = np.zeros((self._batch_size,) + batch.shape[1:], dtype=np.float32)
+                padded[:count] = batch
+                batch = padded
+
+            scale, zero_point = self.input_details["quantization"]
+            if scale:  # Fully integer model: quantize the input ourselves
+                batch = np.round(batch / scale + zero_point).astype(self.input_details["dtype"])
+            self.interpreter.set_tensor(self.input_details["index"], batch)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output_details["index"])[:count]
+
+        scale, zero_point = self.output_details["quantization"]
+        if scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+class OnnxFaceModel:
+    """ONNX Runtime session on CPU."""
+    def __init__(self, path, num_threads=None):
+        from modules.onnx_runtime import create_session
+        self.session = create_session(path, num_threads)
+        self.input_name = self.session.get_inputs()[0].name
+
+    @metrics.timed("face_model_predict", backend="onnx")
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+def model_path(backend="keras"):
+    """The model file a backend loads: FACE_MODEL_PATH, or the default file in models/."""
+    return os.getenv("FACE_MODEL_PATH") or os.path.join(MODELS_DIR, DEFAULT_MODEL_FILES[backend])
+
+def load_face_model(backend="keras", path=None):
+    """Builds the face model for the given backend. Every backend exposes predict(batch) -> probabilities."""
+    if backend not in DEFAULT_MODEL_FILES:
+        raise ValueError(f"Unknown face model backend '{backend}'. Choose from {list(DEFAULT_MODEL_FILES)}.")
+    path = path or model_path(backend)
+    if backend == "keras":
+        return KerasFaceModel(path)
+    if backend == "tflite":
+        return TFLiteFaceModel(path, FACE_MODEL_THREADS)
+    return OnnxFaceModel(path, FACE_MODEL_THREADS)
@@ -0,0 +1,130 @@
+# modules/face_detectors.py
+# Interchangeable face detectors. Both run on a downscaled copy of the image (detection cost grows
+# with pixel count, and a multi-megapixel phone photo doesn't need full resolution to find a face);
+# the boxes are mapped back to the original so the emotion crop keeps its full detail.
+#
+#   FACE_DETECTOR=haar   Haar cascade bundled with OpenCV (default, no extra files)
+#   FACE_DETECTOR=dnn    OpenCV's res10 SSD face detector; faster on large images and better with
+#                        rotated or partly occluded faces. Needs the model files in models/face_detector/:
+#                        deploy.prototxt and res10_300x300_ssd_iter_140000.caffemodel (from the OpenCV samples)
+#
+# Tuning per deployment:
+#   FACE_DETECT_MAX_SIDE      longest side of the copy detection runs on (default 640, 0 = full resolution)
+#   FACE_HAAR_SCALE_FACTOR, FACE_HAAR_MIN_NEIGHBORS, FACE_HAAR_MIN_SIZE
+#   FACE_DNN_CONFIDENCE, FACE_DNN_MODEL, FACE_DNN_CONFIG
+import json
+import os
+import threading
+import cv2
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), '..', 'models', 'face_detector')
+FACE_DETECTOR = os.getenv("FACE_DETECTOR", "haar").lower()
+FACE_DETECT_MAX_SIDE = int(os.getenv("FACE_DETECT_MAX_SIDE", "640"))
+
+FACE_HAAR_SCALE_FACTOR = float(os.getenv("FACE_HAAR_SCALE_FACTOR", "1.1"))
+FACE_HAAR_MIN_NEIGHBORS = int(os.getenv("FACE_HAAR_MIN_NEIGHBORS", "5"))
+FACE_HAAR_MIN_SIZE = int(os.getenv("FACE_HAAR_MIN_SIZE", "30"))  # pixels in the original image
+HAAR_MIN_SIZE_FLOOR = 24  # the frontal cascade's own window; nothing smaller can be detected
+
+FACE_DNN_CONFIDENCE = float(os.getenv("FACE_DNN_CONFIDENCE", "0.6"))
+FACE_DNN_MODEL = os.getenv("FACE_DNN_MODEL", os.path.join(MODELS_DIR, "res10_300x300_ssd_iter_140000.caffemodel"))
+FACE_DNN_CONFIG = os.getenv("FACE_DNN_CONFIG", os.path.join(MODELS_DIR, "deploy.prototxt"))
+DNN_INPUT_SIZE = 300
+DNN_MEAN = (104.0, 177.0, 123.0)  # BGR means the res10 model was trained with
+
+def downscale(image, max_side):
+    """Returns (copy with its longest side at most max_side, scale factor applied)."""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width) if max_side else 1.0
+    if scale >= 1.0:
+        return image, 1.0
+    # INTER_AREA averages pixels instead of skipping them, so small faces survive the resize
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA), scale
+
+def _to_original(boxes, scale, shape):
+    """Maps (x, y, w, h) boxes found on the downscaled copy back to the original image, clipped to it."""
+    height, width = shape[:2]
+    mapped = []
+    for x, y, w, h in boxes:
+        x0, y0 = max(0, int(x / scale)), max(0, int(y / scale))
+        x1, y1 = min(width, int(round((x + w) / scale))), min(height, int(round((y + h) / scale)))
+        if x1 > x0 and y1 > y0:
+            mapped.append((x0, y0, x1 - x0, y1 - y0))
+    return mapped
+
+class HaarFaceDetector:
+    def __init__(self, max_side=FACE_DETECT_MAX_SIDE, scale_factor=FACE_HAAR_SCALE_FACTOR,
+                 min_neighbors=FACE_HAAR_MIN_NEIGHBORS, min_size=FACE_HAAR_MIN_SIZE):
+        self.path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        self.max_side, self.scale_factor = max_side, scale_factor
+        self.min_neighbors, self.min_size = min_neighbors, min_size
+        # CascadeClassifier is not safe to share between threads, so each thread gets its own copy
+        self._local = threading.local()
+
+    def _cascade(self):
+        cascade = getattr(self._local, "cascade", None)
+        if cascade is None:
+            cascade = self._local.cascade = cv2.CascadeClassifier(self.path)
+        return cascade
+
+    def detect(self, image):
+        small, scale = downscale(image, self.max_side)
+        # Grayscale only for detection; the color original is what gets cropped
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # min_size is in original pixels, so the same faces qualify whatever the downscale
+        min_size = max(HAAR_MIN_SIZE_FLOOR, round(self.min_size * scale))
+        faces = self._cascade().detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+                                                 minSize=(min_size, min_size))
+        return _to_original([tuple(int(v) for v in f) for f in faces], scale, image.shape)
+
+class DnnFaceDetector:
+    def __init__(self, model_path=FACE_DNN_MODEL, config_path=FACE_DNN_CONFIG,
+                 max_side=FACE_DETECT_MAX_SIDE, confidence=FACE_DNN_CONFIDENCE):
+        for path in (model_path, config_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"DNN face detector file not found: {path} (see modules/face_detectors.py)")
+        self.model_path, self.config_path = model_path, config_path
+        self.max_side, self.confidence = max_side, confidence
+        # cv2.dnn.Net isn't thread-safe either; the network is ~10 MB, so one per thread is fine
+        self._local = threading.local()
+
+    def _net(self):
+        net = getattr(self._local, "net", None)
+        if net is None:
+            net = self._local.net = cv2.dnn.readNetFromCaffe(self.config_path, self.model_path)
+        return net
+
+    def detect(self, image):
+        small, scale = downscale(image, self.max_side)
+        height, width = small.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.resize(small, (DNN_INPUT_SIZE, DNN_INPUT_SIZE)), 1.0,
+                                     (DNN_INPUT_SIZE, DNN_INPUT_SIZE), DNN_MEAN)
+        net = self._net()
+        net.setInput(blob)
+        detections = net.forward()[0, 0]  # rows of [_, _, confidence, x0, y0, x1, y1] in [0, 1]
+
+        boxes = []
+        for _, _, confidence, x0, y0, x1, y1 in detections:
+            if confidence < self.confidence:
+                continue
+            x0, y0 = max(0.0, x0) * width, max(0.0, y0) * height
+            x1, y1 = min(1.0, x1) * width, min(1.0, y1) * height
+            if x1 > x0 and y1 > y0:
+                boxes.append((int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+        return _to_original(boxes, scale, image.shape)
+
+DETECTORS = {"haar": HaarFaceDetector, "dnn": DnnFaceDetector}
+
+def version():
+    """A string that changes whenever any detection setting does (for result cache keys)."""
+    return json.dumps({
+        "detector": FACE_DETECTOR, "max_side": FACE_DETECT_MAX_SIDE,
+        "haar": [FACE_HAAR_SCALE_FACTOR, FACE_HAAR_MIN_NEIGHBORS, FACE_HAAR_MIN_SIZE, HAAR_MIN_SIZE_FLOOR],
+        "dnn": [FACE_DNN_CONFIDENCE, FACE_DNN_MODEL, FACE_DNN_CONFIG],
+    }, sort_keys=True)
+
+def load_face_detector(name=FACE_DETECTOR, **kwargs):
+    """Builds the named detector. Every detector exposes detect(bgr_image) -> [(x, y, w, h), ...]."""
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector '{name}'. Choose from {list(DETECTORS)}.")
+    return DETECTORS[name](**kwargs)
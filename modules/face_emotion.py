@@ -1,63 +1,254 @@
 import cv2
 import numpy as np
-from tensorflow.keras.models import load_model
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from modules import calibration, metrics, model_registry, result_cache
+from modules.face_backends import load_face_model, model_path
+from modules import face_detectors
+from modules.face_detectors import FACE_DETECTOR, load_face_detector
 
 # This label mapping is correct for the RAF-DB dataset structure.
 emotion_labels = ['Surprise', 'Fear', 'Disgust', 'Happy', 'Sad', 'Anger', 'Neutral']
 
-# Load the model and face detector
-model_path = os.path.join(os.path.dirname(__file__), '..', 'models', 'face_emotion_resnet50.h5')
-model = load_model(model_path)
-face_cascade_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
-face_cascade = cv2.CascadeClassifier(face_cascade_path)
+IMG_SIZE = 224
+# Used for classes without a calibrated threshold (python -m modules.evaluate face ... --save)
+CONFIDENCE_THRESHOLD = 0.4
 
-def preprocess_face(image_path):
-    # Read the original color image
-    image = cv2.imread(image_path)
-    if image is None:
-        return None, "Error loading image"
-    
-    # Create a grayscale version *only for the face detection* as it's more efficient
-    gray_for_detection = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray_for_detection, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+# --- Model backend: "keras" (default), "tflite" or "onnx", see modules/face_backends.py ---
+FACE_MODEL_BACKEND = os.getenv("FACE_MODEL_BACKEND", "keras").lower()
+
+# The model is loaded on first use (or by the app's background warm-up), not at import time
+# Rough resident size per backend, used for the memory budget until the first load is measured
+FACE_MODEL_SIZE_MB = {"keras": 600, "tflite": 60, "onnx": 80}
+model_registry.register("face", lambda: load_face_model(FACE_MODEL_BACKEND), FACE_MODEL_SIZE_MB.get(FACE_MODEL_BACKEND))
+
+def get_face_model():
+    return model_registry.get("face")
+
+def predict_probabilities(batch):
+    """Model probabilities for a batch, temperature-scaled when a calibration is saved (modules/calibration.py)."""
+    return calibration.calibrate("face", get_face_model().predict(batch))
+
+# --- Face detector: "haar" (default) or "dnn", run on a downscaled copy, see modules/face_detectors.py ---
+_face_detector = None
+_face_detector_lock = threading.Lock()
+
+def get_face_detector():
+    global _face_detector
+    with _face_detector_lock:
+        if _face_detector is None:
+            try:
+                _face_detector = load_face_detector(FACE_DETECTOR)
+            except (FileNotFoundError, cv2.error) as e:
+                print(f"Face detector '{FACE_DETECTOR}' unavailable ({e}); falling back to the Haar cascade.")
+                _face_detector = load_face_detector("haar")
+    return _face_detector
+
+@metrics.timed("face_decode")
+def load_image(source):
+    """
+    Returns a BGR image from a file path, encoded image bytes, a file-like object
+    (e.g. a Streamlit upload) or an already decoded array. Bytes are decoded in memory.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if hasattr(source, "getvalue"):
+        source = source.getvalue()
+    elif hasattr(source, "read"):
+        source = source.read()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(os.fspath(source))
+
+@metrics.timed("face_detect")
+def detect_faces(image):
+    """Returns every detected face box as (x, y, w, h) in original image coordinates, largest first."""
+    faces = get_face_detector().detect(image)
+    return sorted(faces, key=lambda f: f[2]*f[3], reverse=True)
+
+def crop_face(image, box):
+    """Crops a face box from the color image and returns it as a 224x224 RGB uint8 array."""
+    (x, y, w, h) = box
 
-    if len(faces) == 0:
-        return None, "No face detected"
-    
-    # Use the largest face found
-    (x, y, w, h) = sorted(faces, key=lambda f: f[2]*f[3], reverse=True)[0]
-    
-    # --- THIS IS THE KEY CHANGE ---
     # Crop the face from the original *color* image
     roi_color = image[y:y+h, x:x+w]
-    
+
     # Resize the color ROI to the model's expected input size
-    roi_resized = cv2.resize(roi_color, (224, 224))
-    
+    roi_resized = cv2.resize(roi_color, (IMG_SIZE, IMG_SIZE))
+
     # Convert color from BGR (OpenCV's default) to RGB (model's expected format)
-    roi_rgb = cv2.cvtColor(roi_resized, cv2.COLOR_BGR2RGB)
-    
+    return cv2.cvtColor(roi_resized, cv2.COLOR_BGR2RGB)
+
+def load_face_crop(source):
+    """Decodes an image and returns (largest face as 224x224 RGB uint8, error)."""
+    image = load_image(source)
+    if image is None:
+        return None, "Error loading image"
+
+    faces = detect_faces(image)
+    if not faces:
+        metrics.inc("face_not_found_total")
+        return None, "No face detected"
+
+    # Use the largest face found
+    return crop_face(image, faces[0]), None
+
+@metrics.timed("face_preprocess")
+def preprocess_face(image_source):
+    roi_rgb, error = load_face_crop(image_source)
+    if error:
+        return None, error
+
     # Normalize pixel values
     roi_normalized = roi_rgb / 255.0
-    
+
     # Expand dimensions to create a batch of 1
     roi_final = np.expand_dims(roi_normalized, axis=0)
-    
+
     return roi_final, None
 
-def detect_emotion_from_face(image_path):
-    roi, error = preprocess_face(image_path)
+@metrics.timed("face_preprocess")
+def preprocess_faces(image_source):
+    """
+    Prepares every detected face for one batched prediction.
+    Returns (batch, boxes, error) where batch is (N, 224, 224, 3) float32 in [0, 1], largest face first.
+    """
+    image = load_image(image_source)
+    if image is None:
+        return None, [], "Error loading image"
+
+    boxes = detect_faces(image)
+    if not boxes:
+        metrics.inc("face_not_found_total")
+        return None, [], "No face detected"
+
+    # blobFromImages resizes, swaps BGR->RGB and scales all crops in a single native call
+    crops = [image[y:y+h, x:x+w] for (x, y, w, h) in boxes]
+    blob = cv2.dnn.blobFromImages(crops, scalefactor=1.0 / 255, size=(IMG_SIZE, IMG_SIZE), swapRB=True, crop=False)
+    return blob.transpose(0, 2, 3, 1), boxes, None
+
+def label_from_prediction(prediction):
+    emotion_index = int(np.argmax(prediction))
+    label = emotion_labels[emotion_index]
+
+    if prediction[emotion_index] < calibration.threshold("face", label, CONFIDENCE_THRESHOLD):
+        metrics.inc("uncertain_total", modality="face")
+        return "Uncertain"
+    return label
+
+# --- Improvement: memoize results on the image bytes, so re-analyzing the same upload is instant ---
+def _result_key(data, mode):
+    """Everything a face result depends on: the image, the weights file, detector settings and calibration."""
+    if data is None:
+        return None
+    path = model_path(FACE_MODEL_BACKEND)
+    weights = os.path.getmtime(path) if os.path.exists(path) else None
+    return result_cache.content_key(data, mode, FACE_MODEL_BACKEND, path, weights, face_detectors.version(),
+                                    CONFIDENCE_THRESHOLD, calibration.version("face"))
+
+def detect_emotion_from_face(image_source, all_faces=False):
+    """Returns the emotion of the largest face, or the group emotion of every face when all_faces=True."""
+    if all_faces:
+        result = detect_emotions_in_group(image_source)
+        return result if isinstance(result, str) else result["group_emotion"]
+
+    data = result_cache.source_bytes(image_source)
+    return result_cache.memoize("face_emotion", _result_key(data, "largest"),
+                                lambda: _detect_largest_face(image_source if data is None else data))
+
+def _detect_largest_face(image_source):
+    roi, error = preprocess_face(image_source)
     if error:
         return error
-        
-    prediction = model.predict(roi)[0]
-    top_prob = np.max(prediction)
-    
-    if top_prob < 0.4: # Confidence threshold
-        return "Uncertain"
-        
-    emotion_index = np.argmax(prediction)
-    detected_emotion = emotion_labels[emotion_index]
-    
-    return detected_emotion
\ No newline at end of file
+
+    prediction = predict_probabilities(roi)[0]
+    return label_from_prediction(prediction)
+
+def detect_emotions_in_group(image_source):
+    """
+    Classifies every face in the image with one batched predict call.
+    Returns {"faces": [{"box", "emotion", "probabilities"}], "group_emotion", "group_probabilities"},
+    or an error string. The group emotion averages the faces' probabilities weighted by face area,
+    so people in the foreground count more than faces in the background.
+    """
+    data = result_cache.source_bytes(image_source)
+    return result_cache.memoize("face_emotion", _result_key(data, "group"),
+                                lambda: _detect_group(image_source if data is None else data))
+
+def _detect_group(image_source):
+    batch, boxes, error = preprocess_faces(image_source)
+    if error:
+        return error
+
+    predictions = predict_probabilities(batch)
+    faces = [
+        {
+            "box": [int(v) for v in box],
+            "emotion": label_from_prediction(prediction),
+            "probabilities": dict(zip(emotion_labels, map(float, prediction))),
+        }
+        for box, prediction in zip(boxes, predictions)
+    ]
+
+    areas = np.array([w * h for (_, _, w, h) in boxes], dtype=np.float32)
+    group_prediction = np.average(predictions, axis=0, weights=areas)
+    return {
+        "faces": faces,
+        "group_emotion": label_from_prediction(group_prediction),
+        "group_probabilities": dict(zip(emotion_labels, map(float, group_prediction))),
+    }
+
+def classify_face_crops(crops, batch_size=32):
+    """
+    Runs 224x224 RGB uint8 face crops through the model in chunks of at most batch_size.
+    Only real crops are scored; backends that need a stable input shape handle that themselves.
+    Returns a list of {"emotion": ..., "probabilities": {...}}, in input order.
+    """
+    results = []
+    buffer = np.empty((min(batch_size, len(crops)), IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    for start in range(0, len(crops), batch_size):
+        chunk = crops[start:start + batch_size]
+        batch = buffer[:len(chunk)]
+        for row, crop in enumerate(chunk):
+            batch[row] = crop
+        batch /= 255.0
+
+        predictions = predict_probabilities(batch)
+        for prediction in predictions:
+            results.append({
+                "emotion": label_from_prediction(prediction),
+                "probabilities": dict(zip(emotion_labels, map(float, prediction))),
+            })
+    return results
+
+def detect_emotions_from_faces(images, batch_size=32, max_workers=None):
+    """
+    Scores many images at once. Accepts paths, encoded bytes or decoded BGR arrays.
+    Face detection runs on a thread pool and the crops go through the model in
+    batches of up to batch_size, so the whole set costs one forward pass per batch instead of one per image.
+    Returns a list of {"emotion": ..., "probabilities": {...} or None}, in input order.
+    Encoded images are memoized on their bytes, so only images not seen before are decoded and scored.
+    """
+    images = list(images)
+    sources = [result_cache.source_bytes(image) for image in images]
+    keys = [_result_key(data, "batch") for data in sources]
+    results = result_cache.lookup_many("face_emotion", keys)
+    misses = [index for index, result in enumerate(results) if result is None]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        crops = list(pool.map(load_face_crop, [images[i] if sources[i] is None else sources[i] for i in misses]))
+
+    pending = []
+    for index, (crop, error) in zip(misses, crops):
+        if error:
+            results[index] = {"emotion": error, "probabilities": None}
+        else:
+            pending.append((index, crop))
+
+    scored = classify_face_crops([crop for _, crop in pending], batch_size)
+    for (index, _), result in zip(pending, scored):
+        results[index] = result
+    for index in misses:
+        result_cache.store("face_emotion", keys[index], results[index])
+    return results
@@ -0,0 +1,200 @@
+# modules/face_stream.py
+# Real-time face emotion for webcam/video streams.
+#
+# Running detect -> resize -> predict on every frame can't keep up on a CPU-only box, so:
+#   * the Haar cascade only runs every `detect_every` analyzed frames; in between the face box
+#     is followed with cheap template matching,
+#   * frames are skipped down to `target_fps`,
+#   * crops from several frames are classified in one batched forward pass,
+#   * probabilities are averaged over a sliding window so the reported emotion doesn't flicker;
+#     the window is cleared whenever no face is found, so a departed face isn't reported.
+#
+#   python -m modules.face_stream path/to/video.mp4 --target-fps 10
+#   python -m modules.face_stream 0              # webcam
+import argparse
+import time
+from collections import deque
+import cv2
+import numpy as np
+
+from modules.face_emotion import crop_face, detect_faces, emotion_labels, label_from_prediction, predict_probabilities
+
+def iter_video_frames(source):
+    """Yields BGR frames from a video file path or a camera index."""
+    capture = cv2.VideoCapture(source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+def video_fps(source):
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps or None
+
+class FaceTracker:
+    """Follows one face box between detections by template matching in a window around the last position."""
+    def __init__(self, frame, box, search_margin=0.5, min_score=0.5):
+        self.search_margin = search_margin
+        self.min_score = min_score
+        self._reset(frame, box)
+
+    def _reset(self, frame, box):
+        x, y, w, h = box
+        self.box = box
+        self.template = cv2.cvtColor(frame[y:y+h, x:x+w], cv2.COLOR_BGR2GRAY)
+
+    def update(self, frame):
+        """Returns the new box, or None when the face is lost and detection should run again."""
+        x, y, w, h = self.box
+        frame_h, frame_w = frame.shape[:2]
+        margin_x, margin_y = int(w * self.search_margin), int(h * self.search_margin)
+        x0, y0 = max(0, x - margin_x), max(0, y - margin_y)
+        x1, y1 = min(frame_w, x + w + margin_x), min(frame_h, y + h + margin_y)
+
+        search = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        if search.shape[0] < h or search.shape[1] < w:
+            return None
+        scores = cv2.matchTemplate(search, self.template, cv2.TM_CCOEFF_NORMED)
+        _, best_score, _, (best_x, best_y) = cv2.minMaxLoc(scores)
+        if best_score < self.min_score:
+            return None
+
+        self._reset(frame, (x0 + best_x, y0 + best_y, w, h))
+        return self.box
+
+class EmotionStream:
+    """
+    Turns a frame iterator into a stream of smoothed emotions.
+    `stats` reports frames read/analyzed, detector runs and the throughput actually achieved.
+    """
+    def __init__(self, detect_every=5, batch_size=8, window=15, target_fps=None, source_fps=None):
+        self.detect_every = detect_every
+        self.batch_size = batch_size
+        self.window = deque(maxlen=window)
+        self.target_fps = target_fps
+        self.source_fps = source_fps
+        self.tracker = None
+        self.stats = {"frames_read": 0, "frames_analyzed": 0, "detections": 0, "forward_passes": 0,
+                      "elapsed_s": 0.0, "read_fps": 0.0, "analyzed_fps": 0.0}
+
+    def _should_analyze(self, frame_index, now, last_analyzed):
+        if not self.target_fps:
+            return True
+        if self.source_fps:
+            # Known frame rate (video file): keep every n-th frame
+            stride = max(1, round(self.source_fps / self.target_fps))
+            return frame_index % stride == 0
+        # Live source: throttle on wall-clock time
+        return last_analyzed is None or now - last_analyzed >= 1.0 / self.target_fps
+
+    def _locate_face(self, frame):
+        box = None
+        if self.tracker is not None and self.stats["frames_analyzed"] % self.detect_every != 0:
+            box = self.tracker.update(frame)
+        if box is None:
+            self.stats["detections"] += 1
+            faces = detect_faces(frame)
+            if not faces:
+                self.tracker = None
+                return None
+            box = faces[0]
+            self.tracker = FaceTracker(frame, box)
+        return box
+
+    def _flush(self, pending):
+        """Classifies the buffered crops in one forward pass and yields one smoothed result per frame."""
+        crops = [item for item in pending if item["crop"] is not None]
+        if crops:
+            batch = np.stack([item["crop"] for item in crops]).astype(np.float32) / 255.0
+            predictions = predict_probabilities(batch)
+            self.stats["forward_passes"] += 1
+            for item, prediction in zip(crops, predictions):
+                item["prediction"] = prediction
+
+        for item in pending:
+            prediction = item.pop("prediction", None)
+            item.pop("crop")
+            if prediction is not None:
+                self.window.append(prediction)
+                smoothed = np.mean(self.window, axis=0)
+                item["emotion"] = label_from_prediction(smoothed)
+                item["probabilities"] = dict(zip(emotion_labels, map(float, smoothed)))
+            else:
+                # No face in this frame: don't keep reporting the last one, and start afresh
+                self.window.clear()
+                item["emotion"] = "No face detected"
+                item["probabilities"] = None
+            item["fps"] = self.stats["analyzed_fps"]
+            yield item
+
+    def _update_throughput(self, started):
+        elapsed = time.perf_counter() - started
+        self.stats["elapsed_s"] = elapsed
+        if elapsed > 0:
+            self.stats["read_fps"] = self.stats["frames_read"] / elapsed
+            self.stats["analyzed_fps"] = self.stats["frames_analyzed"] / elapsed
+
+    def run(self, frames):
+        """Yields {"frame_index", "box", "emotion", "probabilities", "fps"} for every analyzed frame."""
+        started = time.perf_counter()
+        last_analyzed = None
+        pending = []
+
+        for frame_index, frame in enumerate(frames):
+            self.stats["frames_read"] += 1
+            now = time.perf_counter()
+            if not self._should_analyze(frame_index, now, last_analyzed):
+                continue
+            last_analyzed = now
+
+            box = self._locate_face(frame)
+            self.stats["frames_analyzed"] += 1
+            crop = crop_face(frame, box) if box is not None else None
+            pending.append({"frame_index": frame_index, "box": box, "crop": crop})
+
+            if len(pending) >= self.batch_size:
+                self._update_throughput(started)
+                yield from self._flush(pending)
+                pending = []
+
+        self._update_throughput(started)
+        yield from self._flush(pending)
+
+def analyze_video(source, **kwargs):
+    """Convenience wrapper for a video path or camera index; returns (results generator, EmotionStream)."""
+    if "source_fps" not in kwargs and isinstance(source, str):
+        kwargs["source_fps"] = video_fps(source)
+    stream = EmotionStream(**kwargs)
+    return stream.run(iter_video_frames(source)), stream
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream face emotions from a video file or webcam.")
+    parser.add_argument("source", help="Video file path or camera index (e.g. 0)")
+    parser.add_argument("--detect-every", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--window", type=int, default=15)
+    parser.add_argument("--target-fps", type=float, default=None)
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    results, stream = analyze_video(source, detect_every=args.detect_every, batch_size=args.batch_size,
+                                    window=args.window, target_fps=args.target_fps)
+    last_emotion = None
+    for result in results:
+        if result["emotion"] != last_emotion:
+            print(f"frame {result['frame_index']:>6}: {result['emotion']}")
+            last_emotion = result["emotion"]
+
+    stats = stream.stats
+    print(f"\nRead {stats['frames_read']} frames, analyzed {stats['frames_analyzed']} "
+          f"({stats['detections']} detector runs, {stats['forward_passes']} forward passes) "
+          f"in {stats['elapsed_s']:.1f}s: {stats['read_fps']:.1f} fps read, {stats['analyzed_fps']:.1f} fps analyzed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# modules/fusion.py
+# Multimodal analysis: face, text and voice run concurrently, and their full probability vectors
+# are mapped into one label space and combined, instead of keeping only each model's top label.
+#
+# The unified label space is the set of playlist emotions (the emotion_queries keys in
+# modules/recommendation.py). Each model's labels are renamed into it (RAF-DB's "Surprise",
+# "Fear" and "Anger" become "Surprised", "Fearful" and "Angry"); labels a model doesn't have get
+# probability 0 from that model. The fused distribution is the weighted average of the
+# per-modality distributions (a linear opinion pool), so it stays a proper, calibrated
+# probability as long as its inputs are.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from modules import metrics
+
+EMOTIONS = ["Happy", "Sad", "Angry", "Calm", "Fearful", "Disgust", "Surprised", "Neutral"]
+# Model labels that are spelled differently from the unified ones
+LABEL_ALIASES = {"Surprise": "Surprised", "Fear": "Fearful", "Anger": "Angry"}
+
+def _parse_weights(value):
+    weights = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            name, weight = pair.split("=", 1)
+            weights[name.strip()] = float(weight)
+    return weights
+
+# e.g. FUSION_WEIGHTS="face=1.0,text=1.2,voice=0.6"
+FUSION_WEIGHTS = {"face": 1.0, "text": 1.0, "voice": 1.0, **_parse_weights(os.getenv("FUSION_WEIGHTS", ""))}
+FUSION_CONFIDENCE_THRESHOLD = float(os.getenv("FUSION_CONFIDENCE_THRESHOLD", "0.3"))
+
+# One thread per modality, so a request costs the slowest modality rather than the sum
+_fusion_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="fusion")
+
+def to_unified(label):
+    """Maps a model label to the unified label space; other strings (errors, "Uncertain") pass through."""
+    return LABEL_ALIASES.get(label, label)
+
+def unify_probabilities(probabilities):
+    """{model label: p} -> numpy vector over EMOTIONS, renormalized over the labels the model shares with it."""
+    vector = np.zeros(len(EMOTIONS), dtype=np.float64)
+    for label, p in probabilities.items():
+        label = to_unified(label)
+        if label in EMOTIONS:
+            vector[EMOTIONS.index(label)] += p
+    total = vector.sum()
+    return vector / total if total > 0 else vector
+
+# --- Per-modality analyzers: return (probabilities dict or None, error string or None) ---
+def _analyze_face(image_source):
+    from modules.face_emotion import detect_emotions_from_faces
+    result = detect_emotions_from_faces([image_source], batch_size=1)[0]
+    return result["probabilities"], None if result["probabilities"] else result["emotion"]
+
+def _analyze_text(text):
+    from modules.text_emotion import get_bert_emotion_probabilities
+    if not text or not text.strip():
+        return None, "Empty text"
+    return get_bert_emotion_probabilities([text])[0], None
+
+def _analyze_voice(audio_source):
+    from modules.voice_emotion import detect_emotions_from_voices
+    result = detect_emotions_from_voices([audio_source])[0]
+    return result["probabilities"], None if result["probabilities"] else result["emotion"]
+
+ANALYZERS = {"face": _analyze_face, "text": _analyze_text, "voice": _analyze_voice}
+
+def _run_modality(name, source):
+    started = time.perf_counter()
+    try:
+        probabilities, error = ANALYZERS[name](source)
+    except Exception as e:
+        probabilities, error = None, f"Error during {name} analysis: {e}"
+    elapsed = time.perf_counter() - started
+    metrics.observe("fusion_modality", elapsed, modality=name)
+    return probabilities, error, elapsed
+
+def fuse(vectors, weights=None):
+    """Weighted average of unified probability vectors ({modality: vector}); weights renormalized over those present."""
+    weights = weights or FUSION_WEIGHTS
+    total_weight = sum(weights.get(name, 1.0) for name in vectors)
+    if not vectors or total_weight <= 0:
+        return None
+    return sum(weights.get(name, 1.0) * vector for name, vector in vectors.items()) / total_weight
+
+def analyze(face=None, text=None, voice=None, weights=None):
+    """
+    Analyzes every modality that was given, concurrently, and fuses the results.
+    Returns {"emotion", "confidence", "probabilities": {label: p}, "modalities": {name: {...}}}.
+    "emotion" is "Uncertain" when the fused top probability is below FUSION_CONFIDENCE_THRESHOLD,
+    and an error string when no modality produced a result.
+    """
+    sources = {name: source for name, source in (("face", face), ("text", text), ("voice", voice)) if source is not None}
+    with metrics.span("fusion_analyze"):
+        futures = {name: _fusion_pool.submit(_run_modality, name, source) for name, source in sources.items()}
+        outcomes = {name: future.result() for name, future in futures.items()}
+
+    modalities, vectors = {}, {}
+    for name, (probabilities, error, elapsed) in outcomes.items():
+        if probabilities:
+            vectors[name] = unify_probabilities(probabilities)
+            top = int(vectors[name].argmax())
+            modalities[name] = {"emotion": EMOTIONS[top], "confidence": float(vectors[name][top]),
+                                "probabilities": dict(zip(EMOTIONS, map(float, vectors[name]))), "latency_s": elapsed}
+        else:
+            modalities[name] = {"emotion": error, "confidence": None, "probabilities": None, "latency_s": elapsed}
+
+    fused = fuse(vectors, weights)
+    if fused is None:
+        return {"emotion": "No input could be analyzed", "confidence": None, "probabilities": None, "modalities": modalities}
+
+    top = int(fused.argmax())
+    confidence = float(fused[top])
+    emotion = EMOTIONS[top] if confidence >= FUSION_CONFIDENCE_THRESHOLD else "Uncertain"
+    if emotion == "Uncertain":
+        metrics.inc("uncertain_total", modality="fusion")
+    return {
+        "emotion": emotion,
+        "confidence": confidence,
+        "probabilities": dict(zip(EMOTIONS, map(float, fused))),
+        "modalities": modalities,
+    }
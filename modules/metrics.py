@@ -0,0 +1,243 @@
+# modules/metrics.py
+# Lightweight in-process instrumentation: counters, latency histograms and per-request traces,
+# exported in the Prometheus text format. No dependencies beyond the standard library.
+#
+#   with metrics.span("face_preprocess"):            # time a block
+#       ...
+#   @metrics.timed("text_model_forward")             # or a whole function
+#   metrics.inc("cache_requests_total", cache="text_emotion", result="hit")
+#
+# Set METRICS_PORT to serve http://127.0.0.1:<port>/metrics (and /profile when the sampling
+# profiler is on, PROFILE_SAMPLING=1). The HTTP service also exposes them on its own port.
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no metrics endpoint
+PROFILE_SAMPLING = os.getenv("PROFILE_SAMPLING", "0") == "1"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# Latency buckets in seconds, from sub-millisecond cache hits to multi-second model loads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = "vibetune_"
+
+_lock = threading.Lock()
+_counters = Counter()
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_local = threading.local()
+_recent_traces = deque(maxlen=50)
+_server = None
+_profiler = None
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """Adds to a counter, e.g. inc("face_not_found_total")."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+def observe(name, seconds, **labels):
+    """Records one duration in a latency histogram (exported as <name>_seconds)."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["spans"].append((name, seconds))
+
+class span:
+    """Times a block into the `name` histogram; also usable as a decorator via timed()."""
+    def __init__(self, name, **labels):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+def timed(name, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class trace:
+    """
+    Groups the spans recorded on this thread into one request, so recent_traces() shows where
+    each request's time went. Work handed to other threads (thread pools) isn't attributed.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.parent = getattr(_local, "trace", None)
+        self.record = {"name": self.name, "spans": [], "started": time.time()}
+        _local.trace = self.record
+        self.started = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record["total"] = time.perf_counter() - self.started
+        _local.trace = self.parent
+        observe("request", self.record["total"], kind=self.name)
+        _recent_traces.append(self.record)
+
+def recent_traces():
+    """The last requests, newest first: {"name", "started", "total", "spans": [(name, seconds), ...]}."""
+    return list(reversed(_recent_traces))
+
+# --- Prometheus text format ---
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+def render():
+    """All counters and histograms in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+
+    for name in sorted({name for name, _ in histograms}):
+        metric = f"{PREFIX}{name}_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for (histogram_name, labels), values in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, values):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {values[-2]:.6f}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+    _recent_traces.clear()
+
+# --- Sampling profiler ---
+class SamplingProfiler:
+    """
+    Samples every thread's Python stack every `interval_ms` from a background thread and counts
+    identical stacks. folded() returns them in the collapsed format flamegraph tools read.
+    Overhead is one stack walk per thread per sample; nothing is traced per call.
+    """
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS, max_depth=64):
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._samples_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                with self._samples_lock:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self, top=None):
+        with self._samples_lock:
+            common = self.samples.most_common(top)
+        return "\n".join(f"{stack} {count}" for stack, count in common) + "\n"
+
+def start_profiler(interval_ms=PROFILE_INTERVAL_MS):
+    """Starts the process-wide sampling profiler once and returns it."""
+    global _profiler
+    with _lock:
+        if _profiler is None:
+            _profiler = SamplingProfiler(interval_ms).start()
+    return _profiler
+
+def profiler():
+    return _profiler
+
+# --- HTTP endpoint ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = render()
+        elif self.path.startswith("/profile") and _profiler is not None:
+            body = _profiler.folded()
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_http_server(port=METRICS_PORT, host="127.0.0.1"):
+    """
+    Serves /metrics (and /profile) from a daemon thread. Safe to call on every Streamlit rerun:
+    only the first call starts a server. Returns None when port is 0.
+    """
+    global _server
+    if not port:
+        return None
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
+
+if PROFILE_SAMPLING:
+    start_profiler()
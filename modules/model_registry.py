@@ -0,0 +1,190 @@
+# modules/model_registry.py
+# Process-wide registry of lazily loaded models, kept within a memory budget.
+#
+# Each module registers a loader at import time (cheap); the model itself is only built the first
+# time someone asks for it, or when warm_up() preloads it in a background thread after the UI
+# has rendered. Load and import timings are recorded so cold-start costs are visible.
+#
+# Warm-up is opt-in, since preloading every model costs memory and CPU the process may never need:
+#   MODEL_WARM_UP=1           preload every model
+#   MODEL_WARM_UP=text,face   preload only these
+#   unset or 0                load each model on first use
+#
+# Every load measures the model's resident footprint. When MODEL_MEMORY_BUDGET_MB is set and a
+# load would go over it, the least recently used model of another modality is evicted first and
+# simply reloaded the next time it is needed.
+import ctypes
+import gc
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from modules import metrics
+
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))  # 0 = no budget
+MODEL_WARM_UP = os.getenv("MODEL_WARM_UP", "0")
+
+logger = logging.getLogger(__name__)
+
+_loaders = {}
+_size_estimates_mb = {}
+_models = {}
+_footprints_mb = {}
+_last_used = {}
+_load_locks = {}
+_registry_lock = threading.Lock()
+_timings = {"import_s": {}, "load_s": {}}
+_counters = {"loads": Counter(), "evictions": Counter()}
+_warm_up_thread = None
+
+def _rss_mb():
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+    except ImportError:
+        return 0.0
+
+def _release_memory():
+    """Collects garbage and asks glibc to hand freed arenas back to the OS, so evictions lower RSS."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def register(name, loader, size_estimate_mb=None):
+    """
+    Registers a zero-argument loader under `name`. Registering again replaces the loader.
+    `size_estimate_mb` is used for budgeting until the model has been loaded and measured once.
+    """
+    with _registry_lock:
+        _loaders[name] = loader
+        _load_locks.setdefault(name, threading.Lock())
+        if size_estimate_mb is not None:
+            _size_estimates_mb[name] = size_estimate_mb
+
+def _make_room(name, needed_mb):
+    """Evicts least recently used models (never `name`) until `needed_mb` more fits in the budget."""
+    if not MODEL_MEMORY_BUDGET_MB:
+        return
+    with _registry_lock:
+        candidates = sorted((n for n in _models if n != name), key=lambda n: _last_used.get(n, 0))
+        resident = sum(_footprints_mb.get(n, 0) for n in _models)
+        for victim in candidates:
+            if resident + needed_mb <= MODEL_MEMORY_BUDGET_MB:
+                break
+            resident -= _footprints_mb.get(victim, 0)
+            _evict_locked(victim)
+    _release_memory()
+
+def _evict_locked(name):
+    if _models.pop(name, None) is not None:
+        _counters["evictions"][name] += 1
+
+def get(name):
+    """Returns the model, loading it on first use. Concurrent callers wait for a single load."""
+    model = _models.get(name)
+    if model is not None:
+        _last_used[name] = time.monotonic()
+        return model
+
+    with _load_locks[name]:
+        model = _models.get(name)
+        if model is None:
+            _make_room(name, _footprints_mb.get(name, _size_estimates_mb.get(name, 0)))
+            rss_before = _rss_mb()
+            started = time.perf_counter()
+            model = _loaders[name]()
+            _timings["load_s"][name] = time.perf_counter() - started
+            metrics.observe("model_load", _timings["load_s"][name], model=name)
+            # RSS growth is the best cheap measure of what the model really costs; it is noisy,
+            # so it never goes below the static estimate
+            measured = max(_rss_mb() - rss_before, 0.0)
+            with _registry_lock:
+                _footprints_mb[name] = max(measured, _size_estimates_mb.get(name, 0))
+                _models[name] = model
+                _counters["loads"][name] += 1
+            _make_room(name, 0)
+        _last_used[name] = time.monotonic()
+    return model
+
+def evict(name):
+    """Drops a model from memory; it will be reloaded on the next get()."""
+    with _registry_lock:
+        _evict_locked(name)
+    _release_memory()
+
+def evict_all():
+    with _registry_lock:
+        for name in list(_models):
+            _evict_locked(name)
+    _release_memory()
+
+def is_loaded(name):
+    return name in _models
+
+def registered():
+    return list(_loaders)
+
+def memory_stats():
+    """Current residency, measured footprints and load/eviction counts per model."""
+    with _registry_lock:
+        resident = {name: round(_footprints_mb.get(name, 0), 1) for name in _models}
+        return {
+            "budget_mb": MODEL_MEMORY_BUDGET_MB or None,
+            "resident": resident,
+            "resident_mb": round(sum(resident.values()), 1),
+            "footprints_mb": {name: round(mb, 1) for name, mb in _footprints_mb.items()},
+            "loads": dict(_counters["loads"]),
+            "evictions": dict(_counters["evictions"]),
+            "rss_mb": round(_rss_mb(), 1),
+        }
+
+def record_import(name, seconds):
+    # Only the first (cold) import is meaningful; later reruns hit sys.modules
+    _timings["import_s"].setdefault(name, seconds)
+
+def timings():
+    """{"import_s": {module: seconds}, "load_s": {model: seconds of the latest load}}"""
+    return {kind: dict(values) for kind, values in _timings.items()}
+
+def configured_warm_up():
+    """The model names MODEL_WARM_UP asks to preload; [] unless warm-up was opted into."""
+    value = MODEL_WARM_UP.strip()
+    if value in ("", "0"):
+        return []
+    if value == "1":
+        return registered()
+    return [name.strip() for name in value.split(",") if name.strip() in registered()]
+
+def warm_up(names=None, background=True):
+    """
+    Loads the given models (default: all registered) so the first request doesn't pay for them.
+    With background=True this runs once per process in a daemon thread and returns immediately.
+    Models that don't fit in the memory budget are skipped rather than evicting each other.
+    """
+    global _warm_up_thread
+    names = list(names or registered())
+
+    def load_all():
+        for name in names:
+            expected = _footprints_mb.get(name, _size_estimates_mb.get(name, 0))
+            with _registry_lock:
+                resident = sum(_footprints_mb.get(n, 0) for n in _models)
+            if MODEL_MEMORY_BUDGET_MB and resident + expected > MODEL_MEMORY_BUDGET_MB:
+                continue
+            try:
+                get(name)
+            except Exception as e:
+                logger.warning("Warm-up of '%s' model failed: %s", name, e)
+
+    if not background:
+        load_all()
+        return None
+
+    with _registry_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=load_all, name="model-warm-up", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
@@ -0,0 +1,56 @@
+# modules/onnx_runtime.py
+# Shared ONNX Runtime helpers. The int8 text/voice models are produced by
+# `python -m modules.export_transformer_onnx`.
+# Nothing here imports torch: the ONNX backends run (and start) without it.
+import os
+from types import SimpleNamespace
+import numpy as np
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), '..', 'models')
+ONNX_MODEL_FILES = {
+    "text": "text_emotion_distilroberta_int8.onnx",
+    "voice": "voice_emotion_wav2vec2_int8.onnx",
+}
+# 0 means "one thread per physical core", which is what ORT's kernels scale with
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+
+def default_intra_op_threads():
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+def create_session(path, intra_op_threads=None):
+    """CPU inference session with full graph optimizations and a tuned intra-op thread pool."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_threads or ONNX_INTRA_OP_THREADS or default_intra_op_threads()
+    options.inter_op_num_threads = 1
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+def onnx_model_path(kind):
+    return os.getenv(f"{kind.upper()}_ONNX_PATH") or os.path.join(MODELS_DIR, ONNX_MODEL_FILES[kind])
+
+class OnnxModelForClassification:
+    """
+    Drop-in stand-in for a Hugging Face *ForSequenceClassification / *ForAudioClassification model:
+    `model(**inputs).logits` and `model.config` behave the same, but the forward pass runs in ONNX Runtime
+    and the logits come back as a numpy array. Inputs may be numpy arrays or tensors.
+    """
+    def __init__(self, path, config, intra_op_threads=None):
+        self.config = config
+        self.session = create_session(path, intra_op_threads)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, **inputs):
+        feeds = {}
+        for name in self.input_names:
+            value = inputs[name]
+            value = value.numpy() if hasattr(value, "numpy") else np.asarray(value)
+            feeds[name] = value.astype(np.int64) if name in ("input_ids", "attention_mask") else value.astype(np.float32)
+        logits = self.session.run(None, feeds)[0]
+        return SimpleNamespace(logits=logits)
@@ -0,0 +1,41 @@
+# modules/rafdb.py
+# Helpers for reading the RAF-DB folder layout (data/RAF-DB/<split>/<1..7>/*.jpg).
+import os
+import cv2
+import numpy as np
+
+# Folder "1" is emotion_labels[0] ('Surprise'), ..., folder "7" is emotion_labels[6] ('Neutral')
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def list_images(root):
+    """Returns a sorted list of (path, label_index) for every image under a RAF-DB split directory."""
+    items = []
+    for class_dir in sorted(os.listdir(root)):
+        class_path = os.path.join(root, class_dir)
+        if not os.path.isdir(class_path) or not class_dir.isdigit():
+            continue
+        label_index = int(class_dir) - 1
+        for name in sorted(os.listdir(class_path)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                items.append((os.path.join(class_path, name), label_index))
+    return items
+
+def prepare_aligned_image(image, size=224):
+    """Resizes a decoded BGR face to size x size and converts it to RGB uint8, as training expects."""
+    image = cv2.resize(image, (size, size))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def load_aligned_image(path, size=224):
+    """Loads an already aligned RAF-DB face the way training does: whole image resized, RGB, uint8."""
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    return prepare_aligned_image(image, size)
+
+def load_batch(paths, size=224):
+    """Loads a list of aligned images as one float32 batch scaled to [0, 1]."""
+    batch = np.empty((len(paths), size, size, 3), dtype=np.float32)
+    for row, path in enumerate(paths):
+        batch[row] = load_aligned_image(path, size)
+    batch /= 255.0
+    return batch
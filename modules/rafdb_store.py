@@ -0,0 +1,230 @@
+# modules/rafdb_store.py
+# Preprocessed RAF-DB splits: every aligned face decoded and resized once, stored as a memory-mapped
+# uint8 array, so training, evaluation and quantization calibration read batches straight from the
+# page cache instead of decoding thousands of JPEGs on every pass.
+#
+#   python -m modules.rafdb_store build data/RAF-DB/train data/RAF-DB/test
+#   python -m modules.rafdb_store info data/RAF-DB/test
+#
+# Each split gets a directory under RAFDB_STORE_DIR (default <repo>/data/rafdb_store/<split name>,
+# whatever the working directory) holding
+#   images.npy     (N, 224, 224, 3) uint8, RGB, in rafdb.list_images order
+#   labels.npy     (N,) int16, emotion_labels indices
+#   manifest.json  per file: path relative to the split, label, size, mtime and a blake2b content hash
+# Rebuilding is incremental: files whose size and mtime are unchanged aren't read again, and a file
+# whose content hash matches any stored row (touched, renamed or moved to another class) reuses that
+# row. Only new or modified images are decoded.
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+from modules import rafdb
+
+RAFDB_STORE_DIR = os.getenv("RAFDB_STORE_DIR", os.path.join(os.path.dirname(__file__), '..', 'data', 'rafdb_store'))
+STORE_IMAGE_SIZE = 224
+STORE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+def store_dir_for(split_dir, root=RAFDB_STORE_DIR):
+    """data/RAF-DB/test -> data/rafdb_store/test"""
+    return os.path.join(root, os.path.basename(os.path.normpath(split_dir)))
+
+def _content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _read_manifest(store_dir):
+    try:
+        with open(os.path.join(store_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != STORE_VERSION:
+        return None
+    return manifest
+
+def _decode(data, path, size):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    return rafdb.prepare_aligned_image(image, size)
+
+def build(split_dir, store_dir=None, size=STORE_IMAGE_SIZE, workers=None):
+    """
+    Builds or incrementally updates the store for one split. Returns a summary dict with how many
+    rows were reused and decoded. The manifest is written last, so an interrupted build is detected
+    and redone on the next run.
+    """
+    store_dir = store_dir or store_dir_for(split_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    items = rafdb.list_images(split_dir)
+    started = time.perf_counter()
+
+    old = _read_manifest(store_dir)
+    if old is not None and old["size"] != size:
+        old = None
+    old_images = None
+    if old is not None:
+        try:
+            old_images = np.load(os.path.join(store_dir, "images.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            old_images = None
+        # A manifest without a matching images.npy (deleted or truncated by hand): rebuild it all
+        if old_images is None or old_images.shape != (len(old["files"]), size, size, 3):
+            old, old_images = None, None
+    old_files = {entry["path"]: entry for entry in old["files"]} if old else {}
+    old_rows = {entry["hash"]: row for row, entry in enumerate(old["files"])} if old else {}
+
+    # Hash only what may have changed; the file bytes are kept for decoding if no stored row matches
+    entries, sources, pending = [], [], {}
+    for row, (path, label) in enumerate(items):
+        relative = os.path.relpath(path, split_dir).replace(os.sep, "/")
+        stat = os.stat(path)
+        entry = {"path": relative, "label": label, "bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        previous = old_files.get(relative)
+        if previous and previous["bytes"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+            entry["hash"] = previous["hash"]
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+            entry["hash"] = _content_hash(data)
+            if entry["hash"] not in old_rows:
+                pending[row] = (data, path)
+        entries.append(entry)
+        sources.append(old_rows.get(entry["hash"]) if row not in pending else None)
+
+    unchanged = old is not None and [e["hash"] for e in entries] == [e["hash"] for e in old["files"]]
+    if unchanged:
+        old_images = None
+        summary = {"images": len(entries), "reused": len(entries), "decoded": 0}
+    else:
+        tmp_images = os.path.join(store_dir, "images.tmp.npy")
+        images = np.lib.format.open_memmap(tmp_images, mode="w+", dtype=np.uint8,
+                                           shape=(len(entries), size, size, 3))
+        for row, source in enumerate(sources):
+            if source is not None:
+                images[row] = old_images[source]
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as pool:
+            rows = list(pending)
+            for row, image in zip(rows, pool.map(lambda r: _decode(*pending[r], size), rows)):
+                images[row] = image
+        images.flush()
+        del images, old_images
+        # Without a manifest the store reads as missing, never as old labels over new images
+        if os.path.exists(os.path.join(store_dir, "manifest.json")):
+            os.remove(os.path.join(store_dir, "manifest.json"))
+        os.replace(tmp_images, os.path.join(store_dir, "images.npy"))
+        summary = {"images": len(entries), "reused": len(entries) - len(pending), "decoded": len(pending)}
+
+    labels = np.array([entry["label"] for entry in entries], dtype=np.int16)
+    np.save(os.path.join(store_dir, "labels.npy"), labels)
+    manifest = {"version": STORE_VERSION, "size": size, "split_dir": os.path.abspath(split_dir), "files": entries}
+    tmp_manifest = os.path.join(store_dir, "manifest.json.tmp")
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, os.path.join(store_dir, "manifest.json"))
+
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+class RafdbStore:
+    """
+    A built split, memory-mapped read-only. `images` is a numpy memmap, so slicing it costs no copy
+    until the pages are touched; batch() converts only the requested rows to the model's float input.
+    """
+    def __init__(self, store_dir):
+        manifest = _read_manifest(store_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"No RAF-DB store in {store_dir} (build it with python -m modules.rafdb_store build)")
+        self.store_dir = store_dir
+        self.manifest = manifest
+        self.images = np.load(os.path.join(store_dir, "images.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(store_dir, "labels.npy"))
+        self.paths = [os.path.join(manifest["split_dir"], entry["path"]) for entry in manifest["files"]]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def batch(self, rows):
+        """Rows (a slice or index array) as a float32 batch scaled to [0, 1], like rafdb.load_batch."""
+        if not isinstance(rows, slice):
+            # Sorted reads keep the memmap access mostly sequential; the caller's order is restored after
+            rows = np.asarray(rows)
+            order = np.argsort(rows)
+            batch = np.empty((len(rows),) + self.images.shape[1:], dtype=np.float32)
+            batch[order] = self.images[rows[order]]
+        else:
+            batch = self.images[rows].astype(np.float32)
+        batch /= 255.0
+        return batch
+
+    def iter_batches(self, batch_size=32):
+        """Yields (float32 images, labels) in file order."""
+        for start in range(0, len(self), batch_size):
+            rows = slice(start, start + batch_size)
+            yield self.batch(rows), self.labels[rows]
+
+    def is_current(self):
+        """True while the split on disk still lists the same files with the same sizes and mtimes."""
+        split_dir = self.manifest["split_dir"]
+        if not os.path.isdir(split_dir):
+            return False
+        items = rafdb.list_images(split_dir)
+        if len(items) != len(self.manifest["files"]):
+            return False
+        for (path, label), entry in zip(items, self.manifest["files"]):
+            if os.path.relpath(path, split_dir).replace(os.sep, "/") != entry["path"] or label != entry["label"]:
+                return False
+            stat = os.stat(path)
+            if stat.st_size != entry["bytes"] or stat.st_mtime_ns != entry["mtime_ns"]:
+                return False
+        return True
+
+def open_store(split_dir, store_dir=None):
+    """
+    The store for split_dir if it has been built and is up to date, else None (callers then fall back
+    to decoding the JPEGs). A stale store is reported rather than silently used.
+    """
+    store_dir = store_dir or store_dir_for(split_dir)
+    if _read_manifest(store_dir) is None:
+        return None
+    store = RafdbStore(store_dir)
+    if os.path.abspath(split_dir) != store.manifest["split_dir"] or not store.is_current():
+        logger.warning("RAF-DB store %s is out of date for %s; decoding images instead. "
+                       "Rebuild with: python -m modules.rafdb_store build %s", store_dir, split_dir, split_dir)
+        return None
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description="Build memory-mapped RAF-DB splits for fast training and evaluation.")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("splits", nargs="+", help="RAF-DB split directories, e.g. data/RAF-DB/train data/RAF-DB/test")
+    parser.add_argument("--store-root", default=RAFDB_STORE_DIR, help="Parent directory of the per-split stores")
+    parser.add_argument("--size", type=int, default=STORE_IMAGE_SIZE)
+    parser.add_argument("--workers", type=int, help="Decoding threads (default: up to 8)")
+    args = parser.parse_args()
+
+    for split_dir in args.splits:
+        store_dir = store_dir_for(split_dir, args.store_root)
+        if args.command == "build":
+            summary = build(split_dir, store_dir, size=args.size, workers=args.workers)
+            print(f"{split_dir} -> {store_dir}: {summary['images']} images, {summary['reused']} reused, "
+                  f"{summary['decoded']} decoded in {summary['seconds']:.1f}s")
+        else:
+            from modules.face_emotion import emotion_labels
+            store = RafdbStore(store_dir)
+            counts = np.bincount(store.labels, minlength=len(emotion_labels))
+            size_mb = os.path.getsize(os.path.join(store_dir, "images.npy")) / 1e6
+            print(f"{store_dir}: {len(store)} images {store.images.shape[1:]}, {size_mb:.0f} MB, "
+                  f"{'up to date' if store.is_current() else 'stale'}")
+            for name, count in zip(emotion_labels, counts):
+                print(f"  {name:>10}: {count}")
+
+if __name__ == "__main__":
+    main()
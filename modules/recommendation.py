@@ -2,13 +2,62 @@
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 import os
+import math
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import sqlite3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 import streamlit as st
+from modules import metrics
+from modules.fusion import to_unified
+from modules.track_cache import TrackCache
+from modules.track_catalog import TRACK_CATALOG_DIR, TrackCatalog, emotion_target
+
+# --- Concurrency & retry settings for Spotify searches ---
+SPOTIFY_MAX_WORKERS = int(os.getenv("SPOTIFY_MAX_WORKERS", "8"))
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "3"))
+SPOTIFY_BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "0.3"))
+SPOTIFY_BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "8.0"))
+# Longest Retry-After worth waiting for; a longer one fails the search so the cache/catalog fallback runs
+SPOTIFY_RETRY_AFTER_MAX = float(os.getenv("SPOTIFY_RETRY_AFTER_MAX", str(SPOTIFY_BACKOFF_MAX)))
+SPOTIFY_TIMEOUT = float(os.getenv("SPOTIFY_TIMEOUT", "5"))
+# Point this at a local stub (see modules/spotify_stub.py) to run without real credentials
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# --- Persistent search cache: fresh for TTL, then served stale while refreshing in the background ---
+TRACK_CACHE_ENABLED = os.getenv("TRACK_CACHE_ENABLED", "1") == "1"
+TRACK_CACHE_PATH = os.getenv("TRACK_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "vibetune", "spotify_tracks.sqlite"))
+TRACK_CACHE_TTL = float(os.getenv("TRACK_CACHE_TTL", str(6 * 3600)))
+TRACK_CACHE_STALE_TTL = float(os.getenv("TRACK_CACHE_STALE_TTL", str(7 * 24 * 3600)))
+
+# "spotify" (live search, default) or "catalog" (offline nearest-neighbour retrieval)
+RECOMMENDATION_SOURCE = os.getenv("RECOMMENDATION_SOURCE", "spotify").lower()
+CATALOG_POOL_FACTOR = 5
+
+logger = logging.getLogger(__name__)
+
+def _build_session():
+    """One pooled HTTP session shared by all search threads. Retries are handled in _search_with_retry."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=SPOTIFY_MAX_WORKERS, pool_maxsize=SPOTIFY_MAX_WORKERS, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 @st.cache_resource(max_entries=1, ttl=3600)  # Cache for 1 hour, max 1 instance
 def connect_to_spotify():
     """Connect to Spotify using Client Credentials (no user auth required)"""
     try:
+        if SPOTIFY_API_URL:
+            sp = spotipy.Spotify(auth="stub-token", requests_session=_build_session(), requests_timeout=SPOTIFY_TIMEOUT)
+            sp.prefix = SPOTIFY_API_URL.rstrip("/") + "/"
+            return sp
+
         # Try to get credentials from Streamlit secrets first, then environment
         try:
             client_id = st.secrets["SPOTIPY_CLIENT_ID"]
@@ -16,27 +65,34 @@ def connect_to_spotify():
         except:
             client_id = os.getenv("SPOTIPY_CLIENT_ID")
             client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
-        
+
         if not client_id or not client_secret:
             st.error("❌ Spotify credentials not found. Please check your secrets configuration.")
             return None
-            
+
         auth_manager = SpotifyClientCredentials(
             client_id=client_id,
             client_secret=client_secret
         )
-        
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        
-        # Test the connection
-        sp.search(q="test", limit=1)
-        return sp
-        
+
+        # Passing our own session means spotipy doesn't mount its blocking retry adapter.
+        # No test search here: a bad credential surfaces on the first real request instead of costing one per connect.
+        return spotipy.Spotify(auth_manager=auth_manager, requests_session=_build_session(), requests_timeout=SPOTIFY_TIMEOUT)
+
     except Exception as e:
         st.error(f"❌ Spotify connection failed: {e}")
         return None
 
-sp = connect_to_spotify()
+def get_spotify():
+    """The Spotify client is created on first use rather than when this module is imported."""
+    return connect_to_spotify()
+
+_search_pool = ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS, thread_name_prefix="spotify-search")
+_track_cache = None
+_track_cache_opened = False
+_track_cache_lock = threading.Lock()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
 
 emotion_queries = {
     "Happy": ["upbeat", "feel good", "party", "happy vibes", "energetic"],
@@ -49,46 +105,179 @@ emotion_queries = {
     "Neutral": ["chill study beats", "lo-fi", "background music", "easy listening"]
 }
 
+def get_track_cache():
+    """
+    The search cache, opened on first use rather than at import. None when disabled or when
+    TRACK_CACHE_PATH can't be opened (e.g. a read-only HOME); searches then just aren't cached.
+    """
+    global _track_cache, _track_cache_opened
+    with _track_cache_lock:
+        if not _track_cache_opened:
+            _track_cache_opened = True
+            if TRACK_CACHE_ENABLED:
+                try:
+                    _track_cache = TrackCache(TRACK_CACHE_PATH, TRACK_CACHE_TTL, TRACK_CACHE_STALE_TTL)
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Track cache disabled: could not open %s: %s", TRACK_CACHE_PATH, e)
+        return _track_cache
+
+def _retry_delay(attempt, retry_after=None):
+    """
+    Honors Retry-After when Spotify sends one, otherwise exponential backoff with full jitter.
+    Returns None when Retry-After exceeds SPOTIFY_RETRY_AFTER_MAX (don't retry at all); negative
+    or non-numeric values are ignored.
+    """
+    if retry_after is not None:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            seconds = math.nan
+        if seconds > SPOTIFY_RETRY_AFTER_MAX:
+            return None
+        if seconds >= 0:
+            return seconds
+    return random.uniform(0, min(SPOTIFY_BACKOFF_MAX, SPOTIFY_BACKOFF_BASE * 2 ** attempt))
+
+def _search_with_retry(query, market, limit=50):
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        try:
+            with metrics.span("spotify_search"):
+                results = get_spotify().search(q=query, type='track', limit=limit, market=market)
+            metrics.inc("spotify_search_total", outcome="ok")
+            return results
+        except spotipy.SpotifyException as e:
+            metrics.inc("spotify_search_total", outcome=f"http_{e.http_status}")
+            if e.http_status not in RETRYABLE_STATUS or attempt == SPOTIFY_MAX_RETRIES:
+                raise
+            headers = getattr(e, "headers", None) or {}
+            delay = _retry_delay(attempt, headers.get("Retry-After"))
+            if delay is None:
+                raise
+        except requests.exceptions.RequestException:
+            metrics.inc("spotify_search_total", outcome="network_error")
+            if attempt == SPOTIFY_MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+        time.sleep(delay)
+
+def _normalize_track(item):
+    # Get album art URL
+    album_art_url = None
+    if item['album']['images']:
+        album_art_url = item['album']['images'][1]['url'] if len(item['album']['images']) > 1 else item['album']['images'][0]['url']
+
+    return {
+        'id': item.get('id'),
+        'name': item['name'],
+        'artist': item['artists'][0]['name'],
+        'preview_url': item.get('preview_url'),
+        'spotify_url': item['external_urls']['spotify'],
+        'album_art_url': album_art_url
+    }
+
+def _fetch_query(query, market):
+    """Searches Spotify, normalizes the items and stores them in the cache."""
+    results = _search_with_retry(query, market)
+    tracks = [_normalize_track(item) for item in results['tracks']['items'] if item]
+    track_cache = get_track_cache()
+    if track_cache is not None:
+        track_cache.put(query, market, tracks)
+    return tracks
+
+def _refresh_in_background(query, market):
+    key = (query, market)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            _fetch_query(query, market)
+        except Exception:
+            pass  # Keep serving the stale entry; the next request will try again
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _search_pool.submit(refresh)
+
+def search_tracks(queries, market="US"):
+    """
+    Returns the merged track pool for `queries`, de-duplicated by track ID.
+    Cached queries are answered locally (stale ones are refreshed in the background);
+    the remaining searches run concurrently over the pooled session.
+    Failed queries are skipped; raises only if nothing could be found at all.
+    """
+    pools = []
+    futures = []
+    track_cache = get_track_cache()
+    for query in queries:
+        cached, is_stale = track_cache.get(query, market) if track_cache is not None else (None, False)
+        if track_cache is not None:
+            result = "miss" if cached is None else "stale" if is_stale else "hit"
+            metrics.inc("cache_requests_total", cache="spotify_tracks", result=result)
+        if cached is None:
+            futures.append(_search_pool.submit(_fetch_query, query, market))
+        else:
+            pools.append(cached)
+            if is_stale:
+                _refresh_in_background(query, market)
+
+    errors = []
+    for future in as_completed(futures):
+        try:
+            pools.append(future.result())
+        except Exception as e:
+            errors.append(e)
+
+    if errors and not pools:
+        raise errors[0]
+
+    tracks = {}
+    for pool in pools:
+        for track in pool:
+            tracks.setdefault(track['id'] or track['spotify_url'], track)
+    return list(tracks.values())
+
+@st.cache_resource(max_entries=1)
+def load_track_catalog():
+    """Opens the offline catalog if one has been ingested (see modules/track_catalog.py)."""
+    if not os.path.exists(os.path.join(TRACK_CATALOG_DIR, "meta.json")):
+        return None
+    return TrackCatalog(TRACK_CATALOG_DIR)
+
+def get_catalog_tracks_for_emotion(emotion, limit=10, pool_size=None):
+    """Nearest tracks to the emotion's target features, sampled from a wider pool so playlists vary."""
+    catalog = load_track_catalog()
+    if catalog is None:
+        return []
+    candidates = catalog.search(emotion_target(emotion), k=pool_size or limit * CATALOG_POOL_FACTOR)
+    return [catalog.track(index) for index in random.sample(candidates, min(limit, len(candidates)))]
+
+@metrics.timed("recommendation")
 def get_tracks_for_emotion(emotion, limit=10):
+    # Face labels are spelled differently ("Surprise", "Fear", "Anger"); map them to the query keys
+    emotion = to_unified(emotion)
+    # Offline catalog when asked for, or as the fallback when Spotify isn't configured
+    if RECOMMENDATION_SOURCE == "catalog":
+        return get_catalog_tracks_for_emotion(emotion, limit)
+
+    sp = get_spotify()
+    if sp is None and load_track_catalog() is not None:
+        return get_catalog_tracks_for_emotion(emotion, limit)
     if sp is None:
         st.error("❌ Spotify connection not available. Please check your API credentials.")
         return []
-    
+
     queries = emotion_queries.get(emotion, ["mood"])
-    random.shuffle(queries)
-    all_tracks = []
-    
+
     try:
         market = "US"  # Default market
-        
-        for query in queries:
-            results = sp.search(q=query, type='track', limit=50, market=market)
-            tracks_from_query = results['tracks']['items']
-            
-            for item in tracks_from_query:
-                if item:
-                    # Get album art URL
-                    album_art_url = None
-                    if item['album']['images']:
-                        album_art_url = item['album']['images'][1]['url'] if len(item['album']['images']) > 1 else item['album']['images'][0]['url']
-                    
-                    all_tracks.append({
-                        'name': item['name'],
-                        'artist': item['artists'][0]['name'],
-                        'preview_url': item.get('preview_url'),
-                        'spotify_url': item['external_urls']['spotify'],
-                        'album_art_url': album_art_url
-                    })
-                    
-                    if len(all_tracks) >= limit:
-                        break
-            
-            if len(all_tracks) >= limit:
-                break
-                
+        all_tracks = search_tracks(queries, market)
     except Exception as e:
         st.error(f"❌ Could not fetch songs from Spotify: {e}")
         return []
-    
+
     random.shuffle(all_tracks)
     return all_tracks[:limit]
@@ -0,0 +1,205 @@
+# modules/result_cache.py
+# Memoizes analysis results on a hash of the input bytes, so analyzing the same upload again
+# (a second click on "Analyze Face", the same clip sent twice to the service) skips decoding,
+# detection and the model entirely. The service's batch functions look every item of a micro-batch
+# up with lookup_many() and run only the misses.
+#
+# Keys are a BLAKE2b digest of the input bytes plus the model version and anything else the
+# result depends on (backend and weights file, detector settings, the saved calibration), so a
+# new model or calibration never serves stale results. Each cache is an LRU bounded both by
+# entry count and by the approximate size of its values, and can keep a copy of every entry on
+# disk (RESULT_CACHE_DIR) so results survive restarts and are shared between worker processes.
+#
+#   RESULT_CACHE=0             disable memoization (every call recomputes)
+#   RESULT_CACHE_SIZE          entries per cache (default 1024)
+#   RESULT_CACHE_MB            memory per cache in MB (default 16)
+#   RESULT_CACHE_DIR           directory for the on-disk tier (default: memory only)
+#   RESULT_CACHE_DISK_ENTRIES  files kept per cache on disk (default 100000)
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from modules import metrics
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") == "1"
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "16"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_ENTRIES = int(os.getenv("RESULT_CACHE_DISK_ENTRIES", "100000"))
+DISK_PRUNE_EVERY = 256  # puts between checks of the on-disk entry count
+
+_caches = {}
+_registry_lock = threading.Lock()
+
+def content_key(data, *parts):
+    """Hex digest of the input bytes plus every part (model version, settings) the result depends on."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(data)
+    for part in parts:
+        digest.update(b"\0" + str(part).encode("utf-8"))
+    return digest.hexdigest()
+
+def source_bytes(source):
+    """
+    The raw bytes behind a path, bytes object or file-like upload, or None when they can't be
+    read without consuming the source (the call then just isn't cached).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "read") and hasattr(source, "seek"):
+        position = source.tell()
+        data = source.read()
+        source.seek(position)
+        return data
+    if isinstance(source, (str, os.PathLike)):
+        try:
+            with open(source, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+    return None
+
+class ResultCache:
+    """
+    Thread-safe LRU of JSON-serializable results with hit/miss counters. Values are stored as
+    their JSON encoding, which is also what the memory bound counts and what the disk tier holds.
+    """
+    def __init__(self, name, max_entries=RESULT_CACHE_SIZE, max_bytes=RESULT_CACHE_MB * 1e6, disk_dir=RESULT_CACHE_DIR):
+        self.name = name
+        self.max_entries, self.max_bytes = max_entries, max_bytes
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.hits = self.disk_hits = self.misses = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _remember(self, key, encoded):
+        # Caller holds the lock
+        if key in self._data:
+            self.bytes -= len(self._data.pop(key))
+        self._data[key] = encoded
+        self.bytes += len(encoded)
+        while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+            _, evicted = self._data.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def get(self, key):
+        """The cached value, or None."""
+        with self._lock:
+            encoded = self._data.get(key)
+            if encoded is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+        if encoded is None and self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    encoded = f.read()
+            except OSError:
+                encoded = None
+            if encoded is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, encoded)
+                metrics.inc("cache_requests_total", cache=self.name, result="disk_hit")
+                return json.loads(encoded)
+        if encoded is None:
+            with self._lock:
+                self.misses += 1
+            metrics.inc("cache_requests_total", cache=self.name, result="miss")
+            return None
+        metrics.inc("cache_requests_total", cache=self.name, result="hit")
+        return json.loads(encoded)
+
+    def put(self, key, value):
+        encoded = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        with self._lock:
+            self._remember(key, encoded)
+            self._puts += 1
+            prune = self.disk_dir and self._puts % DISK_PRUNE_EVERY == 0
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(encoded)
+            # Atomic, so a concurrent reader in another process never sees half a file
+            os.replace(temporary, path)
+            if prune:
+                self._prune_disk()
+
+    def _prune_disk(self):
+        """Deletes the least recently written files beyond RESULT_CACHE_DISK_ENTRIES."""
+        files = []
+        for directory, _, names in os.walk(self.disk_dir):
+            files.extend(os.path.join(directory, name) for name in names if name.endswith(".json"))
+        if len(files) <= RESULT_CACHE_DISK_ENTRIES:
+            return
+        files.sort(key=lambda path: os.path.getmtime(path))
+        for path in files[:len(files) - RESULT_CACHE_DISK_ENTRIES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {"size": len(self._data), "maxsize": self.max_entries, "bytes": self.bytes,
+                    "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_ratio": (self.hits + self.disk_hits) / total if total else 0.0}
+
+def get_cache(name, **kwargs):
+    """The process-wide cache with this name, created on first use."""
+    with _registry_lock:
+        if name not in _caches:
+            _caches[name] = ResultCache(name, **kwargs)
+        return _caches[name]
+
+def memoize(name, key, compute, cacheable=lambda result: True):
+    """
+    Returns the cached result for key, or compute()'s result, which is stored when cacheable(result)
+    (transient failures such as a model that didn't load shouldn't be remembered). key=None or
+    RESULT_CACHE=0 bypasses the cache.
+    """
+    if not RESULT_CACHE_ENABLED or key is None:
+        return compute()
+    cache = get_cache(name)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    result = compute()
+    if result is not None and cacheable(result):
+        cache.put(key, result)
+    return result
+
+def lookup_many(name, keys):
+    """
+    Cached results for a batch of keys, None for each miss. The batch functions behind the HTTP
+    service look every item up first, compute only the misses in one pass and store() them.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return [None] * len(keys)
+    cache = get_cache(name)
+    return [None if key is None else cache.get(key) for key in keys]
+
+def store(name, key, result):
+    if RESULT_CACHE_ENABLED and key is not None and result is not None:
+        get_cache(name).put(key, result)
+
+def stats():
+    """Hit ratios and sizes of every result cache, by name."""
+    with _registry_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
@@ -0,0 +1,89 @@
+# modules/spotify_stub.py
+# Minimal local stand-in for the Spotify Web API search endpoint, for testing and benchmarking
+# the recommendation code without credentials or network access.
+#
+#   python -m modules.spotify_stub --port 8765 --latency-ms 80 --rate-limit-every 10
+#   SPOTIFY_API_URL=http://127.0.0.1:8765/v1 streamlit run app/app.py
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def fake_track(query, index):
+    """Deterministic track payload in the same shape as the real search response."""
+    track_id = hashlib.sha1(f"{query}:{index}".encode()).hexdigest()[:22]
+    return {
+        "id": track_id,
+        "name": f"{query.title()} #{index + 1}",
+        "artists": [{"name": f"Stub Artist {index % 7 + 1}"}],
+        "album": {"images": [{"url": f"https://i.scdn.co/image/{track_id}-640"},
+                             {"url": f"https://i.scdn.co/image/{track_id}-300"}]},
+        "preview_url": None,
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+    }
+
+def make_handler(latency_ms=0, rate_limit_every=0, retry_after=1):
+    counter = {"requests": 0}
+    lock = threading.Lock()
+
+    class SpotifyStubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if not url.path.rstrip("/").endswith("/search"):
+                self._send_json(404, {"error": {"status": 404, "message": "Not found"}})
+                return
+
+            with lock:
+                counter["requests"] += 1
+                throttled = rate_limit_every and counter["requests"] % rate_limit_every == 0
+            if throttled:
+                self._send_json(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                {"Retry-After": str(retry_after)})
+                return
+
+            time.sleep(latency_ms / 1000)
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0]
+            limit = int(params.get("limit", ["20"])[0])
+            items = [fake_track(query, i) for i in range(limit)]
+            self._send_json(200, {"tracks": {"items": items, "total": limit, "limit": limit, "offset": 0}})
+
+    return SpotifyStubHandler
+
+def start_stub_server(port=0, latency_ms=0, rate_limit_every=0, retry_after=1):
+    """Starts the stub in a daemon thread and returns (server, base_url); port=0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency_ms, rate_limit_every, retry_after))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Spotify search API locally.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every n-th request with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                 make_handler(args.latency_ms, args.rate_limit_every, args.retry_after))
+    print(f"Spotify stub listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
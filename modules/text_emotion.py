@@ -8,20 +8,43 @@
 
 
 # modules/text_emotion.py
+import os
+import random
+import re
+import threading
+from collections import Counter
+from types import SimpleNamespace
+import numpy as np
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-from transformers import pipeline
 import streamlit as st
+from modules import calibration, metrics, model_registry, result_cache
 
-# --- Improvement: Cache the model so it only loads once ---
-@st.cache_resource
+TEXT_MODEL_NAME = "j-hartmann/emotion-english-distilroberta-base"
+# "torch" (default) or "onnx" for the int8 ONNX Runtime export
+TEXT_MODEL_BACKEND = os.getenv("TEXT_MODEL_BACKEND", "torch").lower()
+
+# --- Improvement: Load the model lazily, once per process (see modules/model_registry.py) ---
 def load_bert_model():
-    """Loads the BERT model and caches it."""
-    return pipeline("text-classification", 
-                    model="j-hartmann/emotion-english-distilroberta-base")
+    """Loads the BERT model. transformers/torch are only imported here, not at module import."""
+    if TEXT_MODEL_BACKEND == "onnx":
+        # Tokenizer and config only; torch is never imported on this path
+        from transformers import AutoConfig, AutoTokenizer
+        from modules.onnx_runtime import OnnxModelForClassification, onnx_model_path
+        # Only .tokenizer and .model are used below, so a namespace stands in for the pipeline
+        return SimpleNamespace(
+            tokenizer=AutoTokenizer.from_pretrained(TEXT_MODEL_NAME),
+            model=OnnxModelForClassification(onnx_model_path("text"), AutoConfig.from_pretrained(TEXT_MODEL_NAME)),
+        )
+    from transformers import pipeline
+    return pipeline("text-classification",
+                    model=TEXT_MODEL_NAME)
 
 # Load analyzers
 vader_analyzer = SentimentIntensityAnalyzer()
-bert_emotion_classifier = load_bert_model()
+model_registry.register("text", load_bert_model, 120 if TEXT_MODEL_BACKEND == "onnx" else 350)
+
+def get_bert_classifier():
+    return model_registry.get("text")
 
 # --- Improvement: Map BERT outputs to a standard set of emotions ---
 EMOTION_MAP = {
@@ -34,11 +57,44 @@ EMOTION_MAP = {
     "neutral": "Neutral"
 }
 
+TEXT_CACHE_SIZE = int(os.getenv("TEXT_CACHE_SIZE", "4096"))
+MAX_TOKENS = 512
+
+# --- VADER cascade: settle easy inputs without running BERT ---
+TEXT_CASCADE_ENABLED = os.getenv("TEXT_CASCADE", "0") == "1"
+TEXT_CASCADE_THRESHOLD = float(os.getenv("TEXT_CASCADE_THRESHOLD", "0.6"))
+# Fraction of short-circuited inputs that are still sent to BERT to measure agreement
+TEXT_CASCADE_AUDIT_RATE = float(os.getenv("TEXT_CASCADE_AUDIT_RATE", "0.05"))
+
+EMOTION_KEYWORDS = {
+    "Happy": {"happy", "glad", "joy", "joyful", "excited", "great", "wonderful", "amazing", "awesome",
+              "love", "loved", "fantastic", "delighted", "grateful", "thrilled", "cheerful"},
+    "Sad": {"sad", "unhappy", "depressed", "lonely", "miserable", "heartbroken", "cry", "crying",
+            "cried", "grief", "down", "gloomy", "hopeless", "upset"},
+    "Angry": {"angry", "mad", "furious", "annoyed", "irritated", "rage", "hate", "pissed", "frustrated"},
+    "Fearful": {"scared", "afraid", "fear", "terrified", "anxious", "nervous", "worried", "panic", "frightened"},
+    "Disgust": {"disgusted", "disgusting", "gross", "revolting", "nasty", "sickening"},
+    "Surprised": {"surprised", "shocked", "astonished", "unexpected", "wow", "stunned"},
+}
+POSITIVE_EMOTIONS = {"Happy", "Surprised"}
+_WORD_RE = re.compile(r"[a-z']+")
+
+# Shared result cache (modules/result_cache.py); entries are keyed on the normalized text and model
+_emotion_cache = result_cache.get_cache("text_emotion", max_entries=TEXT_CACHE_SIZE)
+
+def _cache_key(normalized):
+    return result_cache.content_key(normalized.encode("utf-8"), TEXT_MODEL_BACKEND, TEXT_MODEL_NAME,
+                                    calibration.version("text"))
+
+def normalize_text(text: str) -> str:
+    """Cache key: case-folded with whitespace collapsed, so trivially different entries share a result."""
+    return " ".join(text.casefold().split())
+
 def get_vader_sentiment(text: str) -> str:
     # This function is good as is.
     scores = vader_analyzer.polarity_scores(text)
     compound = scores['compound']
-    
+
     if compound >= 0.05:
         return "Positive"
     elif compound <= -0.05:
@@ -46,16 +102,175 @@ def get_vader_sentiment(text: str) -> str:
     else:
         return "Neutral"
 
-def get_bert_emotion(text: str) -> str:
-    """Returns only the standardized emotion label now."""
-    if not text.strip():
+@metrics.timed("text_model_forward")
+def _bert_probabilities(texts, batch_size):
+    """
+    Runs the classifier over `texts` and returns an (N, num_labels) probability array in input order.
+    Inputs are sorted by token length and padded only within each batch, so short entries
+    never pay for the padding of long ones.
+    """
+    classifier = get_bert_classifier()
+    tokenizer = classifier.tokenizer
+    model = classifier.model
+    encodings = tokenizer(texts, truncation=True, max_length=MAX_TOKENS)["input_ids"]
+    order = sorted(range(len(texts)), key=lambda i: len(encodings[i]))
+
+    probabilities = np.empty((len(texts), model.config.num_labels), dtype=np.float32)
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        batch = {"input_ids": [encodings[i] for i in bucket]}
+        if TEXT_MODEL_BACKEND == "onnx":
+            logits = model(**tokenizer.pad(batch, return_tensors="np")).logits
+        else:
+            import torch
+            with torch.no_grad():
+                logits = model(**tokenizer.pad(batch, return_tensors="pt")).logits.numpy()
+        probabilities[bucket] = _softmax(logits)
+    return probabilities
+
+def _softmax(logits):
+    exponents = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponents / exponents.sum(axis=1, keepdims=True)
+
+def get_bert_emotion_probabilities(texts, batch_size=16):
+    """
+    Returns one {standard label: probability} dict per text (None for empty text).
+    Results are served from an LRU cache keyed on the normalized text; only misses reach the model.
+    """
+    results = [None] * len(texts)
+    misses = {}
+    for index, text in enumerate(texts):
+        if not text.strip():
+            continue
+        key = _cache_key(normalize_text(text))
+        cached = _emotion_cache.get(key) if result_cache.RESULT_CACHE_ENABLED else None
+        if cached is not None:
+            results[index] = cached
+        else:
+            misses.setdefault(key, []).append(index)
+
+    if misses:
+        keys = list(misses)
+        # Classify the first original spelling of each distinct normalized text
+        probabilities = _bert_probabilities([texts[misses[key][0]] for key in keys], batch_size)
+        probabilities = calibration.calibrate("text", probabilities)
+        id2label = get_bert_classifier().model.config.id2label
+        for key, row in zip(keys, probabilities):
+            scores = {EMOTION_MAP.get(id2label[i], id2label[i]): float(p) for i, p in enumerate(row)}
+            if result_cache.RESULT_CACHE_ENABLED:
+                _emotion_cache.put(key, scores)
+            for index in misses[key]:
+                results[index] = scores
+    return results
+
+def label_from_scores(scores):
+    """The top label of one probability dict, or "Uncertain" below its calibrated threshold (none by default)."""
+    label = None if scores is None else max(scores, key=scores.get)
+    if label is None or scores[label] < calibration.threshold("text", label):
         return "Uncertain"
-    
+    return label
+
+def get_bert_emotions(texts, batch_size=16):
+    """Batched version of get_bert_emotion: returns one standardized label per text."""
+    texts = list(texts)
     try:
-        results = bert_emotion_classifier(text, top_k=1)
-        top_label = results[0]['label']
-        # Use the mapping to return a consistent, capitalized emotion label
-        return EMOTION_MAP.get(top_label, "Neutral")
+        probabilities = get_bert_emotion_probabilities(texts, batch_size)
     except Exception as e:
         st.error(f"Text analysis failed: {e}")
-        return "Error"
+        return ["Error"] * len(texts)
+    labels = [label_from_scores(scores) for scores in probabilities]
+    metrics.inc("uncertain_total", labels.count("Uncertain"), modality="text")
+    return labels
+
+@metrics.timed("text_emotion")
+def get_bert_emotion(text: str) -> str:
+    """Returns only the standardized emotion label now."""
+    return get_bert_emotions([text])[0]
+
+def cache_stats():
+    """Hit/miss counters of the text emotion cache."""
+    return _emotion_cache.stats()
+
+_cascade_counters = Counter()
+_cascade_lock = threading.Lock()
+
+def _cheap_emotion(text, threshold):
+    """
+    Decides confidently-polar or trivial inputs from VADER plus the keyword lexicon.
+    Returns a standard label, or None when the text is ambiguous and needs BERT.
+    """
+    words = _WORD_RE.findall(text.casefold())
+    compound = vader_analyzer.polarity_scores(text)["compound"]
+    hits = Counter(label for word in words for label, keywords in EMOTION_KEYWORDS.items() if word in keywords)
+
+    if not hits:
+        # Very short text with no sentiment at all ("ok", "nothing much today")
+        if len(words) <= 3 and compound == 0:
+            return "Neutral"
+        # Strongly positive text is almost always joy; strongly negative could be sadness, anger or fear
+        if compound >= threshold:
+            return "Happy"
+        return None
+
+    if len(hits) > 1:
+        return None
+    label = next(iter(hits))
+    # The keyword has to agree with a confident VADER polarity
+    if label in POSITIVE_EMOTIONS and compound >= threshold:
+        return label
+    if label not in POSITIVE_EMOTIONS and compound <= -threshold:
+        return label
+    return None
+
+def get_cascade_emotions(texts, threshold=None, batch_size=16):
+    """
+    Like get_bert_emotions, but inputs VADER can settle on its own never reach the transformer.
+    Only ambiguous texts are escalated to BERT, in one batch. A small random sample of the
+    short-circuited inputs is also scored by BERT so cascade_stats() can report agreement.
+    """
+    threshold = TEXT_CASCADE_THRESHOLD if threshold is None else threshold
+    texts = list(texts)
+    labels = [None] * len(texts)
+    escalate, audit = [], []
+
+    for index, text in enumerate(texts):
+        if not text.strip():
+            metrics.inc("uncertain_total", modality="text")
+            labels[index] = "Uncertain"
+            continue
+        cheap = _cheap_emotion(text, threshold)
+        if cheap is None:
+            escalate.append(index)
+        else:
+            labels[index] = cheap
+            if random.random() < TEXT_CASCADE_AUDIT_RATE:
+                audit.append(index)
+
+    bert_labels = get_bert_emotions([texts[i] for i in escalate + audit], batch_size)
+    for index, label in zip(escalate, bert_labels):
+        labels[index] = label
+    agreed = sum(labels[i] == label for i, label in zip(audit, bert_labels[len(escalate):]))
+
+    with _cascade_lock:
+        _cascade_counters["requests"] += len(texts)
+        _cascade_counters["short_circuited"] += len(texts) - len(escalate)
+        _cascade_counters["audited"] += len(audit)
+        _cascade_counters["agreed"] += agreed
+    return labels
+
+def get_text_emotion(text: str) -> str:
+    """Entry point used by the app: the VADER cascade when TEXT_CASCADE=1, plain BERT otherwise."""
+    if TEXT_CASCADE_ENABLED:
+        return get_cascade_emotions([text])[0]
+    return get_bert_emotion(text)
+
+def cascade_stats():
+    """Share of requests the cascade answered without BERT, and how often audited answers matched BERT."""
+    with _cascade_lock:
+        counters = dict(_cascade_counters)
+    requests, audited = counters.get("requests", 0), counters.get("audited", 0)
+    return {
+        **counters,
+        "short_circuit_rate": counters.get("short_circuited", 0) / requests if requests else 0.0,
+        "agreement": counters.get("agreed", 0) / audited if audited else None,
+    }
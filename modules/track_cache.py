@@ -0,0 +1,64 @@
+# modules/track_cache.py
+# Persistent cache of normalized Spotify search results, keyed by (query, market).
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+class TrackCache:
+    """
+    SQLite-backed store with two ages:
+      * younger than `ttl`            -> fresh, served as is
+      * between `ttl` and `stale_ttl` -> stale, served immediately but should be refreshed in the background
+      * older than `stale_ttl`        -> treated as missing
+    """
+    def __init__(self, path, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache ("
+                " query TEXT NOT NULL, market TEXT NOT NULL, tracks TEXT NOT NULL, fetched_at REAL NOT NULL,"
+                " PRIMARY KEY (query, market))"
+            )
+
+    def get(self, query, market):
+        """Returns (tracks, is_stale), or (None, False) on a miss."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tracks, fetched_at FROM search_cache WHERE query = ? AND market = ?", (query, market)
+            ).fetchone()
+            age = time.time() - row[1] if row else None
+            if row is None or age >= self.stale_ttl:
+                self.counters["misses"] += 1
+                return None, False
+            is_stale = age >= self.ttl
+            self.counters["stale_hits" if is_stale else "fresh_hits"] += 1
+        return json.loads(row[0]), is_stale
+
+    def put(self, query, market, tracks):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (query, market, tracks, fetched_at) VALUES (?, ?, ?, ?)",
+                (query, market, json.dumps(tracks), time.time())
+            )
+
+    def purge_expired(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM search_cache WHERE fetched_at < ?", (time.time() - self.stale_ttl,))
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            entries = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        lookups = sum(counters.get(key, 0) for key in ("fresh_hits", "stale_hits", "misses"))
+        hits = counters.get("fresh_hits", 0) + counters.get("stale_hits", 0)
+        return {**counters, "entries": entries, "hit_ratio": hits / lookups if lookups else 0.0}
@@ -0,0 +1,288 @@
+# modules/track_catalog.py
+# Offline track catalog: audio features + metadata in memory-mapped columnar files,
+# with an IVF (inverted file) approximate-nearest-neighbour index over the features.
+#
+#   python -m modules.track_catalog ingest tracks.csv           # e.g. a Spotify tracks dataset export
+#   python -m modules.track_catalog ingest --synthetic 200000   # random sample catalog, no network needed
+#   python -m modules.track_catalog query Happy
+#
+# Set RECOMMENDATION_SOURCE=catalog to serve playlists from it instead of live Spotify searches.
+import argparse
+import csv
+import json
+import os
+import time
+import numpy as np
+from modules.fusion import to_unified
+
+TRACK_CATALOG_DIR = os.getenv("TRACK_CATALOG_DIR", os.path.join(os.path.dirname(__file__), '..', 'data', 'catalog'))
+
+FEATURES = ["valence", "energy", "danceability", "tempo", "acousticness"]
+STRING_COLUMNS = ["id", "name", "artist", "spotify_url", "preview_url", "album_art_url"]
+TEMPO_RANGE = (50.0, 200.0)  # BPM, scaled to [0, 1] so every feature has the same range
+INGEST_CHUNK_ROWS = 65536  # rows buffered per column before they are written out
+
+# Target point in feature space for each emotion (valence, energy, danceability, tempo, acousticness)
+EMOTION_TARGETS = {
+    "Happy":     [0.85, 0.80, 0.75, 0.60, 0.20],
+    "Sad":       [0.15, 0.25, 0.35, 0.30, 0.70],
+    "Angry":     [0.25, 0.95, 0.50, 0.75, 0.05],
+    "Calm":      [0.55, 0.20, 0.40, 0.25, 0.85],
+    "Fearful":   [0.10, 0.40, 0.25, 0.40, 0.50],
+    "Disgust":   [0.20, 0.80, 0.40, 0.65, 0.10],
+    "Surprised": [0.70, 0.75, 0.65, 0.70, 0.25],
+    "Neutral":   [0.50, 0.45, 0.50, 0.45, 0.45],
+}
+
+def _scale_tempo(bpm):
+    low, high = TEMPO_RANGE
+    return min(max((bpm - low) / (high - low), 0.0), 1.0)
+
+class _ArrayColumnWriter:
+    """
+    Streams fixed-width rows to <name>.npy. Rows collect in a preallocated chunk that is spilled to
+    a raw file whenever it fills, so ingest memory stays constant however large the catalog is.
+    """
+    def __init__(self, directory, name, dtype, width=None, chunk_rows=INGEST_CHUNK_ROWS):
+        self.path = os.path.join(directory, f"{name}.npy")
+        self.raw_path = self.path + ".raw"
+        self.file = open(self.raw_path, "wb")
+        self.buffer = np.empty((chunk_rows,) if width is None else (chunk_rows, width), dtype=dtype)
+        self.filled = self.count = 0
+
+    def append(self, row):
+        self.buffer[self.filled] = row
+        self.filled += 1
+        if self.filled == len(self.buffer):
+            self._spill()
+
+    def _spill(self):
+        self.file.write(self.buffer[:self.filled].tobytes())
+        self.count += self.filled
+        self.filled = 0
+
+    def close(self):
+        """Writes <name>.npy from the spilled rows, chunk by chunk, and returns it memory-mapped."""
+        self._spill()
+        self.file.close()
+        shape = (self.count,) + self.buffer.shape[1:]
+        output = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.buffer.dtype, shape=shape)
+        if self.count:
+            raw = np.memmap(self.raw_path, dtype=self.buffer.dtype, mode="r", shape=shape)
+            for start in range(0, self.count, len(self.buffer)):
+                output[start:start + len(self.buffer)] = raw[start:start + len(self.buffer)]
+            del raw
+        output.flush()
+        del output
+        os.remove(self.raw_path)
+        return np.load(self.path, mmap_mode="r")
+
+class _StringColumnWriter:
+    """Appends UTF-8 strings to <name>.bytes and records their offsets for <name>.offsets.npy."""
+    def __init__(self, directory, name):
+        self.file = open(os.path.join(directory, f"{name}.bytes"), "wb")
+        self.offsets = _ArrayColumnWriter(directory, f"{name}.offsets", np.int64)
+        self.offsets.append(0)
+        self.end = 0
+
+    def append(self, value):
+        data = (value or "").encode("utf-8")
+        self.file.write(data)
+        self.end += len(data)
+        self.offsets.append(self.end)
+
+    def close(self):
+        self.file.close()
+        self.offsets.close()
+
+def _iter_csv_tracks(path):
+    """Reads tracks from a CSV with Spotify audio-feature columns (track_id, track_name, artists, valence, ...)."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                features = [float(row[name]) for name in FEATURES]
+            except (KeyError, ValueError):
+                continue
+            track_id = row.get("track_id") or row.get("id")
+            yield {
+                "id": track_id,
+                "name": row.get("track_name") or row.get("name"),
+                "artist": (row.get("artists") or row.get("artist") or "").split(";")[0],
+                "spotify_url": row.get("spotify_url") or f"https://open.spotify.com/track/{track_id}",
+                "preview_url": row.get("preview_url"),
+                "album_art_url": row.get("album_art_url"),
+            }, features
+
+def _iter_synthetic_tracks(count, seed=0):
+    rng = np.random.default_rng(seed)
+    for index in range(count):
+        track_id = f"synthetic{index:013d}"
+        features = rng.beta(2, 2, size=len(FEATURES)).tolist()
+        features[FEATURES.index("tempo")] = TEMPO_RANGE[0] + features[FEATURES.index("tempo")] * (TEMPO_RANGE[1] - TEMPO_RANGE[0])
+        yield {
+            "id": track_id,
+            "name": f"Sample Track {index + 1}",
+            "artist": f"Sample Artist {index % 997 + 1}",
+            "spotify_url": f"https://open.spotify.com/track/{track_id}",
+            "preview_url": None,
+            "album_art_url": None,
+        }, features
+
+def _kmeans(points, k, iterations=20, seed=0):
+    """Plain Lloyd's k-means in numpy; good enough for a coarse quantizer over a handful of dimensions."""
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest_centroid(points, centroids)
+        for cluster in range(k):
+            members = points[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return centroids
+
+def _nearest_centroid(points, centroids):
+    # |a - b|^2 = |a|^2 - 2ab + |b|^2 as a matmul, in chunks of ~16M distances to bound memory
+    chunk = max(1, (1 << 24) // len(centroids))
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(points), dtype=np.int32)
+    for start in range(0, len(points), chunk):
+        block = np.asarray(points[start:start + chunk])
+        distances = centroid_norms - 2 * block @ centroids.T
+        assignments[start:start + chunk] = distances.argmin(axis=1)
+    return assignments
+
+def build_index(features, nlist=None, sample_size=100_000):
+    """Trains IVF centroids on a sample and groups track ids by their nearest centroid."""
+    nlist = nlist or int(np.clip(np.sqrt(len(features)), 1, 4096))
+    rng = np.random.default_rng(0)
+    # Sorted rows read a memory-mapped feature file front to back
+    sample = features if len(features) <= sample_size else features[np.sort(rng.choice(len(features), sample_size, replace=False))]
+    centroids = _kmeans(np.asarray(sample), min(nlist, len(sample)))
+
+    assignments = _nearest_centroid(features, centroids)
+    list_ids = np.argsort(assignments, kind="stable").astype(np.int32)
+    list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=list_offsets[1:])
+    return centroids.astype(np.float32), list_offsets, list_ids
+
+def ingest(tracks, directory=TRACK_CATALOG_DIR, nlist=None):
+    """
+    Writes the catalog columns for an iterable of (metadata, raw features) and builds the ANN index.
+    Every column is streamed to disk, so the tracks are never all held in memory at once.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # Without meta.json the directory reads as no catalog, never as old metadata over new columns
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    writers = {name: _StringColumnWriter(directory, name) for name in STRING_COLUMNS}
+    feature_writer = _ArrayColumnWriter(directory, "features", np.float32, width=len(FEATURES))
+    tempo_index = FEATURES.index("tempo")
+
+    for metadata, features in tracks:
+        features = list(features)
+        features[tempo_index] = _scale_tempo(features[tempo_index])
+        feature_writer.append(features)
+        for name, writer in writers.items():
+            writer.append(metadata.get(name))
+    for writer in writers.values():
+        writer.close()
+
+    features = feature_writer.close()
+    if len(features) == 0:
+        raise ValueError("No tracks with audio features ingested (the CSV needs columns: " + ", ".join(FEATURES) + ")")
+    centroids, list_offsets, list_ids = build_index(features, nlist)
+    np.save(os.path.join(directory, "centroids.npy"), centroids)
+    np.save(os.path.join(directory, "list_offsets.npy"), list_offsets)
+    np.save(os.path.join(directory, "list_ids.npy"), list_ids)
+
+    with open(meta_path, "w") as f:
+        json.dump({"count": len(features), "features": FEATURES, "nlist": len(centroids)}, f)
+    return len(features)
+
+class TrackCatalog:
+    """Read-only view of an ingested catalog. Everything is memory-mapped, so opening it is instant."""
+    def __init__(self, directory=TRACK_CATALOG_DIR):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(directory, name), mmap_mode="r")
+
+        self.features = load("features.npy")
+        self.centroids = np.asarray(load("centroids.npy"))
+        self.list_offsets = np.asarray(load("list_offsets.npy"))
+        self.list_ids = load("list_ids.npy")
+        self._strings = {
+            name: (load(f"{name}.offsets.npy"), np.memmap(os.path.join(directory, f"{name}.bytes"), dtype=np.uint8, mode="r")
+                   if os.path.getsize(os.path.join(directory, f"{name}.bytes")) else np.zeros(0, dtype=np.uint8))
+            for name in STRING_COLUMNS
+        }
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _string(self, name, index):
+        offsets, data = self._strings[name]
+        value = bytes(data[offsets[index]:offsets[index + 1]]).decode("utf-8")
+        return value or None
+
+    def track(self, index):
+        return {name: self._string(name, index) for name in STRING_COLUMNS}
+
+    def search(self, target, k=10, nprobe=8):
+        """Approximate top-k by Euclidean distance: exact ranking within the `nprobe` closest IVF lists."""
+        target = np.asarray(target, dtype=np.float32)
+        centroid_distances = ((self.centroids - target) ** 2).sum(axis=1)
+        probe = np.argsort(centroid_distances)[:nprobe]
+        candidates = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe])
+        if len(candidates) == 0:
+            return []
+
+        # Sorted ids read the memory-mapped feature file front to back
+        candidates = np.sort(candidates)
+        distances = ((np.asarray(self.features[candidates]) - target) ** 2).sum(axis=1)
+        top = np.argpartition(distances, min(k, len(distances) - 1))[:k]
+        top = top[np.argsort(distances[top])]
+        return [int(candidates[i]) for i in top]
+
+def emotion_target(emotion):
+    emotion = to_unified(emotion)
+    return EMOTION_TARGETS.get(emotion, EMOTION_TARGETS["Neutral"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the offline track catalog.")
+    parser.add_argument("--dir", default=TRACK_CATALOG_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = sub.add_parser("ingest", help="Build the catalog from a CSV or a synthetic sample")
+    ingest_parser.add_argument("csv", nargs="?")
+    ingest_parser.add_argument("--synthetic", type=int, help="Generate this many random tracks instead of reading a CSV")
+    ingest_parser.add_argument("--nlist", type=int, help="Number of IVF lists (default: sqrt(N))")
+    query_parser = sub.add_parser("query", help="Show the nearest tracks for an emotion")
+    query_parser.add_argument("emotion")
+    query_parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        if not args.csv and not args.synthetic:
+            parser.error("ingest needs a CSV path or --synthetic N")
+        tracks = _iter_synthetic_tracks(args.synthetic) if args.synthetic else _iter_csv_tracks(args.csv)
+        started = time.perf_counter()
+        try:
+            count = ingest(tracks, args.dir, args.nlist)
+        except ValueError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Ingested {count} tracks into {args.dir} in {time.perf_counter() - started:.1f}s")
+    else:
+        catalog = TrackCatalog(args.dir)
+        started = time.perf_counter()
+        indices = catalog.search(emotion_target(args.emotion), k=args.k)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for index in indices:
+            track = catalog.track(index)
+            print(f"{track['name']} — {track['artist']}")
+        print(f"\n{len(indices)} tracks from {len(catalog)} in {elapsed_ms:.2f} ms")
+
+if __name__ == "__main__":
+    main()
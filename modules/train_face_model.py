@@ -1,18 +1,33 @@
+# Run from the repository root:
+#   python -m modules.train_face_model                        # tf.data pipeline
+#   python -m modules.train_face_model --pipeline generator   # original ImageDataGenerator, for comparison
+#   python -m modules.train_face_model --feature-cache data/features   # stage 1 on cached backbone features
+# Splits built with `python -m modules.rafdb_store build ...` are read from the store automatically.
 import tensorflow as tf
 from tensorflow.keras.applications import ResNet50
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout
+from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout, Input
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
+from tensorflow.keras.utils import Sequence
 from sklearn.utils.class_weight import compute_class_weight
 import numpy as np
+import argparse
+import hashlib
+import json
+import math
 import os
+import time
+
+from modules.rafdb import list_images
+from modules.rafdb_store import open_store
 
 # --- Model & Data Parameters ---
 IMG_SIZE = 224
 BATCH_SIZE = 32
 NUM_CLASSES = 7 # RAF-DB has 7 emotion classes
+FEATURE_DIM = 2048 # ResNet50 output after global average pooling
 
 def get_data_generators(train_dir, val_dir):
     # Set up data augmentation for the training data
@@ -49,7 +64,232 @@ def get_data_generators(train_dir, val_dir):
     )
     return train_gen, val_gen
 
+# --- Improvement: tf.data input pipeline (parallel decode, on-graph batched augmentation, prefetch) ---
+def _decode_resized(path, label):
+    """Reads and decodes one image, resized to the model input; kept as uint8 so caches stay small."""
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, (IMG_SIZE, IMG_SIZE))
+    return tf.cast(tf.round(image), tf.uint8), label
+
+def random_affine(images, rotation_deg=25, shift=0.15, shear_deg=0.15, zoom=0.15):
+    """
+    The ImageDataGenerator augmentation (rotation/shift/shear/zoom/horizontal flip, fill_mode='nearest')
+    for a whole batch at once: one random affine matrix per image, applied in a single transform op.
+    shear_deg is in degrees, as ImageDataGenerator's shear_range is.
+    """
+    batch = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+
+    def uniform(limit):
+        return tf.random.uniform([batch], -limit, limit)
+
+    theta = uniform(np.deg2rad(rotation_deg))
+    shear = uniform(np.deg2rad(shear_deg))
+    zoom_x, zoom_y = 1 + uniform(zoom), 1 + uniform(zoom)
+    shift_x, shift_y = uniform(shift) * width, uniform(shift) * height
+
+    # Maps output pixels to input pixels: rotation @ shear @ zoom around the image centre, then shift
+    a00, a01 = tf.cos(theta) * zoom_x, -tf.sin(theta + shear) * zoom_y
+    a10, a11 = tf.sin(theta) * zoom_x, tf.cos(theta + shear) * zoom_y
+    center_x, center_y = (width - 1) / 2, (height - 1) / 2
+    offset_x = center_x + shift_x - (a00 * center_x + a01 * center_y)
+    offset_y = center_y + shift_y - (a10 * center_x + a11 * center_y)
+    zeros = tf.zeros([batch])
+    transforms = tf.stack([a00, a01, offset_x, a10, a11, offset_y, zeros, zeros], axis=1)
+
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms, output_shape=tf.shape(images)[1:3],
+        fill_value=0.0, interpolation="BILINEAR", fill_mode="NEAREST")
+    flip = tf.random.uniform([batch]) < 0.5
+    return tf.where(flip[:, None, None, None], tf.reverse(images, axis=[2]), images)
+
+# --- Improvement: read splits from the preprocessed rafdb_store (no JPEG decoding at all) ---
+def _open_store(directory):
+    """The up-to-date store for a split at the model's input size, or None."""
+    store = open_store(directory)
+    return store if store is not None and store.images.shape[1] == IMG_SIZE else None
+
+def _store_dataset(store, shuffle=False):
+    """Batches of (uint8 images, labels) gathered straight from a memory-mapped store split."""
+    rows = tf.data.Dataset.range(len(store))
+    if shuffle:
+        rows = rows.shuffle(len(store), reshuffle_each_iteration=True)
+
+    def gather(batch_rows):
+        # The batch is already a random draw, so reading its rows in order loses nothing
+        batch_rows = np.sort(batch_rows)
+        return store.images[batch_rows], store.labels[batch_rows].astype(np.int32)
+
+    def load(batch_rows):
+        images, labels = tf.numpy_function(gather, [batch_rows], (tf.uint8, tf.int32))
+        images.set_shape((None, IMG_SIZE, IMG_SIZE, 3))
+        labels.set_shape((None,))
+        return images, labels
+    return rows.batch(BATCH_SIZE).map(load, num_parallel_calls=tf.data.AUTOTUNE)
+
+def get_datasets(train_dir, val_dir, cache_dir=None, use_store=True):
+    """
+    Returns (train_ds, val_ds, train_labels). Labels are one-hot like the generators' 'categorical' mode.
+    Splits with a built rafdb_store are read from it. Otherwise the decoded validation set is cached
+    (in memory, or under cache_dir so later runs skip decoding); with cache_dir the decoded training
+    images are cached there too and only augmentation runs per epoch.
+    """
+    autotune = tf.data.AUTOTUNE
+
+    def files(directory):
+        items = list_images(directory)
+        return [path for path, _ in items], np.array([label for _, label in items], dtype=np.int32)
+
+    def cache_path(name):
+        if not cache_dir:
+            return ""
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, name)
+
+    def to_model_input(images, labels):
+        return tf.cast(images, tf.float32) / 255.0, tf.one_hot(labels, NUM_CLASSES)
+
+    train_store = _open_store(train_dir) if use_store else None
+    if train_store is not None:
+        print(f"Reading training images from {train_store.store_dir}")
+        train_ds = _store_dataset(train_store, shuffle=True)
+        train_labels = train_store.labels.astype(np.int32)
+    else:
+        train_paths, train_labels = files(train_dir)
+        train_ds = tf.data.Dataset.from_tensor_slices((train_paths, train_labels))
+        if cache_dir:
+            train_ds = train_ds.map(_decode_resized, num_parallel_calls=autotune).cache(cache_path("train"))
+            train_ds = train_ds.shuffle(2048, reshuffle_each_iteration=True)
+        else:
+            # Shuffling file names is free; decoded images would need a large shuffle buffer
+            train_ds = train_ds.shuffle(len(train_paths), reshuffle_each_iteration=True)
+            train_ds = train_ds.map(_decode_resized, num_parallel_calls=autotune, deterministic=False)
+        train_ds = train_ds.batch(BATCH_SIZE)
+    train_ds = (train_ds.map(to_model_input, num_parallel_calls=autotune)
+                .map(lambda images, labels: (random_affine(images), labels), num_parallel_calls=autotune)
+                .prefetch(autotune))
+
+    val_store = _open_store(val_dir) if use_store else None
+    if val_store is not None:
+        print(f"Reading validation images from {val_store.store_dir}")
+        val_ds = _store_dataset(val_store)
+    else:
+        val_paths, val_labels = files(val_dir)
+        val_ds = (tf.data.Dataset.from_tensor_slices((val_paths, val_labels))
+                  .map(_decode_resized, num_parallel_calls=autotune)
+                  .cache(cache_path("val"))
+                  .batch(BATCH_SIZE))
+    val_ds = val_ds.map(to_model_input, num_parallel_calls=autotune).prefetch(autotune)
+    return train_ds, val_ds, train_labels
+
+class ThroughputLogger(Callback):
+    """Prints training steps/sec and images/sec per epoch (validation excluded), to compare input pipelines."""
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.started = self.last_step = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.last_step = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = max(self.last_step - self.started, 1e-9)
+        print(f"Epoch {epoch + 1}: {self.steps / elapsed:.2f} steps/s, {self.steps * BATCH_SIZE / elapsed:.1f} images/s")
+
+# --- Improvement: stage 1 on cached backbone features (the frozen ResNet50 runs once, not every epoch) ---
+def _image_batches(paths, augment=False, store=None):
+    """Model-ready batches in file order, optionally with the training augmentation applied."""
+    autotune = tf.data.AUTOTUNE
+    if store is not None:
+        ds = _store_dataset(store)
+    else:
+        ds = tf.data.Dataset.from_tensor_slices((paths, np.zeros(len(paths), dtype=np.int32)))
+        ds = ds.map(_decode_resized, num_parallel_calls=autotune).batch(BATCH_SIZE)
+    ds = ds.map(lambda images, _: tf.cast(images, tf.float32) / 255.0, num_parallel_calls=autotune)
+    if augment:
+        ds = ds.map(random_affine, num_parallel_calls=autotune)
+    return ds.prefetch(autotune)
+
+def _weights_digest(model):
+    """Hash of every weight array, so features from a different backbone are never reused."""
+    digest = hashlib.sha1()
+    for weights in model.get_weights():
+        digest.update(np.ascontiguousarray(weights).tobytes())
+    return digest.hexdigest()
+
+def extract_features(extractor, directory, cache_dir, name, variants=0, use_store=True):
+    """
+    Runs the frozen backbone once over a split and stores the pooled features in <cache_dir>/<name>.npy,
+    shaped (1 + variants, N, FEATURE_DIM): the plain images first, then `variants` augmented copies.
+    The file is reused while the images (paths, sizes and mtimes), the backbone weights and the
+    variant count are unchanged. Returns (memory-mapped features, labels).
+    """
+    items = list_images(directory)
+    paths = [path for path, _ in items]
+    labels = np.array([label for _, label in items], dtype=np.int32)
+    files = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        files.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    signature = {"files": files.hexdigest(), "backbone": _weights_digest(extractor), "variants": variants}
+    features_path = os.path.join(cache_dir, f"{name}.npy")
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+
+    if os.path.exists(meta_path) and os.path.exists(features_path):
+        with open(meta_path) as f:
+            if json.load(f) == signature:
+                print(f"Using cached {name} features from {features_path}")
+                return np.load(features_path, mmap_mode="r"), labels
+
+    os.makedirs(cache_dir, exist_ok=True)
+    store = _open_store(directory) if use_store else None
+    features = np.lib.format.open_memmap(features_path, mode="w+", dtype=np.float32,
+                                         shape=(1 + variants, len(paths), FEATURE_DIM))
+    for variant in range(1 + variants):
+        started = time.perf_counter()
+        row = 0
+        for batch in _image_batches(paths, augment=variant > 0, store=store):
+            output = extractor.predict_on_batch(batch)
+            features[variant, row:row + len(output)] = output
+            row += len(output)
+        print(f"Extracted {name} features, variant {variant + 1}/{1 + variants}: "
+              f"{len(paths) / (time.perf_counter() - started):.1f} images/s")
+    features.flush()
+    del features
+
+    # Written last, so an interrupted extraction is redone instead of reused
+    with open(meta_path, "w") as f:
+        json.dump(signature, f)
+    return np.load(features_path, mmap_mode="r"), labels
+
+class FeatureSequence(Sequence):
+    """Batches of cached features; every epoch each image contributes one randomly chosen variant."""
+    def __init__(self, features, labels, batch_size=BATCH_SIZE, shuffle=True):
+        super().__init__()
+        self.features, self.labels = features, labels
+        self.batch_size, self.shuffle = batch_size, shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __getitem__(self, index):
+        # Sorted rows keep reads from the memory-mapped file mostly sequential
+        rows = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        x = np.asarray(self.features[self.variants[rows], rows])
+        return x, np.eye(NUM_CLASSES, dtype=np.float32)[self.labels[rows]]
+
+    def on_epoch_end(self):
+        count = len(self.labels)
+        self.order = np.random.permutation(count) if self.shuffle else np.arange(count)
+        if self.shuffle:
+            self.variants = np.random.randint(0, self.features.shape[0], size=count)
+        else:
+            self.variants = np.zeros(count, dtype=np.int64)
+
 def build_model():
+    """Returns (model, base_model, head); head is the classifier on pooled features and shares its layers with model."""
     # Load ResNet50 pre-trained on ImageNet, without the final classification layer
     base_model = ResNet50(weights='imagenet', include_top=False, input_shape=(IMG_SIZE, IMG_SIZE, 3))
     
@@ -57,23 +297,46 @@ def build_model():
     base_model.trainable = False
     
     # Add custom layers on top for our specific task
+    head_layers = [
+        Dropout(0.5), # Use dropout for regularization to prevent overfitting
+        Dense(512, activation='relu'),
+        Dense(NUM_CLASSES, activation='softmax'),
+    ]
     x = base_model.output
     x = GlobalAveragePooling2D()(x)
-    x = Dropout(0.5)(x) # Use dropout for regularization to prevent overfitting
-    x = Dense(512, activation='relu')(x)
-    predictions = Dense(NUM_CLASSES, activation='softmax')(x)
-    
-    model = Model(inputs=base_model.input, outputs=predictions)
-    return model, base_model
+    for layer in head_layers:
+        x = layer(x)
+    model = Model(inputs=base_model.input, outputs=x)
 
-if __name__ == "__main__":
-    # --- CRITICAL: Update these paths to point to your new dataset ---
-    train_dir = "data/RAF-DB/train"
-    val_dir = "data/RAF-DB/test" # Note: The validation folder is named 'test'
-    
-    train_gen, val_gen = get_data_generators(train_dir, val_dir)
+    # The same layer objects on a feature input: training `head` trains the top of `model`
+    features = Input(shape=(FEATURE_DIM,))
+    y = features
+    for layer in head_layers:
+        y = layer(y)
+    head = Model(inputs=features, outputs=y)
+    return model, base_model, head
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the ResNet50 face emotion model on RAF-DB.")
+    parser.add_argument("--train-dir", default="data/RAF-DB/train")
+    parser.add_argument("--val-dir", default="data/RAF-DB/test")  # Note: The validation folder is named 'test'
+    parser.add_argument("--pipeline", choices=["tfdata", "generator"], default="tfdata",
+                        help="tf.data input pipeline, or the original ImageDataGenerator")
+    parser.add_argument("--cache-dir", help="tf.data only: cache decoded images in files here instead of memory")
+    parser.add_argument("--feature-cache", help="Train stage 1 on backbone features cached in this directory")
+    parser.add_argument("--augmented-variants", type=int, default=4,
+                        help="Augmented copies of each training image in the feature cache")
+    parser.add_argument("--no-store", action="store_true",
+                        help="Decode the JPEGs even when a preprocessed rafdb_store split is available")
+    args = parser.parse_args()
+
+    if args.pipeline == "tfdata":
+        train_data, val_data, train_labels = get_datasets(args.train_dir, args.val_dir, args.cache_dir, not args.no_store)
+    else:
+        train_data, val_data = get_data_generators(args.train_dir, args.val_dir)
+        train_labels = train_data.classes
 
-    model, base_model = build_model()
+    model, base_model, head = build_model()
     
     # Compile the model for the first stage of training
     model.compile(optimizer=Adam(learning_rate=1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
@@ -82,8 +345,8 @@ if __name__ == "__main__":
     # Compute class weights to help the model handle the imbalanced dataset
     class_weights = compute_class_weight(
         class_weight='balanced',
-        classes=np.unique(train_gen.classes),
-        y=train_gen.classes
+        classes=np.unique(train_labels),
+        y=train_labels
     )
     class_weights_dict = dict(enumerate(class_weights))
     print(f"\nCalculated Class Weights: {class_weights_dict}\n")
@@ -95,16 +358,40 @@ if __name__ == "__main__":
     early_stopping = EarlyStopping(monitor='val_loss', patience=10, restore_best_weights=True, verbose=1)
     # Reduce learning rate when performance plateaus
     reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=5, min_lr=1e-6, verbose=1)
+    throughput = ThroughputLogger()
     
     # --- Stage 1: Initial Training (only top layers) ---
     print("--- Starting Initial Training of Top Layers ---")
-    model.fit(
-        train_gen,
-        validation_data=val_gen,
-        epochs=30, # Train for more epochs, EarlyStopping will handle the rest
-        class_weight=class_weights_dict,
-        callbacks=[checkpoint, early_stopping, reduce_lr]
-    )
+    if args.feature_cache:
+        # The backbone is frozen, so its pooled features never change: compute them once, train only the head
+        extractor = Model(inputs=base_model.input, outputs=GlobalAveragePooling2D()(base_model.output))
+        train_features, feature_labels = extract_features(extractor, args.train_dir, args.feature_cache, "train",
+                                                           args.augmented_variants, not args.no_store)
+        val_features, val_labels = extract_features(extractor, args.val_dir, args.feature_cache, "val",
+                                                    use_store=not args.no_store)
+
+        head.compile(optimizer=Adam(learning_rate=1e-4), loss='categorical_crossentropy', metrics=['accuracy'])
+        val_sequence = FeatureSequence(val_features, val_labels, shuffle=False)
+        head.fit(
+            FeatureSequence(train_features, feature_labels),
+            validation_data=val_sequence,
+            epochs=30,
+            class_weight=class_weights_dict,
+            callbacks=[early_stopping, reduce_lr, throughput]
+        )
+        # The head's layers are part of the full model, which now carries the trained weights
+        model.save("models/face_emotion_resnet50.h5")
+        # Stage 2 may only overwrite the saved model with a better one, as after the full-model stage 1
+        _, checkpoint.best = head.evaluate(val_sequence, verbose=0)
+        print(f"Stage 1 val_accuracy: {checkpoint.best:.4f}")
+    else:
+        model.fit(
+            train_data,
+            validation_data=val_data,
+            epochs=30, # Train for more epochs, EarlyStopping will handle the rest
+            class_weight=class_weights_dict,
+            callbacks=[checkpoint, early_stopping, reduce_lr, throughput]
+        )
 
     # --- Stage 2: Fine-Tuning (unfreeze all layers with a tiny learning rate) ---
     print("\n--- Starting Fine-Tuning of Full Model ---")
@@ -114,12 +401,14 @@ if __name__ == "__main__":
     model.compile(optimizer=Adam(learning_rate=1e-5), loss='categorical_crossentropy', metrics=['accuracy'])
     
     model.fit(
-        train_gen,
-        validation_data=val_gen,
+        train_data,
+        validation_data=val_data,
         epochs=20, # Fine-tune for additional epochs
         class_weight=class_weights_dict,
-        callbacks=[checkpoint, early_stopping, reduce_lr]
+        callbacks=[checkpoint, early_stopping, reduce_lr, throughput]
     )
 
     print("\nTraining complete. Best model saved as 'face_emotion_resnet50.h5' in the 'models' directory.")
 
+if __name__ == "__main__":
+    main()
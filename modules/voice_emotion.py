@@ -1,68 +1,400 @@
 # modules/voice_emotion.py
+import io
 import os
-import torch
+import subprocess
+import tempfile
+import threading
+import numpy as np
 import librosa
 import librosa.effects
-from pydub import AudioSegment
-from transformers import AutoFeatureExtractor, AutoModelForAudioClassification
+import soundfile as sf
 import streamlit as st
+from modules import calibration, metrics, model_registry, result_cache
 
-# --- Improvement: Cache the model for efficiency ---
-@st.cache_resource
+VOICE_MODEL_NAME = "ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition"
+# "torch" (default) or "onnx" for the int8 ONNX Runtime export
+VOICE_MODEL_BACKEND = os.getenv("VOICE_MODEL_BACKEND", "torch").lower()
+
+# --- Improvement: Load the model lazily, once per process (see modules/model_registry.py) ---
 def load_voice_model():
-    """Loads the voice model and caches it."""
+    """Loads the voice model. transformers/torch are only imported here, not at module import."""
     try:
-        extractor = AutoFeatureExtractor.from_pretrained("ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition", trust_remote_code=True)
-        model = AutoModelForAudioClassification.from_pretrained("ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition", trust_remote_code=True)
+        from transformers import AutoFeatureExtractor, AutoModelForAudioClassification
+        extractor = AutoFeatureExtractor.from_pretrained(VOICE_MODEL_NAME, trust_remote_code=True)
+        if VOICE_MODEL_BACKEND == "onnx":
+            from transformers import AutoConfig
+            from modules.onnx_runtime import OnnxModelForClassification, onnx_model_path
+            model = OnnxModelForClassification(onnx_model_path("voice"), AutoConfig.from_pretrained(VOICE_MODEL_NAME))
+        else:
+            model = AutoModelForAudioClassification.from_pretrained(VOICE_MODEL_NAME, trust_remote_code=True)
         return extractor, model
     except Exception as e:
         st.error(f"Error loading voice model: {e}")
         return None, None
 
-extractor, model = load_voice_model()
+model_registry.register("voice", load_voice_model, 400 if VOICE_MODEL_BACKEND == "onnx" else 1300)
+
+def get_voice_model():
+    """Returns (extractor, model); both are None if loading failed."""
+    return model_registry.get("voice")
 
 # --- Improvement: Standardized labels ---
 EMOTION_LABELS = ['Angry', 'Calm', 'Happy', 'Sad', 'Fearful', 'Disgust', 'Surprised', 'Neutral']
 
+SAMPLE_RATE = 16000
+
+# --- Streaming mode for long recordings ---
+VOICE_WINDOW_SECONDS = float(os.getenv("VOICE_WINDOW_SECONDS", "4.0"))
+VOICE_HOP_SECONDS = float(os.getenv("VOICE_HOP_SECONDS", "2.0"))
+VOICE_BATCH_SIZE = int(os.getenv("VOICE_BATCH_SIZE", "4"))
+BLOCK_SECONDS = 30.0
+MIN_WINDOW_SECONDS = 0.5
+# Frames quieter than this (RMS, dB relative to full scale) are silence. A fixed floor rather than
+# librosa's default "25 dB below this block's loudest frame", so the same passage gets the same
+# verdict wherever the block boundaries fall.
+VOICE_SILENCE_DBFS = float(os.getenv("VOICE_SILENCE_DBFS", "-50"))
+
 # --- Improvement: Removed hardcoded FFMPEG path ---
 # NOTE: User must have FFMPEG installed and in their system PATH.
 
-def convert_to_wav_if_needed(audio_path):
-    # This function is good, but improved error handling
-    ext = os.path.splitext(audio_path)[-1].lower()
-    if ext == ".wav":
-        return audio_path
-    
-    wav_path = audio_path.replace(ext, ".wav")
+def _read_audio_bytes(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "read"):
+        return source.read()
+    with open(os.fspath(source), "rb") as f:
+        return f.read()
+
+def _needs_seekable_input(data):
+    """
+    MP4-family containers (m4a, mp4, mov, 3gp) start with an "ftyp" box. Phone recordings often
+    put the "moov" index at the end of the file, which FFMPEG can't reach on a pipe.
+    """
+    return data[4:8] == b"ftyp"
+
+@metrics.timed("audio_ffmpeg_decode")
+def _decode_with_ffmpeg(data, sample_rate):
+    """
+    Decodes any container FFMPEG understands to mono float32 PCM. Stream-friendly formats are
+    piped in; MP4-family files go through a temporary file because FFMPEG has to seek in them.
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+    if not _needs_seekable_input(data):
+        process = subprocess.run(command, input=data, capture_output=True, check=True)
+        return np.frombuffer(process.stdout, dtype=np.float32)
+
+    # delete=False so FFMPEG can open the file by name on Windows too
+    with tempfile.NamedTemporaryFile(suffix=".m4a", delete=False) as f:
+        f.write(data)
     try:
-        audio = AudioSegment.from_file(audio_path)
-        audio = audio.set_frame_rate(16000).set_channels(1)
-        audio.export(wav_path, format="wav")
-        return wav_path
-    except Exception as e:
+        command[command.index("pipe:0")] = f.name
+        process = subprocess.run(command, capture_output=True, check=True)
+        return np.frombuffer(process.stdout, dtype=np.float32)
+    finally:
+        os.remove(f.name)
+
+@metrics.timed("audio_decode")
+def load_audio(source, sample_rate=SAMPLE_RATE):
+    """
+    Decodes a path, raw bytes or file-like object into a mono float32 waveform at `sample_rate`.
+    WAV/FLAC/OGG are decoded in-process by soundfile; everything else (mp3, m4a, webm) goes
+    through FFMPEG, piped in except for MP4-family files (see _decode_with_ffmpeg).
+    """
+    data = _read_audio_bytes(source)
+    try:
+        speech, native_rate = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except RuntimeError:
+        return _decode_with_ffmpeg(data, sample_rate)
+
+    speech = speech.mean(axis=1)
+    if native_rate != sample_rate:
+        with metrics.span("audio_resample"):
+            speech = librosa.resample(speech, orig_sr=native_rate, target_sr=sample_rate)
+    return speech
+
+def _ffmpeg_blocks(path, data, sample_rate, block_seconds):
+    """
+    Yields PCM blocks from an FFMPEG pipe. Reads `path`, or `data` fed to stdin from a thread so
+    decoding runs while earlier blocks are consumed and the output is never held in full.
+    """
+    process = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0" if path is None else path,
+         "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+        stdin=subprocess.DEVNULL if data is None else subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    if data is not None:
+        def feed():
+            try:
+                process.stdin.write(data)
+            except OSError:
+                pass  # FFMPEG exited early; its return code reports why
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        threading.Thread(target=feed, name="ffmpeg-feed", daemon=True).start()
+    try:
+        block_bytes = int(block_seconds * sample_rate) * 4
+        while True:
+            chunk = process.stdout.read(block_bytes)
+            if not chunk:
+                break
+            yield np.frombuffer(chunk, dtype=np.float32)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+
+def _iter_audio_blocks(source, sample_rate=SAMPLE_RATE, block_seconds=BLOCK_SECONDS):
+    """
+    Yields the waveform in fixed-size blocks, so memory doesn't grow with duration: only the
+    (compressed) input and one decoded block are held. Paths are read from disk incrementally;
+    bytes and uploads are decoded from memory a block at a time. WAV/FLAC/OGG go through
+    soundfile, everything else through an FFMPEG pipe (MP4-family bytes via a temporary file,
+    see _decode_with_ffmpeg).
+    """
+    if isinstance(source, (str, os.PathLike)):
+        path, data = os.fspath(source), None
+    else:
+        path, data = None, _read_audio_bytes(source)
+
+    def open_input():
+        return path if data is None else io.BytesIO(data)
+
+    try:
+        native_rate = sf.info(open_input()).samplerate
+    except RuntimeError:
+        native_rate = None
+
+    if native_rate is not None:
+        for block in sf.blocks(open_input(), blocksize=int(block_seconds * native_rate), dtype="float32", always_2d=True):
+            block = block.mean(axis=1)
+            if native_rate != sample_rate:
+                block = librosa.resample(block, orig_sr=native_rate, target_sr=sample_rate)
+            yield block
+        return
+
+    if data is None or not _needs_seekable_input(data):
+        yield from _ffmpeg_blocks(path, data, sample_rate, block_seconds)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".m4a", delete=False) as f:
+        f.write(data)
+    try:
+        yield from _ffmpeg_blocks(f.name, None, sample_rate, block_seconds)
+    finally:
+        os.remove(f.name)
+
+def _voiced_windows(blocks, sample_rate=SAMPLE_RATE, window_seconds=VOICE_WINDOW_SECONDS, hop_seconds=VOICE_HOP_SECONDS):
+    """
+    Drops silent regions (voice-activity detection by energy against the fixed VOICE_SILENCE_DBFS
+    floor) and cuts the voiced ones into overlapping windows. Yields (waveform, start_s, end_s). A voiced region that runs into the
+    end of a block is carried over to the next block, so windows never get split by the block size.
+    """
+    window, hop = int(window_seconds * sample_rate), int(hop_seconds * sample_rate)
+    min_length = int(MIN_WINDOW_SECONDS * sample_rate)
+    carry = np.zeros(0, dtype=np.float32)
+    offset = 0  # absolute sample index of the first sample after the last block
+
+    blocks = iter(blocks)
+    block = next(blocks, None)
+    while block is not None:
+        next_block = next(blocks, None)
+        is_last = next_block is None
+        audio = np.concatenate([carry, block])
+        audio_start = offset - len(carry)
+        offset += len(block)
+        carry = np.zeros(0, dtype=np.float32)
+
+        for region_start, region_end in librosa.effects.split(audio, top_db=-VOICE_SILENCE_DBFS, ref=1.0):
+            position = region_start
+            while position + window <= region_end:
+                yield audio[position:position + window], (audio_start + position) / sample_rate, (audio_start + position + window) / sample_rate
+                position += hop
+            if region_end == len(audio) and not is_last:
+                carry = audio[position:]
+            elif region_end - position >= min_length and (position == region_start or region_end - position > window - hop):
+                # Region shorter than a window, or a tail that the last full window didn't cover
+                yield audio[position:region_end], (audio_start + position) / sample_rate, (audio_start + region_end) / sample_rate
+        block = next_block
+
+@metrics.timed("voice_model_forward")
+def _classify_waveforms(waveforms):
+    """Runs one batched forward pass and returns the (N, num_labels) logits as a numpy array."""
+    extractor, model = get_voice_model()
+    if VOICE_MODEL_BACKEND == "onnx":
+        # numpy in, numpy out: the ONNX backend never imports torch
+        return model(**extractor(waveforms, sampling_rate=SAMPLE_RATE, return_tensors="np", padding=True)).logits
+    import torch
+    inputs = extractor(waveforms, sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True)
+    with torch.no_grad():
+        logits = model(**inputs).logits
+    return logits.numpy()
+
+def _softmax(logits):
+    probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+def _label_from_probabilities(probabilities):
+    """Top label, or "Uncertain" below its calibrated threshold (none unless one was saved)."""
+    label = EMOTION_LABELS[int(probabilities.argmax())]
+    if probabilities.max() < calibration.threshold("voice", label):
+        metrics.inc("uncertain_total", modality="voice")
+        return "Uncertain"
+    return label
+
+def detect_emotion_timeline(audio_source, window_seconds=VOICE_WINDOW_SECONDS, hop_seconds=VOICE_HOP_SECONDS, batch_size=VOICE_BATCH_SIZE):
+    """
+    Streaming analysis for long recordings with bounded memory.
+    Voiced windows are classified `batch_size` at a time; logits are averaged over time
+    (weighted by window length) and calibrated like a single clip for the overall label, and
+    consecutive windows with the same label are merged into the timeline.
+    Returns {"emotion", "timeline": [{"start", "end", "emotion", "confidence"}], "voiced_seconds"} or an error string.
+    """
+    extractor, model = get_voice_model()
+    if model is None or extractor is None:
+        return "Voice model not loaded."
+
+    try:
+        logit_sum = None
+        total_weight = 0.0
+        timeline = []
+        batch = []
+
+        def flush():
+            nonlocal logit_sum, total_weight
+            logits = _classify_waveforms([waveform for waveform, _, _ in batch])
+            probabilities = calibration.calibrate("voice", _softmax(logits))
+            for (_, start, end), row_logits, row_probs in zip(batch, logits, probabilities):
+                weight = end - start
+                logit_sum = row_logits * weight if logit_sum is None else logit_sum + row_logits * weight
+                total_weight += weight
+                label = EMOTION_LABELS[int(row_probs.argmax())]
+                if timeline and timeline[-1]["emotion"] == label and start <= timeline[-1]["end"]:
+                    timeline[-1]["end"] = end
+                    timeline[-1]["confidence"] = max(timeline[-1]["confidence"], float(row_probs.max()))
+                else:
+                    timeline.append({"start": start, "end": end, "emotion": label, "confidence": float(row_probs.max())})
+            batch.clear()
+
+        windows = _voiced_windows(_iter_audio_blocks(audio_source), window_seconds=window_seconds, hop_seconds=hop_seconds)
+        for item in windows:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+        if logit_sum is None:
+            return "Audio is silent."
+        probabilities = calibration.calibrate("voice", _softmax((logit_sum / total_weight)[np.newaxis]))[0]
+        return {
+            "emotion": _label_from_probabilities(probabilities),
+            "timeline": timeline,
+            "voiced_seconds": total_weight,
+        }
+
+    except (OSError, subprocess.CalledProcessError) as e:
         st.error(f"Error converting audio. Please ensure FFMPEG is installed and in your system's PATH. Error: {e}")
+        return "Audio conversion failed."
+    except Exception as e:
+        return f"Error during voice analysis: {str(e)}"
+
+# Results that depend only on the audio; conversion failures or a missing model may be transient
+_CACHEABLE_RESULTS = set(EMOTION_LABELS) | {"Uncertain", "Audio is silent."}
+
+def _result_key(data, mode):
+    """Everything a voice result depends on: the audio bytes, the model and the saved calibration."""
+    if data is None:
         return None
+    return result_cache.content_key(data, mode, VOICE_MODEL_BACKEND, VOICE_MODEL_NAME, calibration.version("voice"))
 
-def detect_emotion_from_voice(audio_path):
+@metrics.timed("voice_emotion")
+def detect_emotion_from_voice(audio_source):
+    """Label for one clip, memoized on the audio bytes (see modules/result_cache.py)."""
+    data = result_cache.source_bytes(audio_source)
+    key = _result_key(data, "clip")
+    return result_cache.memoize("voice_emotion", key, lambda: _detect_emotion(audio_source if data is None else data),
+                                cacheable=lambda result: result in _CACHEABLE_RESULTS)
+
+def _detect_emotion(audio_source):
+    extractor, model = get_voice_model()
     if model is None or extractor is None:
         return "Voice model not loaded."
 
     try:
-        wav_path = convert_to_wav_if_needed(audio_path)
-        if not wav_path: return "Audio conversion failed."
+        try:
+            speech = load_audio(audio_source)
+        except (OSError, subprocess.CalledProcessError) as e:
+            st.error(f"Error converting audio. Please ensure FFMPEG is installed and in your system's PATH. Error: {e}")
+            return "Audio conversion failed."
 
-        speech, sr = librosa.load(wav_path, sr=16000)
-        
         # Trim leading/trailing silence
         speech, _ = librosa.effects.trim(speech, top_db=25)
         if speech.size == 0: return "Audio is silent."
 
-        inputs = extractor(speech, sampling_rate=16000, return_tensors="pt", padding=True)
-        with torch.no_grad():
-            logits = model(**inputs).logits
+        probabilities = calibration.calibrate("voice", _softmax(_classify_waveforms([speech])))[0]
+        return _label_from_probabilities(probabilities)
 
-        predicted_class_id = torch.argmax(logits).item()
-        return EMOTION_LABELS[predicted_class_id]
-    
     except Exception as e:
         return f"Error during voice analysis: {str(e)}"
+
+def prepare_voice_clip(audio_source):
+    """Decodes and trims one clip. Returns (waveform, error)."""
+    try:
+        speech, _ = librosa.effects.trim(load_audio(audio_source), top_db=25)
+    except (OSError, subprocess.CalledProcessError, RuntimeError):
+        return None, "Audio conversion failed."
+    if speech.size == 0:
+        return None, "Audio is silent."
+    return speech, None
+
+def classify_voice_clips(waveforms):
+    """One padded forward pass over prepared clips; returns {"emotion", "probabilities"} per clip."""
+    probabilities = calibration.calibrate("voice", _softmax(_classify_waveforms(list(waveforms))))
+    return [
+        {"emotion": _label_from_probabilities(row), "probabilities": dict(zip(EMOTION_LABELS, map(float, row)))}
+        for row in probabilities
+    ]
+
+def detect_emotions_from_voices(audio_sources):
+    """
+    Batched version of detect_emotion_from_voice for many short clips (used by the HTTP service).
+    Every clip is decoded and trimmed, then all voiced clips share one padded forward pass.
+    Returns a list of {"emotion": ..., "probabilities": {...} or None}, in input order.
+    Clips are memoized on their bytes, so only clips not seen before are decoded and classified.
+    """
+    audio_sources = list(audio_sources)
+    sources = [result_cache.source_bytes(source) for source in audio_sources]
+    keys = [_result_key(data, "batch") for data in sources]
+    results = result_cache.lookup_many("voice_emotion", keys)
+    misses = [index for index, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    extractor, model = get_voice_model()
+    if model is None or extractor is None:
+        for index in misses:
+            results[index] = {"emotion": "Voice model not loaded.", "probabilities": None}
+        return results
+
+    pending = []
+    for index in misses:
+        speech, error = prepare_voice_clip(audio_sources[index] if sources[index] is None else sources[index])
+        if error:
+            results[index] = {"emotion": error, "probabilities": None}
+        else:
+            pending.append((index, speech))
+
+    if pending:
+        for (index, _), result in zip(pending, classify_voice_clips([speech for _, speech in pending])):
+            results[index] = result
+    for index in misses:
+        # A failed conversion may be transient (see _CACHEABLE_RESULTS)
+        if results[index]["emotion"] in _CACHEABLE_RESULTS:
+            result_cache.store("voice_emotion", keys[index], results[index])
+    return results